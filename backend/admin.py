@@ -1,8 +1,43 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 
 from backend.models import User, Shop, Category, Product, ProductInfo, Parameter, ProductParameter, Order, OrderItem, \
-    Contact, ConfirmEmailToken
+    Contact, ConfirmEmailToken, PriceChange, OutboxEvent, ImportJob, ArchivedOrder
+from backend.signals import shop_state_changed, order_state_changed
+
+# начиная с этого числа строк в списках админки показываем оценку вместо COUNT(*)
+ESTIMATED_COUNT_THRESHOLD = 100000
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Пагинатор для больших таблиц: без фильтров берём оценку числа строк из статистики postgres,
+    полный COUNT(*) считаем только для отфильтрованных списков
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if not queryset.query.where and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                               [queryset.model._meta.db_table])
+                estimate = int(cursor.fetchone()[0])
+            if estimate >= ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super().count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Базовая админка для больших таблиц: оценка количества строк и без второго COUNT(*) по всей таблице
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(User)
@@ -25,7 +60,15 @@ class CustomUserAdmin(UserAdmin):
 
 @admin.register(Shop)
 class ShopAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('id', 'name', 'user', 'state',)
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    search_fields = ('name',)
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change and 'state' in form.changed_data:
+            shop_state_changed.send(sender=Shop, shop_ids=[obj.id], state=obj.state)
 
 
 @admin.register(Category)
@@ -34,40 +77,96 @@ class CategoryAdmin(admin.ModelAdmin):
 
 
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
-    pass
+class ProductAdmin(LargeTableAdmin):
+    list_display = ('id', 'name', 'category',)
+    list_select_related = ('category',)
+    raw_id_fields = ('category',)
 
 
 @admin.register(ProductInfo)
-class ProductInfoAdmin(admin.ModelAdmin):
-    pass
+class ProductInfoAdmin(LargeTableAdmin):
+    list_display = ('id', 'external_id', 'model', 'product', 'shop', 'price', 'price_rrc', 'quantity', 'is_active',)
+    list_select_related = ('product', 'shop',)
+    raw_id_fields = ('product',)
+    autocomplete_fields = ('shop',)
+    list_filter = ('shop',)
+    search_fields = ('=model',)
 
 
 @admin.register(Parameter)
 class ParameterAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('id', 'name', 'type',)
+    list_filter = ('type',)
+    search_fields = ('name',)
 
 
 @admin.register(ProductParameter)
-class ProductParameterAdmin(admin.ModelAdmin):
-    pass
+class ProductParameterAdmin(LargeTableAdmin):
+    list_display = ('id', 'product_info', 'parameter', 'value', 'value_number',)
+    list_select_related = ('product_info', 'parameter',)
+    raw_id_fields = ('product_info',)
+    autocomplete_fields = ('parameter',)
+    list_filter = ('parameter',)
 
 
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
-    pass
+class OrderAdmin(LargeTableAdmin):
+    list_display = ('id', 'user', 'dt', 'state', 'contact',)
+    list_select_related = ('user', 'contact',)
+    raw_id_fields = ('user', 'contact',)
+    list_filter = ('state',)
+    search_fields = ('=user__email',)
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if 'state' in form.changed_data:
+            order_state_changed.send(sender=Order, order_id=obj.id, old_state=form.initial.get('state'),
+                                     new_state=obj.state)
 
 
 @admin.register(OrderItem)
-class OrderItemAdmin(admin.ModelAdmin):
-    pass
+class OrderItemAdmin(LargeTableAdmin):
+    list_display = ('id', 'order', 'product_info', 'quantity',)
+    list_select_related = ('order', 'product_info',)
+    raw_id_fields = ('order', 'product_info',)
+
+
+@admin.register(PriceChange)
+class PriceChangeAdmin(LargeTableAdmin):
+    list_display = ('id', 'shop', 'product', 'external_id', 'change', 'price', 'price_rrc', 'quantity', 'dt',)
+    list_select_related = ('shop', 'product',)
+    raw_id_fields = ('shop', 'product',)
+
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(LargeTableAdmin):
+    list_display = ('id', 'task', 'created_at', 'published_at', 'attempts',)
+
+
+@admin.register(ArchivedOrder)
+class ArchivedOrderAdmin(LargeTableAdmin):
+    list_display = ('id', 'user', 'dt', 'state', 'archived_at',)
+    list_select_related = ('user',)
+    raw_id_fields = ('user', 'contact',)
+
+
+@admin.register(ImportJob)
+class ImportJobAdmin(LargeTableAdmin):
+    list_display = ('id', 'shop', 'user', 'state', 'created_at', 'duration',)
+    list_filter = ('state',)
+    list_select_related = ('shop', 'user',)
+    raw_id_fields = ('shop', 'user',)
 
 
 @admin.register(Contact)
 class ContactAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('id', 'user', 'city', 'street', 'house', 'phone',)
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
 
 
 @admin.register(ConfirmEmailToken)
 class ConfirmEmailTokenAdmin(admin.ModelAdmin):
-    list_display = ('user', 'key', 'created_at',)
\ No newline at end of file
+    list_display = ('user', 'key', 'created_at',)
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
@@ -8,4 +8,5 @@ class BackendConfig(AppConfig):
     def ready(self):
         """
         импортируем сигналы
-        """
\ No newline at end of file
+        """
+        import backend.signals  # noqa: F401
\ No newline at end of file
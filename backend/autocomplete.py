@@ -0,0 +1,156 @@
+import time
+from bisect import bisect_left, insort
+from collections import Counter
+from heapq import nlargest
+from threading import Lock
+
+from django.conf import settings
+
+from backend.catalog import catalog_version
+from backend.models import ProductInfo, Shop
+
+# верхняя граница для всех строк с данным префиксом
+PREFIX_END = '\U0010ffff'
+
+
+def normalize(name):
+    # регистр без учёта языка (casefold), ё и е не различаем
+    return ' '.join(name.casefold().replace('ё', 'е').split())
+
+
+class PrefixIndex:
+    """
+    Префиксный индекс имён: отсортированный список нормализованных ключей и bisect.
+    Для каждого ключа храним исходное имя и число предложений, подсказки ранжируем по числу предложений.
+    Ответы на префиксы с большим числом совпадений запоминаем до следующего изменения индекса
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.entries = {}
+        self.answers = {}
+
+    def build(self, counts):
+        self.entries = {}
+        for name, count in counts.items():
+            entry = self.entries.setdefault(normalize(name), [name, 0])
+            entry[1] += count
+        self.keys = sorted(self.entries)
+        self.answers = {}
+
+    def update(self, deltas):
+        """
+        Применить изменения числа предложений {имя: приращение}: новые ключи вставляем в отсортированный
+        список, ключи без предложений убираем
+        """
+        for name, delta in deltas.items():
+            if not delta:
+                continue
+            key = normalize(name)
+            entry = self.entries.get(key)
+            if entry is None:
+                if delta > 0:
+                    self.entries[key] = [name, delta]
+                    insort(self.keys, key)
+                continue
+            entry[1] += delta
+            if entry[1] <= 0:
+                del self.entries[key]
+                del self.keys[bisect_left(self.keys, key)]
+        self.answers = {}
+
+    def search(self, prefix, limit):
+        key = normalize(prefix)
+        if not key:
+            return []
+        lo = bisect_left(self.keys, key)
+        hi = bisect_left(self.keys, key + PREFIX_END, lo)
+        # выбор top N из большого диапазона запоминаем
+        remember = hi - lo > settings.AUTOCOMPLETE_REMEMBER_MATCHES
+        if remember and (key, limit) in self.answers:
+            return self.answers[key, limit]
+        answer = [{'name': name, 'offers': count} for name, count in nlargest(
+            limit, (self.entries[key] for key in self.keys[lo:hi]), key=lambda entry: entry[1])]
+        if remember:
+            self.answers[key, limit] = answer
+        return answer
+
+
+class AutocompleteIndex:
+    """
+    Подсказки по именам продуктов и моделям включенных предложений живых версий каталогов.
+    Индекс в памяти процесса строится при первом запросе. Загрузка прайса и смена статуса магазина
+    меняют версию каталога (backend.catalog): тогда пересчитываем только магазины, у которых изменились
+    версия каталога или статус. Для этого храним имена каждого магазина (ссылки на общие строки)
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.index = PrefixIndex()
+        self.shop_names = {}
+        self.shop_states = None
+        self.version = None
+        self.checked_at = 0
+
+    def shop_rows(self, shop_ids=None):
+        queryset = ProductInfo.objects.visible()
+        if shop_ids is not None:
+            queryset = queryset.filter(shop_id__in=shop_ids)
+        return queryset.order_by().values_list('shop_id', 'product__name', 'model').iterator(
+            chunk_size=settings.EXPORT_CHUNK_SIZE)
+
+    def load_shops(self, shop_ids=None):
+        names = {shop_id: [] for shop_id in shop_ids or ()}
+        # одинаковые имена храним одной строкой
+        interned = {}
+        for shop_id, product_name, model in self.shop_rows(shop_ids):
+            shop = names.setdefault(shop_id, [])
+            for name in (product_name, model):
+                if name:
+                    shop.append(interned.setdefault(name, name))
+        return names
+
+    def current_states(self):
+        return {shop_id: (version, state) for shop_id, version, state in Shop.objects.values_list(
+            'id', 'catalog_version', 'state')}
+
+    def refresh(self):
+        version = catalog_version()
+        if self.shop_states is None:
+            self.shop_states = self.current_states()
+            self.shop_names = self.load_shops()
+            self.index.build(Counter(name for names in self.shop_names.values() for name in names))
+        elif version != self.version:
+            states = self.current_states()
+            changed = {shop_id for shop_id in states.keys() | self.shop_states.keys()
+                       if states.get(shop_id) != self.shop_states.get(shop_id)}
+            if changed:
+                deltas = Counter()
+                for shop_id in changed:
+                    deltas.subtract(self.shop_names.pop(shop_id, ()))
+                loaded = self.load_shops(changed)
+                for names in loaded.values():
+                    deltas.update(names)
+                self.shop_names.update((shop_id, names) for shop_id, names in loaded.items() if names)
+                self.index.update(deltas)
+            self.shop_states = states
+        self.version = version
+
+    def search(self, prefix, limit):
+        with self.lock:
+            now = time.monotonic()
+            if self.shop_states is None or now - self.checked_at >= settings.AUTOCOMPLETE_CHECK_SECONDS:
+                self.checked_at = now
+                self.refresh()
+            return self.index.search(prefix, limit)
+
+    def clear(self):
+        with self.lock:
+            self.index = PrefixIndex()
+            self.shop_names = {}
+            self.shop_states = None
+            self.version = None
+            self.checked_at = 0
+
+
+autocomplete = AutocompleteIndex()
@@ -0,0 +1,170 @@
+import json
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from redis import Redis
+
+from backend import reference
+from backend.models import ProductInfo, Order, OrderItem
+
+# стоимость доставки от одного магазина
+DELIVERY = 300
+
+_client = None
+
+
+def touch_basket(order_id):
+    # позиции корзины в базе меняются без сохранения заказа, срок хранения корзины считается от этой отметки
+    Order.objects.filter(id=order_id).update(updated_at=timezone.now())
+
+
+def valid_quantity(value):
+    # количество позиции - целое от единицы, иначе None
+    try:
+        quantity = int(value)
+    except (TypeError, ValueError):
+        return None
+    return quantity if quantity >= 1 else None
+
+
+def redis_client():
+    global _client
+    if _client is None:
+        _client = Redis.from_url(settings.BASKET_REDIS_URL, decode_responses=True)
+    return _client
+
+
+class RedisBasket:
+    """
+    Корзина в redis (BASKET_BACKEND=redis): хеш basket:<user_id> живёт BASKET_TTL секунд с последнего изменения.
+    Поле id - номер корзины, остальные поля - позиции: id предложения -> количество и снимок цены.
+    Суммы считаем по снимку цен, в базу корзина попадает только при оформлении заказа (checkout)
+    """
+
+    def __init__(self, user_id, client=None):
+        self.user_id = user_id
+        self.client = client or redis_client()
+        self.key = f'basket:{user_id}'
+
+    def basket_id(self, create=False):
+        basket_id = self.client.hget(self.key, 'id')
+        if basket_id is None and create:
+            # hsetnx: при параллельных добавлениях номер корзины останется одним
+            self.client.hsetnx(self.key, 'id', self.client.incr('basket:seq'))
+            basket_id = self.client.hget(self.key, 'id')
+        return int(basket_id) if basket_id is not None else None
+
+    def lines(self):
+        return {int(field): json.loads(value) for field, value in self.client.hgetall(self.key).items()
+                if field != 'id'}
+
+    def touch(self):
+        self.client.expire(self.key, settings.BASKET_TTL)
+
+    def add(self, items):
+        """
+        Добавить позиции [{'product_info': id, 'quantity': n}], возвращаем число добавленных.
+        Позиции с количеством меньше единицы пропускаем
+        """
+        quantities = {}
+        for item in items:
+            quantity = valid_quantity(item.get('quantity'))
+            try:
+                product_info_id = int(item['product_info'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if quantity:
+                quantities[product_info_id] = quantity
+        lines = {}
+        for product_info_id, price, shop_id, model, product_id, external_id in ProductInfo.objects.visible().filter(
+                id__in=quantities).values_list(
+                'id', 'price', 'shop_id', 'model', 'product_id', 'external_id'):
+            lines[product_info_id] = json.dumps({
+                'quantity': quantities[product_info_id], 'price': price, 'shop': shop_id, 'model': model,
+                'product': product_id, 'external_id': external_id})
+        if lines:
+            self.basket_id(create=True)
+            self.client.hset(self.key, mapping=lines)
+            self.touch()
+        return len(lines)
+
+    def remove(self, product_info_ids):
+        removed = self.client.hdel(self.key, *product_info_ids) if product_info_ids else 0
+        self.touch()
+        return removed
+
+    def update(self, items):
+        updated = 0
+        for item in items:
+            if not valid_quantity(item['quantity']):
+                continue
+            raw = self.client.hget(self.key, str(item['id']))
+            if raw is not None:
+                line = json.loads(raw)
+                line['quantity'] = item['quantity']
+                self.client.hset(self.key, str(item['id']), json.dumps(line))
+                updated += 1
+        self.touch()
+        return updated
+
+    def data(self):
+        """
+        Корзина в формате BasketSerializer, позиции нумеруются id предложений
+        """
+        basket_id = self.basket_id()
+        if basket_id is None:
+            return []
+        lines = self.lines()
+        shop_ids = {line['shop'] for line in lines.values()}
+        reference.shops.get_many(shop_ids)
+        ordered_items = [{
+            'id': product_info_id,
+            'product_info': {'id': product_info_id, 'model': line['model'],
+                             'shop': reference.shops.name(line['shop']), 'price': line['price']},
+            'quantity': line['quantity'],
+        } for product_info_id, line in sorted(lines.items())]
+        basket_sum = sum(line['quantity'] * line['price'] for line in lines.values()) if lines else None
+        delivery = len(shop_ids) * DELIVERY
+        return [{'id': basket_id, 'ordered_items': ordered_items, 'sum': basket_sum, 'delivery': delivery,
+                 'total_sum': basket_sum + delivery if lines else None}]
+
+    def live_offers(self, lines):
+        """
+        Предложения позиций в живой версии каталога: после загрузки прайса магазина
+        предложение ищем по магазину, продукту и внешнему id
+        """
+        offer_ids = {product_info_id: product_info_id for product_info_id in
+                     ProductInfo.objects.live().filter(id__in=lines).values_list('id', flat=True)}
+        stale = {product_info_id: line for product_info_id, line in lines.items() if product_info_id not in offer_ids}
+        if stale:
+            query = Q()
+            for line in stale.values():
+                query |= Q(shop_id=line['shop'], product_id=line['product'], external_id=line['external_id'])
+            replacements = {key: product_info_id for product_info_id, *key in ProductInfo.objects.live().filter(
+                query).values_list('id', 'shop_id', 'product_id', 'external_id')}
+            for product_info_id, line in stale.items():
+                replacement = replacements.get((line['shop'], line['product'], line['external_id']))
+                if replacement:
+                    offer_ids[product_info_id] = replacement
+        return offer_ids
+
+    def checkout(self, basket_id, contact_id):
+        """
+        Записать корзину в базу заказом (Order и OrderItem) в текущей транзакции,
+        после фиксации корзина удаляется из redis. None, если у пользователя нет такой корзины,
+        False, если в корзине нет позиций или ни одно предложение не нашлось в живом каталоге
+        """
+        if basket_id != self.basket_id():
+            return None
+        lines = self.lines()
+        offer_ids = self.live_offers(lines)
+        if not offer_ids:
+            return False
+        order = Order.objects.create(user_id=self.user_id, state='new', contact_id=contact_id)
+        OrderItem.objects.bulk_create(
+            OrderItem(order_id=order.id, product_info_id=offer_ids[product_info_id], quantity=line['quantity'])
+            for product_info_id, line in lines.items() if product_info_id in offer_ids)
+        transaction.on_commit(lambda: self.client.delete(self.key))
+        return order
@@ -0,0 +1,149 @@
+import json
+import re
+from contextlib import nullcontext
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import transaction
+from django.test.client import RequestFactory, encode_multipart, BOUNDARY, MULTIPART_CONTENT
+from django.urls import resolve, Resolver404
+
+from backend.routers import BATCH_KEY
+
+BATCH_PREFIX = '/api/v1/'
+# {{id_операции.путь.к.значению}}, элементы списков по номеру: {{basket.results.0.id}}
+REFERENCE = re.compile(r'{{\s*([\w-]+)((?:\.[\w-]+)*)\s*}}')
+# заголовки запроса, которые переходят в подзапросы
+SHARED_META = ('REMOTE_ADDR', 'SERVER_NAME', 'SERVER_PORT', 'HTTP_HOST', 'HTTP_X_FORWARDED_FOR', 'wsgi.url_scheme')
+
+
+class BatchError(Exception):
+    pass
+
+
+class BatchReferenceError(BatchError):
+    pass
+
+
+def lookup(results, operation_id, path):
+    if operation_id not in results:
+        raise BatchReferenceError(f'Нет операции {operation_id} до этой операции')
+    value = results[operation_id]['body']
+    for part in filter(None, path.split('.')):
+        try:
+            value = value[int(part)] if isinstance(value, list) else value[part]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise BatchReferenceError(f'Нет значения {operation_id}{path}')
+    return value
+
+
+def resolve_references(value, results):
+    """
+    Подставляем ответы предыдущих операций. Строка из одной ссылки получает значение как есть (число, список),
+    ссылки внутри строки подставляются текстом
+    """
+    if isinstance(value, dict):
+        return {key: resolve_references(item, results) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve_references(item, results) for item in value]
+    if not isinstance(value, str):
+        return value
+    match = REFERENCE.fullmatch(value.strip())
+    if match:
+        return lookup(results, *match.groups())
+    return REFERENCE.sub(lambda match: str(lookup(results, *match.groups())), value)
+
+
+def form_value(value):
+    # вложенные структуры передаём json-строкой, как их ждут view (items корзины)
+    return json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else str(value)
+
+
+def build_request(request, method, url, data, headers):
+    """
+    Подзапрос к api: те же адрес клиента и хост, данные формой (multipart) или query string для GET.
+    Без своего Authorization подзапрос выполняется от пользователя batch-запроса без повторной проверки токена
+    """
+    path = urlsplit(url).path
+    if not path.startswith(BATCH_PREFIX) or path.rstrip('/') == BATCH_PREFIX + 'batch':
+        raise BatchError(f'Недопустимый url {url}')
+    meta = {key: request.META[key] for key in SHARED_META if key in request.META}
+    meta.update({'HTTP_' + name.upper().replace('-', '_'): str(value) for name, value in headers.items()})
+    meta.update({'HTTP_ACCEPT': 'application/json', BATCH_KEY: True})
+    factory = RequestFactory()
+    if method in ('GET', 'HEAD'):
+        sub_request = factory.generic(method, url, **meta) if not data else \
+            factory.get(url, {key: form_value(value) for key, value in data.items()}, **meta)
+    else:
+        body = encode_multipart(BOUNDARY, {key: form_value(value) for key, value in data.items()})
+        sub_request = factory.generic(method, url, body, MULTIPART_CONTENT, **meta)
+    if 'HTTP_AUTHORIZATION' not in meta and request.user.is_authenticated:
+        sub_request._force_auth_user = request.user
+        sub_request._force_auth_token = request.auth
+    return sub_request
+
+
+def response_body(response):
+    if response.streaming:
+        raise BatchError('Потоковые ответы (выгрузки) в batch не поддерживаются')
+    if hasattr(response, 'render') and not response.is_rendered:
+        response.render()
+    if response.get('Content-Type', '').startswith('application/json'):
+        return json.loads(response.content or b'null')
+    return response.content.decode(errors='replace')
+
+
+def is_failed(result):
+    # view проекта сообщают об ошибке и статусом 200 с {'Status': False}
+    body = result['body']
+    return result['status'] >= 400 or isinstance(body, dict) and body.get('Status') is False
+
+
+def run_operation(request, operation, results):
+    method = str(operation.get('method', 'GET')).upper()
+    url = resolve_references(operation['url'], results)
+    data = resolve_references(operation.get('data') or {}, results)
+    headers = resolve_references(operation.get('headers') or {}, results)
+    sub_request = build_request(request, method, url, data, headers)
+    try:
+        match = resolve(sub_request.path_info)
+    except Resolver404:
+        return {'status': 404, 'body': {'Status': False, 'Errors': 'Не найдено'}}
+    response = match.func(sub_request, *match.args, **match.kwargs)
+    return {'status': response.status_code, 'body': response_body(response)}
+
+
+def run_batch(request, operations, atomic=False):
+    """
+    Выполнить операции по порядку. Ответ каждой доступен следующим по id операции (по умолчанию - номер).
+    atomic=True - одна транзакция: первая неудачная операция откатывает все и останавливает batch.
+    Без atomic операции независимы, ошибка ссылки на неудачную операцию даёт статус 424
+    """
+    if not isinstance(operations, list) or not operations:
+        raise BatchError('operations - непустой список операций')
+    if len(operations) > settings.BATCH_MAX_OPERATIONS:
+        raise BatchError(f'Не больше {settings.BATCH_MAX_OPERATIONS} операций в batch')
+    for number, operation in enumerate(operations):
+        if not isinstance(operation, dict) or not isinstance(operation.get('url'), str):
+            raise BatchError(f'Операция {number}: нужен url')
+    results = {}
+    report = []
+    rolled_back = False
+    with transaction.atomic() if atomic else nullcontext():
+        for number, operation in enumerate(operations):
+            operation_id = str(operation.get('id', number))
+            try:
+                result = run_operation(request, operation, results)
+            except BatchReferenceError as error:
+                result = {'status': 424, 'body': {'Status': False, 'Errors': str(error)}}
+            except BatchError as error:
+                result = {'status': 400, 'body': {'Status': False, 'Errors': str(error)}}
+            report.append({'id': operation_id, **result})
+            if not is_failed(result):
+                results[operation_id] = result
+            elif atomic:
+                transaction.set_rollback(True)
+                rolled_back = True
+                break
+    return {'Status': not any(is_failed(result) for result in report), 'rolled_back': rolled_back,
+            'operations': report}
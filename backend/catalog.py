@@ -0,0 +1,125 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from backend.celery import app
+from backend.models import ProductInfo, BestOffer, Shop, OrderItem, ArchivedOrderItem
+
+CATALOG_VERSION_KEY = 'catalog_version'
+
+BEST_OFFER_BATCH_SIZE = 1000
+
+
+def refresh_best_offers(product_ids):
+    """
+    Пересчёт лучших предложений для указанных продуктов: минимальная цена среди включенных магазинов,
+    магазин с этой ценой и число предложений. Продукты без предложений из таблицы удаляются
+    """
+    product_ids = sorted(set(product_ids))
+    for start in range(0, len(product_ids), BEST_OFFER_BATCH_SIZE):
+        batch = product_ids[start:start + BEST_OFFER_BATCH_SIZE]
+        best_offers = {}
+        # предложения отсортированы по цене, первое по продукту и есть лучшее
+        for product_id, product_info_id, shop_id, price in ProductInfo.objects.visible().filter(
+                product_id__in=batch).order_by('product_id', 'price', 'id').values_list(
+                'product_id', 'id', 'shop_id', 'price'):
+            best_offer = best_offers.get(product_id)
+            if best_offer:
+                best_offer.offer_count += 1
+            else:
+                best_offers[product_id] = BestOffer(product_id=product_id, product_info_id=product_info_id,
+                                                    shop_id=shop_id, price=price, offer_count=1)
+        with transaction.atomic():
+            BestOffer.objects.filter(product_id__in=batch).delete()
+            BestOffer.objects.bulk_create(best_offers.values())
+
+
+def refresh_shop_best_offers(shop_ids):
+    refresh_best_offers(ProductInfo.objects.filter(shop_id__in=shop_ids).values_list('product_id', flat=True))
+
+
+def catalog_version():
+    """
+    Версия каталога для кэшей и производных структур: меняется, когда меняется видимость предложений
+    """
+    return cache.get_or_set(CATALOG_VERSION_KEY, 1, None)
+
+
+def bump_catalog_version():
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.set(CATALOG_VERSION_KEY, 1, None)
+
+
+def apply_shop_state(shop_ids, state):
+    """
+    Переносим статус магазинов в каталог одной операцией: видимость предложений живой версии,
+    лучшие предложения и версия каталога. Строки магазинов блокируем, чтобы не разойтись
+    с переключением версии (switch_catalog_version). Версию меняем после фиксации транзакции,
+    иначе кэши успеют перестроиться по прежним данным
+    """
+    with transaction.atomic():
+        for shop_id, version in Shop.objects.select_for_update().filter(id__in=shop_ids).order_by('id').values_list(
+                'id', 'catalog_version'):
+            ProductInfo.objects.filter(shop_id=shop_id, version=version).update(is_active=state)
+        refresh_shop_best_offers(shop_ids)
+        transaction.on_commit(bump_catalog_version)
+
+
+def switch_catalog_version(shop_id, old_version, new_version, new_offer_ids):
+    """
+    Переключаем магазин на загруженную версию каталога одним обновлением указателя.
+    Позиции корзин переносим на те же предложения новой версии (new_offer_ids: (product_id, external_id) -> id),
+    позиции с исчезнувшими предложениями удаляем. Позиции оформленных заказов остаются на старой версии.
+    Видимость (is_active) переходит к новой версии в той же транзакции: прежнюю выключаем, новую включаем
+    по статусу магазина, перечитанному под блокировкой строки магазина
+    """
+    with transaction.atomic():
+        state = Shop.objects.select_for_update().filter(id=shop_id).values_list('state', flat=True).get()
+        ProductInfo.objects.filter(shop_id=shop_id, version=old_version, is_active=True).update(is_active=False)
+        ProductInfo.objects.filter(shop_id=shop_id, version=new_version).update(is_active=state)
+        Shop.objects.filter(id=shop_id).update(catalog_version=new_version)
+        moved, removed = [], []
+        for item in OrderItem.objects.filter(
+                order__state='basket', product_info__shop_id=shop_id,
+                product_info__version=old_version).select_related('product_info').only(
+                'id', 'product_info__product_id', 'product_info__external_id'):
+            product_info_id = new_offer_ids.get((item.product_info.product_id, item.product_info.external_id))
+            if product_info_id:
+                item.product_info_id = product_info_id
+                moved.append(item)
+            else:
+                removed.append(item.id)
+        OrderItem.objects.bulk_update(moved, ['product_info'], batch_size=BEST_OFFER_BATCH_SIZE)
+        OrderItem.objects.filter(id__in=removed).delete()
+
+
+def collect_catalog_versions(shop_id, staging=False, batch_size=None):
+    """
+    Удаляем старые версии каталога магазина порциями по CATALOG_GC_BATCH_SIZE, каждая в своей короткой транзакции.
+    Предложения из оформленных и архивных заказов не удаляем: строки порции блокируем, и условие
+    проверяется заново при удалении, поэтому позиция заказа, добавленная после выборки, не уйдёт каскадом.
+    staging=True - остатки незавершённой загрузки (версии новее живой)
+    """
+    batch_size = batch_size or settings.CATALOG_GC_BATCH_SIZE
+    live_version = Shop.objects.filter(id=shop_id).values_list('catalog_version', flat=True).first()
+    if live_version is None:
+        return 0
+    versions = {'version__gt': live_version} if staging else {'version__lt': live_version}
+    stale = ProductInfo.objects.filter(shop_id=shop_id, **versions).filter(
+        ~Exists(OrderItem.objects.filter(product_info_id=OuterRef('pk'))),
+        ~Exists(ArchivedOrderItem.objects.filter(product_info_id=OuterRef('pk')))).order_by('id')
+    removed = 0
+    while True:
+        with transaction.atomic():
+            ids = list(stale.select_for_update(skip_locked=True).values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return removed
+            removed += stale.filter(id__in=ids).delete()[1].get(ProductInfo._meta.label, 0)
+
+
+@app.task(ignore_result=True)
+def collect_catalog_versions_task(shop_id):
+    collect_catalog_versions(shop_id)
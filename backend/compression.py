@@ -0,0 +1,84 @@
+import re
+
+import brotli
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence, compress_string
+
+# br сжимает json лучше gzip, поэтому предпочитаем его, если клиент принимает оба
+ENCODINGS = ('br', 'gzip')
+# xlsx уже сжат, повторно не сжимаем
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/x-yaml')
+
+q_value = re.compile(r'q=([0-9.]+)')
+
+
+def accepted_encoding(header):
+    """
+    Кодировка ответа по Accept-Encoding: первая из ENCODINGS с q > 0
+    """
+    accepted = {}
+    for item in header.split(','):
+        name, _, params = item.partition(';')
+        match = q_value.search(params)
+        try:
+            accepted[name.strip().lower()] = float(match.group(1)) if match else 1.0
+        except ValueError:
+            accepted[name.strip().lower()] = 0.0
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress_brotli_sequence(sequence):
+    compressor = brotli.Compressor(quality=settings.COMPRESSION_BROTLI_QUALITY)
+    for item in sequence:
+        data = compressor.process(item)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+class CompressionMiddleware:
+    """
+    Сжатие ответов brotli или gzip по Accept-Encoding клиента.
+    Ответы меньше COMPRESSION_MIN_SIZE байт отдаём как есть: выигрыш меньше накладных расходов.
+    Потоковые выгрузки сжимаются по мере отдачи
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.has_header('Content-Encoding') or \
+                not response.get('Content-Type', '').startswith(COMPRESSIBLE_TYPES):
+            return response
+        if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = accepted_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            content = response.streaming_content
+            response.streaming_content = compress_brotli_sequence(content) if encoding == 'br' \
+                else compress_sequence(content)
+            del response['Content-Length']
+        else:
+            content = brotli.compress(response.content, quality=settings.COMPRESSION_BROTLI_QUALITY) \
+                if encoding == 'br' else compress_string(response.content)
+            if len(content) >= len(response.content):
+                return response
+            response.content = content
+            response['Content-Length'] = str(len(content))
+
+        # сжатое тело отличается побайтно, сильный ETag становится слабым
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,200 @@
+import csv
+from json import dumps as json_dumps
+from tempfile import TemporaryFile
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import F, Q
+from django.http import StreamingHttpResponse
+from openpyxl import Workbook
+from yaml import dump as dump_yaml
+
+from backend.models import OrderItem, ProductInfo, ProductParameter, Category, format_number
+
+ORDER_HEADER = ('order_id', 'dt', 'state', 'product_info_id', 'external_id', 'model', 'product', 'quantity',
+                'price', 'sum')
+CATALOG_HEADER = ('product_info_id', 'external_id', 'shop', 'category', 'product', 'model', 'price', 'price_rrc',
+                  'quantity')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+YAML_CONTENT_TYPE = 'application/x-yaml'
+
+
+class Echo:
+    """
+    Псевдо-файл для csv.writer: вместо записи возвращает строку,
+    чтобы её сразу отдать в поток ответа
+    """
+
+    def write(self, value):
+        return value
+
+
+def keyset_rows(queryset, after):
+    """
+    Строки запроса порциями по EXPORT_CHUNK_SIZE: следующая порция - отдельный запрос с условием after(последняя
+    строка) по ключу сортировки. В памяти одна порция, между запросами соединение свободно
+    """
+    page = queryset
+    while True:
+        rows = list(page[:settings.EXPORT_CHUNK_SIZE])
+        yield from rows
+        if len(rows) < settings.EXPORT_CHUNK_SIZE:
+            return
+        page = queryset.filter(after(rows[-1]))
+
+
+def export_rows(queryset, after):
+    """
+    Серверным курсором, если он доступен. Через pgbouncer (DISABLE_SERVER_SIDE_CURSORS) iterator() psycopg2
+    получает весь результат в память клиента, поэтому там читаем порциями по ключу (keyset_rows)
+    """
+    if connections[queryset.db].settings_dict.get('DISABLE_SERVER_SIDE_CURSORS'):
+        return keyset_rows(queryset, after)
+    return queryset.iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+
+
+def partner_order_rows(user_id):
+    """
+    Строки заказов поставщика с позициями, порциями и без создания объектов моделей.
+    Ключ сортировки (заказ, предложение) уникален (unique_order_item).
+    Базу выбираем сразу: запросы выполнятся уже после выхода из view
+    """
+    return export_rows(OrderItem.objects.using(router.db_for_read(OrderItem)).filter(
+        product_info__shop__user_id=user_id).exclude(order__state='basket').annotate(
+        line_sum=F('quantity') * F('product_info__price')).order_by('order_id', 'product_info_id').values_list(
+        'order_id', 'order__dt', 'order__state', 'product_info_id', 'product_info__external_id',
+        'product_info__model', 'product_info__product__name', 'quantity', 'product_info__price',
+        'line_sum'), lambda row: Q(order_id__gt=row[0]) | Q(order_id=row[0], product_info_id__gt=row[3]))
+
+
+def catalog_rows(shop_ids):
+    """
+    Строки текущего каталога магазинов
+    """
+    return export_rows(ProductInfo.objects.using(router.db_for_read(ProductInfo)).live().filter(
+        shop_id__in=shop_ids).order_by('id').values_list(
+        'id', 'external_id', 'shop__name', 'product__category__name', 'product__name', 'model', 'price',
+        'price_rrc', 'quantity'), lambda row: Q(id__gt=row[0]))
+
+
+def stream_csv(header, rows):
+    """
+    Отдаём csv построчно, в памяти держим только текущую строку
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_xlsx(header, rows, chunk_size=64 * 1024):
+    """
+    Книга в режиме write_only сбрасывает строки во временный файл,
+    готовый файл отдаём кусками
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(header)
+    for row in rows:
+        # openpyxl не умеет писать даты с часовым поясом
+        sheet.append([value.replace(tzinfo=None) if getattr(value, 'tzinfo', None) else value for value in row])
+
+    with TemporaryFile() as tmp:
+        workbook.save(tmp)
+        tmp.seek(0)
+        while True:
+            chunk = tmp.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def export_response(file_type, filename, header, rows):
+    """
+    Потоковый ответ с выгрузкой в нужном формате
+    """
+    if file_type == 'xlsx':
+        content = stream_xlsx(header, rows)
+    else:
+        content = stream_csv(header, rows)
+    response = StreamingHttpResponse(content, content_type=CONTENT_TYPES[file_type])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{file_type}"'
+    return response
+
+
+def _dump(value):
+    return dump_yaml(value, allow_unicode=True, sort_keys=False, default_flow_style=False)
+
+
+def stream_price_list(shop, using=None):
+    """
+    Каталог магазина в формате прайса поставщика (shop.yaml), который принимает partner/update.
+    Товары читаем порциями, параметры подтягиваем одним запросом на порцию,
+    поэтому число запросов не зависит от числа параметров
+    """
+    yield _dump({'shop': shop.name})
+    categories = [{'id': category_id, 'name': name} for category_id, name in
+                  Category.objects.using(using).filter(shops=shop.id).order_by('id').values_list('id', 'name')]
+    yield _dump({'categories': categories})
+    yield 'goods:\n'
+
+    goods = export_rows(ProductInfo.objects.using(using).live().filter(shop_id=shop.id).order_by('id').values_list(
+        'id', 'external_id', 'product__category_id', 'model', 'product__name', 'price', 'price_rrc',
+        'quantity'), lambda row: Q(id__gt=row[0]))
+    chunk = []
+    for row in goods:
+        chunk.append(row)
+        if len(chunk) == settings.EXPORT_CHUNK_SIZE:
+            yield _dump_goods(chunk, using)
+            chunk = []
+    if chunk:
+        yield _dump_goods(chunk, using)
+
+
+def _scalar(value):
+    # строка в json-кавычках является корректной строкой yaml в двойных кавычках
+    if isinstance(value, str):
+        return json_dumps(value, ensure_ascii=False)
+    text = repr(value)
+    if isinstance(value, float) and '.' not in text:
+        # yaml 1.1 читает 1e-05 как строку, а 1.0e-05 как число
+        text = text.replace('e', '.0e')
+    return text
+
+
+def _dump_goods(chunk, using):
+    parameters = {}
+    for product_info_id, name, value, value_number in ProductParameter.objects.using(using).filter(
+            product_info_id__in=[row[0] for row in chunk]).order_by('id').values_list(
+            'product_info_id', 'parameter__name', 'value', 'value_number'):
+        # числа пишем без кавычек, чтобы при повторном импорте параметр остался числовым
+        if value_number is not None:
+            value = format_number(value_number)
+        parameters.setdefault(product_info_id, []).append(f'    {_scalar(name)}: {_scalar(value)}\n')
+
+    # формат товара фиксирован, поэтому пишем его напрямую, без представления через yaml.dump
+    lines = []
+    for product_info_id, external_id, category_id, model, name, price, price_rrc, quantity in chunk:
+        lines.append(f'- id: {external_id}\n'
+                     f'  category: {category_id}\n'
+                     f'  model: {_scalar(model)}\n'
+                     f'  name: {_scalar(name)}\n'
+                     f'  price: {price}\n'
+                     f'  price_rrc: {price_rrc}\n'
+                     f'  quantity: {quantity}\n')
+        if product_info_id in parameters:
+            lines.append('  parameters:\n')
+            lines.extend(parameters[product_info_id])
+        else:
+            lines.append('  parameters: {}\n')
+    return ''.join(lines)
+
+
+def price_list_response(shop):
+    response = StreamingHttpResponse(stream_price_list(shop, router.db_for_read(ProductInfo)), content_type=YAML_CONTENT_TYPE)
+    response['Content-Disposition'] = f'attachment; filename="shop_{shop.id}.yaml"'
+    return response
@@ -0,0 +1,81 @@
+import numpy as np
+from django.conf import settings
+from django.db import router
+
+from backend.models import ProductInfo
+
+# колонки предложения в порядке столбцов массива
+OFFER_COLUMNS = ('id', 'product_id', 'shop_id', 'price', 'price_rrc', 'quantity', 'is_active')
+ID, PRODUCT, SHOP, PRICE, PRICE_RRC, QUANTITY, IS_ACTIVE = range(len(OFFER_COLUMNS))
+
+HEALTH_HEADER = ('product_info_id', 'product_id', 'shop_id', 'price', 'price_rrc', 'quantity', 'is_active',
+                 'product_offers', 'product_median_price', 'over_rrc', 'zero_stock', 'price_outlier')
+
+
+def offer_chunks(queryset, chunk_size):
+    """
+    Колонки предложений порциями массивов (n, 7), строки отсортированы по продукту и цене.
+    Страницы берём по ключу product_id > последнего продукта, поэтому все предложения продукта
+    попадают в одну порцию: память ограничена размером порции и самым большим продуктом
+    """
+    queryset = queryset.order_by('product_id', 'price', 'id').values_list(*OFFER_COLUMNS)
+    last_product = 0
+    while True:
+        rows = list(queryset.filter(product_id__gt=last_product)[:chunk_size])
+        if not rows:
+            return
+        last_page = len(rows) < chunk_size
+        if not last_page:
+            tail_product = rows[-1][PRODUCT]
+            if rows[0][PRODUCT] == tail_product:
+                # продукт больше порции - дочитываем его целиком
+                rows += list(queryset.filter(product_id=tail_product)[chunk_size:])
+            else:
+                # последний продукт мог не поместиться, он начнёт следующую порцию
+                while rows[-1][PRODUCT] == tail_product:
+                    rows.pop()
+        last_product = rows[-1][PRODUCT]
+        yield np.array(rows, dtype=np.int64)
+        if last_page:
+            return
+
+
+def offer_health(offers, outlier_ratio, min_offers):
+    """
+    Проверки по массиву предложений, отсортированному по продукту и цене:
+    цена выше рекомендованной, нулевой остаток у выставленного предложения, цена отличается
+    от медианы продукта по магазинам больше чем на outlier_ratio (у продуктов от min_offers предложений).
+    Возвращаем маску найденных строк и столбцы отчёта
+    """
+    product, price = offers[:, PRODUCT], offers[:, PRICE]
+    # начала групп продуктов, медиана группы - середина отсортированных цен
+    starts = np.flatnonzero(np.diff(product, prepend=product[0] - 1))
+    counts = np.diff(np.append(starts, len(product)))
+    medians = (price[starts + (counts - 1) // 2] + price[starts + counts // 2]) / 2
+    product_offers = np.repeat(counts, counts)
+    product_median = np.repeat(medians, counts)
+
+    over_rrc = price > offers[:, PRICE_RRC]
+    zero_stock = (offers[:, QUANTITY] == 0) & (offers[:, IS_ACTIVE] == 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        deviation = np.abs(price - product_median) / product_median
+    price_outlier = (product_offers >= min_offers) & (deviation > outlier_ratio)
+    return over_rrc | zero_stock | price_outlier, (product_offers, product_median, over_rrc, zero_stock,
+                                                    price_outlier)
+
+
+def offer_health_rows(shop_ids=None, chunk_size=None):
+    """
+    Строки отчёта о проблемных предложениях живых версий каталогов.
+    С shop_ids в отчёт попадают только предложения этих магазинов, но медиану продукта
+    считаем по всем магазинам, которые его продают
+    """
+    queryset = ProductInfo.objects.using(router.db_for_read(ProductInfo)).live()
+    if shop_ids is not None:
+        queryset = queryset.filter(product_id__in=ProductInfo.objects.live().filter(
+            shop_id__in=shop_ids).values('product_id'))
+    for offers in offer_chunks(queryset, chunk_size or settings.HEALTH_CHUNK_SIZE):
+        flagged, columns = offer_health(offers, settings.HEALTH_OUTLIER_RATIO, settings.HEALTH_MIN_OFFERS)
+        if shop_ids is not None:
+            flagged &= np.isin(offers[:, SHOP], shop_ids)
+        yield from zip(*offers[flagged].T.tolist(), *(column[flagged].tolist() for column in columns))
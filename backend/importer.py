@@ -0,0 +1,373 @@
+import logging
+import time
+from threading import Lock
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Count, Avg, Max, Q
+from django.utils import timezone
+from requests import get
+from yaml import load as load_yaml, Loader
+
+from backend import reference
+from backend.catalog import refresh_best_offers, bump_catalog_version, switch_catalog_version, \
+    collect_catalog_versions, collect_catalog_versions_task
+from backend.celery import app
+from backend.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, PriceChange, \
+    ImportJob, parameter_type
+from backend.outbox import enqueue
+
+logger = logging.getLogger(__name__)
+
+PRICE_CHANGE_BATCH_SIZE = 1000
+
+
+def _string(max_length, numbers=False):
+    types = (str, int, float) if numbers else str
+
+    def check(value):
+        if not isinstance(value, types) or isinstance(value, bool):
+            return 'ожидается строка'
+        if len(str(value)) > max_length:
+            return f'длиннее {max_length} символов'
+    return check
+
+
+def _positive_int(value):
+    # bool тоже int, его не пропускаем
+    if type(value) is not int or value < 0:
+        return 'ожидается целое число не меньше 0'
+
+
+def _parameters(value):
+    if not isinstance(value, dict):
+        return 'ожидается словарь параметров'
+    for name, parameter_value in value.items():
+        if not isinstance(name, str) or len(name) > 40:
+            return f'недопустимое имя параметра {name!r}'
+        if isinstance(parameter_value, str):
+            if len(parameter_value) > 100:
+                return f'значение параметра {name!r} длиннее 100 символов'
+        elif not isinstance(parameter_value, (int, float)) or isinstance(parameter_value, bool):
+            return f'недопустимое значение параметра {name!r}'
+
+
+# схема товара прайса (формат shop.yaml): поле -> проверка, возвращающая текст ошибки или None.
+# Ограничения соответствуют полям моделей, в которые товар будет записан
+GOODS_SCHEMA = (
+    ('id', _positive_int),
+    ('category', _positive_int),
+    ('model', _string(80, numbers=True)),
+    ('name', _string(80)),
+    ('price', _positive_int),
+    ('price_rrc', _positive_int),
+    ('quantity', _positive_int),
+    ('parameters', _parameters),
+)
+CATEGORY_SCHEMA = (
+    ('id', _positive_int),
+    ('name', _string(40)),
+)
+
+
+def _check_rows(rows, section, schema, errors):
+    """
+    Один проход по списку: все ошибки с индексом строки, проверки схемы уже собраны в кортеж
+    """
+    if not isinstance(rows, list):
+        errors.append({'path': section, 'error': 'ожидается список'})
+        return
+    append = errors.append
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            append({'path': f'{section}[{index}]', 'error': 'ожидается словарь'})
+            continue
+        for field, check in schema:
+            if field not in row:
+                append({'path': f'{section}[{index}].{field}', 'error': 'поле отсутствует'})
+                continue
+            error = check(row[field])
+            if error:
+                append({'path': f'{section}[{index}].{field}', 'error': error})
+
+
+def validate_price_list(data):
+    """
+    Проверка прайса до записи в базу. Возвращает список всех ошибок {'path': 'goods[12].price', 'error': ...},
+    пустой список - прайс можно загружать
+    """
+    start = time.monotonic()
+    errors = []
+    if not isinstance(data, dict):
+        return [{'path': '', 'error': 'ожидается словарь с ключами shop, categories, goods'}]
+    if 'shop' not in data:
+        errors.append({'path': 'shop', 'error': 'поле отсутствует'})
+    else:
+        error = _string(50)(data['shop'])
+        if error:
+            errors.append({'path': 'shop', 'error': error})
+
+    # обязательные разделы: import_price_list читает оба
+    for section, schema in (('categories', CATEGORY_SCHEMA), ('goods', GOODS_SCHEMA)):
+        if section not in data:
+            errors.append({'path': section, 'error': 'поле отсутствует'})
+        else:
+            _check_rows(data[section], section, schema, errors)
+    categories = data.get('categories')
+    goods = data.get('goods')
+
+    if isinstance(categories, list) and isinstance(goods, list):
+        category_ids = {category.get('id') for category in categories if isinstance(category, dict)}
+        offers_seen = set()
+        for index, item in enumerate(goods):
+            if not isinstance(item, dict):
+                continue
+            if 'category' in item and item['category'] not in category_ids:
+                errors.append({'path': f'goods[{index}].category', 'error': 'категории нет в разделе categories'})
+            # один товар магазина с одним внешним id (ограничение unique_product_info)
+            key = (item.get('id'), item.get('category'), item.get('name'))
+            if key in offers_seen:
+                errors.append({'path': f'goods[{index}].id', 'error': 'товар с этим id уже есть в прайсе'})
+            offers_seen.add(key)
+
+    elapsed = time.monotonic() - start
+    goods_count = len(goods) if isinstance(goods, list) else 0
+    logger.info('Price list validated: %s goods, %s errors in %.3fs (%.0f goods/s)',
+                goods_count, len(errors), elapsed, goods_count / elapsed if elapsed else goods_count)
+    return errors
+
+
+class ShopImportLocked(Exception):
+    """Загрузка прайса этого магазина уже выполняется"""
+
+
+def price_changes(shop_id, old_offers, new_offers):
+    """
+    Разница между прежним и новым каталогом магазина.
+    Ключ предложения (product_id, external_id), значение (price, price_rrc, quantity)
+    """
+    for key, values in new_offers.items():
+        old_values = old_offers.get(key)
+        if old_values != values:
+            yield PriceChange(shop_id=shop_id, product_id=key[0], external_id=key[1],
+                              change='created' if old_values is None else 'updated',
+                              price=values[0], price_rrc=values[1], quantity=values[2])
+    for key in old_offers.keys() - new_offers.keys():
+        yield PriceChange(shop_id=shop_id, product_id=key[0], external_id=key[1], change='deleted')
+
+
+def offers(shop_id, version):
+    return {(product_id, external_id): tuple(values) for product_id, external_id, *values in
+            ProductInfo.objects.filter(shop_id=shop_id, version=version).values_list(
+                'product_id', 'external_id', 'price', 'price_rrc', 'quantity').iterator()}
+
+
+def import_price_list(data, user_id, url):
+    """
+    Загрузка прайса поставщика (формат shop.yaml) в базу.
+    Предложения пишем в новую версию каталога магазина, покупатели до переключения видят прежнюю целиком
+    """
+    shop, _ = Shop.objects.get_or_create(name=data['shop'], user_id=user_id, url=url)
+    live_version = shop.catalog_version
+    version = live_version + 1
+    collect_catalog_versions(shop.id, staging=True)
+    known_categories = reference.categories.get_many([category['id'] for category in data['categories']])
+    # общие категории вставляем без конфликтов (ON CONFLICT DO NOTHING) в порядке id,
+    # параллельные загрузки разных магазинов не падают и не блокируют друг друга
+    Category.objects.bulk_create(
+        sorted((Category(id=category['id'], name=category['name']) for category in data['categories']
+                if category['id'] not in known_categories), key=lambda category: category.id),
+        ignore_conflicts=True)
+    # связи категорий с магазином одним запросом, существующие пропускаем
+    Category.shops.through.objects.bulk_create(
+        [Category.shops.through(category_id=category['id'], shop_id=shop.id) for category in data['categories']],
+        ignore_conflicts=True)
+    old_offers = offers(shop.id, live_version)
+    new_offers = {}
+    new_offer_ids = {}
+    # параметры этой загрузки; справочник в памяти пополнится только после фиксации транзакции
+    parameter_objects = {}
+    for item in data['goods']:
+        product, _ = Product.objects.get_or_create(name=item['name'], category_id=item['category'])
+
+        product_info = ProductInfo.objects.create(product_id=product.id,
+                                                  external_id=item['id'],
+                                                  model=item['model'],
+                                                  price=item['price'],
+                                                  quantity=item['quantity'],
+                                                  price_rrc=item['price_rrc'],
+                                                  shop_id=shop.id,
+                                                  is_active=False,  # видимой версию сделает switch_catalog_version
+                                                  version=version)
+        new_offers[(product.id, product_info.external_id)] = (product_info.price, product_info.price_rrc,
+                                                              product_info.quantity)
+        new_offer_ids[(product.id, product_info.external_id)] = product_info.id
+        for name, value in item['parameters'].items():
+            if name not in parameter_objects:
+                parameter_id, row = reference.parameters.get_or_create(name, defaults={'type': parameter_type(value)})
+                parameter_objects[name] = Parameter(id=parameter_id, **row)
+            value, value_number = ProductParameter.split_value(parameter_objects[name], value)
+            ProductParameter.objects.create(product_info_id=product_info.id,
+                                            parameter_id=parameter_objects[name].id,
+                                            value=value,
+                                            value_number=value_number)
+
+    with transaction.atomic():
+        switch_catalog_version(shop.id, live_version, version, new_offer_ids)
+        PriceChange.objects.bulk_create(price_changes(shop.id, old_offers, new_offers),
+                                        batch_size=PRICE_CHANGE_BATCH_SIZE)
+        # прежнюю версию удалит фоновая задача
+        enqueue(collect_catalog_versions_task, shop_id=shop.id)
+    shop.catalog_version = version
+    refresh_best_offers(product_id for product_id, _ in old_offers.keys() | new_offers.keys())
+    bump_catalog_version()
+    return shop
+
+
+# первый ключ пары в pg_try_advisory_lock(key, shop_id): блокировки загрузки прайсов
+IMPORT_LOCK_KEY = 1001
+# магазины, которые загружает этот процесс: {shop_id: job_id}.
+# advisory-блокировка в своей сессии берётся повторно, занятость внутри процесса проверяем сами
+_held_locks = {}
+_held_locks_guard = Lock()
+
+
+def _advisory_lock(function, shop_id):
+    connection = connections[settings.IMPORT_LOCK_DATABASE]
+    if connection.vendor != 'postgresql':
+        # sqlite - только локальная разработка в одном процессе
+        return True
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT {function}(%s, %s)', [IMPORT_LOCK_KEY, shop_id])
+        return cursor.fetchone()[0]
+
+
+def acquire_shop_lock(shop_id, job_id):
+    """
+    Магазин загружает только одно задание. Сессионная advisory-блокировка postgres видна всем процессам
+    и воркерам, держится до release_shop_lock без срока действия, а при падении воркера снимается
+    вместе с его соединением
+    """
+    with _held_locks_guard:
+        if shop_id in _held_locks or not _advisory_lock('pg_try_advisory_lock', shop_id):
+            return False
+        _held_locks[shop_id] = job_id
+        return True
+
+
+def release_shop_lock(shop_id, job_id):
+    with _held_locks_guard:
+        if _held_locks.get(shop_id) == job_id:
+            _advisory_lock('pg_advisory_unlock', shop_id)
+            del _held_locks[shop_id]
+
+
+def create_import_job(user_id, url):
+    # магазин известен заранее, если этот фид уже загружался
+    return ImportJob.objects.create(user_id=user_id, url=url,
+                                    shop=Shop.objects.filter(user_id=user_id, url=url).first())
+
+
+def schedule_import(user_id, url):
+    """
+    Ставим загрузку прайса в очередь imports
+    """
+    with transaction.atomic():
+        job = create_import_job(user_id, url)
+        enqueue(import_price_list_task, job_id=job.id)
+    return job
+
+
+def import_now(user_id, url):
+    """
+    Загрузка прайса в текущем процессе (PRICE_IMPORT_ASYNC=false) с той же блокировкой магазина
+    """
+    job = create_import_job(user_id, url)
+    try:
+        return run_import_job(job.id)
+    except ShopImportLocked:
+        job.state, job.error, job.finished_at = 'failed', 'Загрузка прайса магазина уже выполняется', timezone.now()
+        job.save(update_fields=['state', 'error', 'finished_at'])
+        return job
+
+
+def run_import_job(job_id):
+    """
+    Выполнить задание загрузки. Если в очереди есть более свежий фид того же магазина,
+    задание пропускаем. Если магазин уже загружается, бросаем ShopImportLocked.
+    Задание в статусе running celery доставляет повторно (acks_late), когда воркер упал посреди загрузки:
+    если блокировка магазина свободна, загрузку никто не ведёт, и задание выполняется заново
+    """
+    job = ImportJob.objects.get(id=job_id)
+    if job.state not in ('queued', 'running'):
+        return job
+    if job.state == 'running':
+        # блокировка занята - прежний воркер ещё загружает, повторим позже
+        if not acquire_shop_lock(job.shop_id, job.id):
+            raise ShopImportLocked(job.shop_id)
+        release_shop_lock(job.shop_id, job.id)
+        logger.warning('Import job %s was interrupted, restarting', job.id)
+    if ImportJob.objects.filter(user_id=job.user_id, url=job.url, state='queued', id__gt=job.id).exists():
+        job.state, job.finished_at = 'skipped', timezone.now()
+        job.save(update_fields=['state', 'finished_at'])
+        return job
+
+    try:
+        data = load_yaml(get(job.url).content, Loader=Loader)
+    except Exception as error:
+        job.state, job.error, job.finished_at = 'failed', str(error), timezone.now()
+        job.save(update_fields=['state', 'error', 'finished_at'])
+        return job
+    # некорректный прайс отклоняем целиком, прежний каталог магазина не трогаем
+    errors = validate_price_list(data)
+    if errors:
+        job.state, job.error, job.errors, job.finished_at = 'failed', 'Прайс не прошёл проверку', errors, \
+            timezone.now()
+        job.save(update_fields=['state', 'error', 'errors', 'finished_at'])
+        return job
+    shop, _ = Shop.objects.get_or_create(name=data['shop'], user_id=job.user_id, url=job.url)
+
+    job.shop = shop
+    if not acquire_shop_lock(shop.id, job.id):
+        job.save(update_fields=['shop'])
+        raise ShopImportLocked(shop.id)
+
+    job.state, job.started_at = 'running', timezone.now()
+    job.save(update_fields=['shop', 'state', 'started_at'])
+    start = time.monotonic()
+    try:
+        import_price_list(data, job.user_id, job.url)
+        job.state = 'done'
+    except Exception as error:
+        logger.exception('Import job %s failed', job.id)
+        job.state, job.error = 'failed', str(error)
+    finally:
+        job.duration = time.monotonic() - start
+        job.finished_at = timezone.now()
+        job.save(update_fields=['state', 'error', 'duration', 'finished_at'])
+        release_shop_lock(shop.id, job.id)
+    logger.info('Import job %s shop %s %s in %.2fs', job.id, shop.id, job.state, job.duration)
+    return job
+
+
+@app.task(bind=True, acks_late=True, max_retries=None, ignore_result=True)
+def import_price_list_task(self, job_id):
+    # магазины загружаются параллельно на воркерах очереди imports, один магазин ждёт своей очереди
+    try:
+        run_import_job(job_id)
+    except ShopImportLocked as error:
+        raise self.retry(exc=error, countdown=settings.IMPORT_RETRY_SECONDS)
+
+
+def import_metrics():
+    """
+    По магазинам: глубина очереди, выполняемые и неудачные задания, длительность загрузки
+    """
+    return ImportJob.objects.values('shop_id', 'shop__name').annotate(
+        queued=Count('id', filter=Q(state='queued')),
+        running=Count('id', filter=Q(state='running')),
+        failed=Count('id', filter=Q(state='failed')),
+        avg_duration=Avg('duration', filter=Q(state='done')),
+        max_duration=Max('duration', filter=Q(state='done')),
+        last_finished_at=Max('finished_at'),
+    ).order_by('shop_id')
@@ -1,11 +1,13 @@
-from django.core.mail import send_mail
+from celery import group
+from django.conf import settings
+from django.core.mail import send_mail, get_connection, EmailMessage
 from django_rest_passwordreset.models import ResetPasswordToken
 
 from backend.celery import app
 from backend.models import ConfirmEmailToken, User, Order
 
 
-@app.task
+@app.task(rate_limit=settings.MAIL_TRANSACTIONAL_RATE_LIMIT)
 def new_user_registered(user_email, user_id):
     # отправяем письмо при регистрации пользователя
     token, _ = ConfirmEmailToken.objects.get_or_create(user_id=user_id)
@@ -18,7 +20,7 @@ def new_user_registered(user_email, user_id):
     )
 
 
-@app.task
+@app.task(rate_limit=settings.MAIL_TRANSACTIONAL_RATE_LIMIT)
 def password_reset_token_created(reset_password_token, user_email):
     # отправяем письмо для восстановления пароля
     send_mail(
@@ -29,11 +31,12 @@ def password_reset_token_created(reset_password_token, user_email):
         fail_silently=False,
     )
 
-@app.task
-def new_order(user_id):
+
+@app.task(rate_limit=settings.MAIL_TRANSACTIONAL_RATE_LIMIT)
+def new_order(user_id, order_id):
     # отправяем письмо при изменении статуса заказа
     user = User.objects.get(id=user_id)
-    order = Order.objects.get(user_id=user_id)
+    order = Order.objects.get(id=order_id, user_id=user_id)
 
     send_mail(
         f"Update order status",
@@ -42,3 +45,21 @@ def new_order(user_id):
         [user.email],
         fail_silently=False,
     )
+
+
+@app.task(rate_limit=settings.MAIL_BULK_RATE_LIMIT)
+def send_mail_chunk(subject, message, user_emails):
+    # массовая рассылка: одно smtp соединение на порцию получателей
+    messages = [EmailMessage(subject, message, 'testflask@mail.ru', [email]) for email in user_emails]
+    with get_connection() as connection:
+        connection.send_messages(messages)
+
+
+def send_bulk_mail(subject, message, user_ids):
+    """
+    Массовая рассылка группой задач по MAIL_BULK_CHUNK_SIZE получателей в очереди mail_bulk
+    """
+    emails = list(User.objects.filter(id__in=user_ids).values_list('email', flat=True))
+    chunk_size = settings.MAIL_BULK_CHUNK_SIZE
+    return group(send_mail_chunk.s(subject, message, emails[start:start + chunk_size])
+                 for start in range(0, len(emails), chunk_size)).apply_async()
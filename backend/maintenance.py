@@ -0,0 +1,119 @@
+import logging
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django_rest_passwordreset.models import ResetPasswordToken
+
+from backend.celery import app
+from backend.models import Order, OrderItem, ConfirmEmailToken, OutboxEvent, ArchivedOrder, ArchivedOrderItem
+
+logger = logging.getLogger(__name__)
+
+
+def expired_querysets(now=None):
+    """
+    Что удаляем и по какому сроку хранения: брошенные корзины (по последнему изменению, вместе с позициями),
+    неиспользованные токены подтверждения и сброса пароля, опубликованные события outbox
+    """
+    now = now or timezone.now()
+    return (
+        Order.objects.filter(state='basket',
+                             updated_at__lt=now - timedelta(days=settings.BASKET_RETENTION_DAYS)),
+        ConfirmEmailToken.objects.filter(
+            created_at__lt=now - timedelta(days=settings.CONFIRM_TOKEN_RETENTION_DAYS)),
+        ResetPasswordToken.objects.filter(
+            created_at__lt=now - timedelta(hours=settings.RESET_TOKEN_RETENTION_HOURS)),
+        OutboxEvent.objects.filter(
+            published_at__lt=now - timedelta(days=settings.OUTBOX_RETENTION_DAYS)),
+    )
+
+
+def delete_in_batches(queryset, batch_size, max_batches):
+    """
+    Удаляем порциями по batch_size строк, каждая порция в своей короткой транзакции.
+    Строки порции блокируем (занятые другими транзакциями пропускаем), а при удалении повторяем условие queryset:
+    корзину, оформленную между выборкой и удалением, не трогаем.
+    Возвращаем число удалённых строк по моделям, включая каскадные
+    """
+    removed = Counter()
+    for _ in range(max_batches):
+        with transaction.atomic():
+            ids = list(queryset.select_for_update(skip_locked=True).order_by('pk').values_list(
+                'pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            removed.update(queryset.filter(pk__in=ids).delete()[1])
+        if len(ids) < batch_size:
+            break
+    return removed
+
+
+def sweep_expired(batch_size=None, max_batches=None):
+    """
+    Одна уборка устаревших строк. За запуск по каждой таблице удаляется не больше max_batches порций,
+    остаток дочистит следующий запуск
+    """
+    batch_size = batch_size or settings.SWEEP_BATCH_SIZE
+    max_batches = max_batches or settings.SWEEP_MAX_BATCHES
+    start = time.monotonic()
+    removed = Counter()
+    for queryset in expired_querysets():
+        removed.update(delete_in_batches(queryset, batch_size, max_batches))
+    report = {'removed': dict(removed), 'seconds': round(time.monotonic() - start, 3)}
+    logger.info('Expired rows swept: %s', report)
+    return report
+
+
+@app.task(ignore_result=True)
+def sweep_expired_task():
+    # запускается celery beat (CELERY_BEAT_SCHEDULE)
+    sweep_expired()
+
+
+ARCHIVED_STATES = ('delivered', 'canceled')
+
+
+def archive_cutoff(now=None):
+    # заказы раньше этой даты могут быть в архиве
+    return (now or timezone.now()) - timedelta(days=settings.ORDER_ARCHIVE_AFTER_DAYS)
+
+
+def archive_orders(batch_size=None, max_batches=None):
+    """
+    Переносим доставленные и отменённые заказы старше ORDER_ARCHIVE_AFTER_DAYS с позициями в архивные таблицы.
+    Каждая порция - своя транзакция: копируем строки и удаляем их из рабочих таблиц.
+    Заказы, заблокированные другими транзакциями, пропускаем до следующего запуска
+    """
+    batch_size = batch_size or settings.ORDER_ARCHIVE_BATCH_SIZE
+    max_batches = max_batches or settings.SWEEP_MAX_BATCHES
+    start = time.monotonic()
+    cutoff = archive_cutoff()
+    archived = 0
+    for _ in range(max_batches):
+        with transaction.atomic():
+            orders = list(Order.objects.select_for_update(skip_locked=True).filter(
+                state__in=ARCHIVED_STATES, dt__lt=cutoff).order_by('id').values(
+                'id', 'user_id', 'dt', 'state', 'contact_id')[:batch_size])
+            if not orders:
+                break
+            order_ids = [order['id'] for order in orders]
+            ArchivedOrder.objects.bulk_create(ArchivedOrder(**order) for order in orders)
+            ArchivedOrderItem.objects.bulk_create(
+                ArchivedOrderItem(**item) for item in OrderItem.objects.filter(order_id__in=order_ids).values(
+                    'id', 'order_id', 'product_info_id', 'quantity'))
+            Order.objects.filter(id__in=order_ids).delete()
+        archived += len(orders)
+        if len(orders) < batch_size:
+            break
+    report = {'archived': archived, 'seconds': round(time.monotonic() - start, 3)}
+    logger.info('Orders archived: %s', report)
+    return report
+
+
+@app.task(ignore_result=True)
+def archive_orders_task():
+    archive_orders()
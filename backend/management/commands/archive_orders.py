@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from backend.maintenance import archive_orders
+
+
+class Command(BaseCommand):
+    help = 'Перенос доставленных и отменённых заказов старше ORDER_ARCHIVE_AFTER_DAYS в архив'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--max-batches', type=int, default=None)
+
+    def handle(self, *args, **options):
+        report = archive_orders(options['batch_size'], options['max_batches'])
+        self.stdout.write(f'Перенесено заказов: {report["archived"]}, время: {report["seconds"]} с')
@@ -0,0 +1,30 @@
+import csv
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+
+from backend.health import offer_health_rows, HEALTH_HEADER
+
+
+class Command(BaseCommand):
+    help = 'Отчёт csv о предложениях с ценой выше рекомендованной, нулевым остатком и выбросами цены'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None, help='файл отчёта, по умолчанию stdout')
+        parser.add_argument('--shop-id', type=int, action='append', dest='shop_ids', default=None)
+        parser.add_argument('--chunk-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        found = Counter()
+        output = open(options['output'], 'w', newline='') if options['output'] else self.stdout
+        try:
+            writer = csv.writer(output)
+            writer.writerow(HEALTH_HEADER)
+            for row in offer_health_rows(options['shop_ids'], options['chunk_size']):
+                writer.writerow(row)
+                found.update(name for name, flag in zip(HEALTH_HEADER[-3:], row[-3:]) if flag)
+        finally:
+            if options['output']:
+                output.close()
+        if options['output']:
+            self.stdout.write(f'Найдено: {dict(found)}, отчёт: {options["output"]}')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from backend.catalog import refresh_best_offers
+from backend.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Полный пересчёт лучших предложений по всем продуктам'
+
+    def handle(self, *args, **options):
+        product_ids = list(Product.objects.values_list('id', flat=True))
+        refresh_best_offers(product_ids)
+        self.stdout.write(f'Пересчитано продуктов: {len(product_ids)}')
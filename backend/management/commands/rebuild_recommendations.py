@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from backend.recommendations import rebuild_recommendations
+
+
+class Command(BaseCommand):
+    help = 'Полный пересчёт рекомендаций "покупают вместе" по оформленным заказам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        report = rebuild_recommendations(options['chunk_size'])
+        self.stdout.write(f'Пар продуктов: {report["pairs"]}, рекомендаций: {report["recommendations"]}, '
+                          f'время: {report["seconds"]} с')
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from backend.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Полный пересчёт сводок продаж магазинов по всем заказам, включая архив'
+
+    def handle(self, *args, **options):
+        sales, products = rebuild_rollups()
+        self.stdout.write(f'Строк по статусам: {sales}, по продуктам: {products}')
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from backend.maintenance import sweep_expired
+
+
+class Command(BaseCommand):
+    help = 'Удаление брошенных корзин, устаревших токенов и опубликованных событий outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--max-batches', type=int, default=None)
+
+    def handle(self, *args, **options):
+        report = sweep_expired(options['batch_size'], options['max_batches'])
+        for model, count in sorted(report['removed'].items()):
+            self.stdout.write(f'{model}: {count}')
+        self.stdout.write(f'Время: {report["seconds"]} с')
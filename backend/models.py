@@ -2,6 +2,7 @@ from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.validators import UnicodeUsernameValidator
 from django.db import models
+from django.db.models.functions import Upper
 from django.utils.translation import gettext_lazy as _
 from django_rest_passwordreset.tokens import get_token_generator
 
@@ -21,6 +22,39 @@ USER_TYPE_CHOICES = (
 
 )
 
+PRICE_CHANGE_CHOICES = (
+    ('created', 'Добавлен'),
+    ('updated', 'Изменен'),
+    ('deleted', 'Удален'),
+)
+
+IMPORT_STATE_CHOICES = (
+    ('queued', 'В очереди'),
+    ('running', 'Выполняется'),
+    ('done', 'Загружен'),
+    ('failed', 'Ошибка'),
+    ('skipped', 'Заменен более новым'),
+)
+
+PARAMETER_TYPE_CHOICES = (
+    ('string', 'Строка'),
+    ('number', 'Число'),
+)
+
+
+def parameter_type(value):
+    """
+    Тип параметра по значению из прайса
+    """
+    return 'number' if isinstance(value, (int, float)) and not isinstance(value, bool) else 'string'
+
+
+def format_number(number):
+    """
+    Числовое значение параметра в том виде, в каком оно было в прайсе: 512, 6.5
+    """
+    return int(number) if number.is_integer() else number
+
 
 # Create your models here.
 
@@ -98,6 +132,10 @@ class User(AbstractUser):
         verbose_name = 'Пользователь'
         verbose_name_plural = "Список пользователей"
         ordering = ('email',)
+        indexes = [
+            # поиск без учета регистра (iexact) в админке
+            models.Index(Upper('email'), name='user_email_upper_idx'),
+        ]
 
 
 class Shop(models.Model):
@@ -107,6 +145,8 @@ class Shop(models.Model):
                                 blank=True, null=True,
                                 on_delete=models.CASCADE)
     state = models.BooleanField(verbose_name='статус получения заказов', default=True)
+    # живая версия каталога магазина: загрузка пишет новую версию рядом и переключает указатель
+    catalog_version = models.PositiveIntegerField(verbose_name='Версия каталога', default=0)
 
     # filename
 
@@ -141,11 +181,25 @@ class Product(models.Model):
         verbose_name = 'Продукт'
         verbose_name_plural = "Список продуктов"
         ordering = ('-name',)
+        constraints = [
+            # параллельные загрузки разных магазинов не создадут дубли продукта
+            models.UniqueConstraint(fields=['name', 'category'], name='unique_product'),
+        ]
 
     def __str__(self):
         return self.name
 
 
+class ProductInfoQuerySet(models.QuerySet):
+    def live(self):
+        """Предложения живой версии каталога своего магазина"""
+        return self.filter(version=models.F('shop__catalog_version'))
+
+    def visible(self):
+        """Предложения, которые видят покупатели: живая версия включенного магазина, без соединения с магазинами"""
+        return self.filter(is_active=True)
+
+
 class ProductInfo(models.Model):
     external_id = models.PositiveIntegerField(verbose_name='Внешний ИД')
     product = models.ForeignKey(Product, verbose_name='Продукт', related_name='product_infos', blank=True,
@@ -156,17 +210,34 @@ class ProductInfo(models.Model):
     quantity = models.PositiveIntegerField(verbose_name='Количество')
     price = models.PositiveIntegerField(verbose_name='Цена')
     price_rrc = models.PositiveIntegerField(verbose_name='Рекомендованная цена')
+    # видимость покупателям: живая версия каталога и Shop.state, чтобы выдача каталога не соединялась с магазинами.
+    # Загружаемая версия пишется выключенной, её включает switch_catalog_version вместе с выключением прежней
+    is_active = models.BooleanField(verbose_name='Виден покупателям', default=True)
+    # версия каталога магазина (Shop.catalog_version), в которую загружено предложение
+    version = models.PositiveIntegerField(verbose_name='Версия каталога', default=0)
+
+    objects = ProductInfoQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Информация о продукте'
         verbose_name_plural = "Информационный список о продуктах"
         constraints = [
-            models.UniqueConstraint(fields=['product', 'shop', 'external_id'], name='unique_product_info'),
+            models.UniqueConstraint(fields=['product', 'shop', 'external_id', 'version'],
+                                    name='unique_product_info'),
+        ]
+        indexes = [
+            models.Index(Upper('model'), name='product_info_model_upper_idx'),
+            models.Index(fields=['shop', 'version'], name='product_info_shop_version_idx'),
         ]
 
+    def __str__(self):
+        return f'{self.model} ({self.external_id})'
+
 
 class Parameter(models.Model):
-    name = models.CharField(max_length=40, verbose_name='Название')
+    name = models.CharField(max_length=40, verbose_name='Название', unique=True)
+    type = models.CharField(verbose_name='Тип значения', choices=PARAMETER_TYPE_CHOICES, max_length=6,
+                            default='string')
 
     class Meta:
         verbose_name = 'Имя параметра'
@@ -183,7 +254,9 @@ class ProductParameter(models.Model):
                                      on_delete=models.CASCADE)
     parameter = models.ForeignKey(Parameter, verbose_name='Параметр', related_name='product_parameters', blank=True,
                                   on_delete=models.CASCADE)
-    value = models.CharField(verbose_name='Значение', max_length=100)
+    # строковое значение, для числовых параметров пустое
+    value = models.CharField(verbose_name='Значение', max_length=100, blank=True)
+    value_number = models.FloatField(verbose_name='Числовое значение', null=True, blank=True)
 
     class Meta:
         verbose_name = 'Параметр'
@@ -191,6 +264,113 @@ class ProductParameter(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['product_info', 'parameter'], name='unique_product_parameter'),
         ]
+        indexes = [
+            # фильтр по диапазону значений числового параметра
+            models.Index(fields=['parameter', 'value_number'], name='product_parameter_number_idx'),
+        ]
+
+    @staticmethod
+    def split_value(parameter, value):
+        """
+        Раскладываем значение из прайса по колонкам: (value, value_number).
+        Строка у числового параметра остаётся строкой
+        """
+        if parameter.type == 'number' and parameter_type(value) == 'number':
+            return '', float(value)
+        return str(value), None
+
+    def get_value(self):
+        return self.value if self.value_number is None else format_number(self.value_number)
+
+
+class BestOffer(models.Model):
+    """
+    Лучшее предложение по продукту среди включенных магазинов.
+    Пересчитывается при загрузке прайса и переключении статуса магазина (backend.catalog)
+    """
+    product = models.OneToOneField(Product, verbose_name='Продукт', related_name='best_offer', primary_key=True,
+                                   on_delete=models.CASCADE)
+    product_info = models.ForeignKey(ProductInfo, verbose_name='Информация о продукте', related_name='+',
+                                     on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='+', on_delete=models.CASCADE)
+    price = models.PositiveIntegerField(verbose_name='Минимальная цена')
+    offer_count = models.PositiveIntegerField(verbose_name='Количество предложений')
+
+    class Meta:
+        verbose_name = 'Лучшее предложение'
+        verbose_name_plural = "Лучшие предложения"
+
+
+class PriceChange(models.Model):
+    """
+    Журнал изменений цен и остатков, пишется при загрузке прайса.
+    Только добавление строк, id служит курсором для получения изменений
+    """
+    id = models.BigAutoField(primary_key=True)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='price_changes', on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, verbose_name='Продукт', related_name='price_changes',
+                                on_delete=models.CASCADE)
+    external_id = models.PositiveIntegerField(verbose_name='Внешний ИД')
+    change = models.CharField(verbose_name='Изменение', choices=PRICE_CHANGE_CHOICES, max_length=7)
+    price = models.PositiveIntegerField(verbose_name='Цена', null=True)
+    price_rrc = models.PositiveIntegerField(verbose_name='Рекомендованная цена', null=True)
+    quantity = models.PositiveIntegerField(verbose_name='Количество', null=True)
+    dt = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Изменение цены'
+        verbose_name_plural = "Журнал изменений цен"
+        ordering = ('id',)
+        indexes = [
+            models.Index(fields=['shop', 'id'], name='price_change_shop_idx'),
+        ]
+
+
+class ImportJob(models.Model):
+    """
+    Задание на загрузку прайса магазина (backend.importer.run_import_job)
+    """
+    user = models.ForeignKey(User, verbose_name='Пользователь', related_name='import_jobs', on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='import_jobs', null=True, blank=True,
+                             on_delete=models.CASCADE)
+    url = models.URLField(verbose_name='Ссылка')
+    state = models.CharField(verbose_name='Статус', choices=IMPORT_STATE_CHOICES, max_length=7, default='queued')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    duration = models.FloatField(verbose_name='Длительность, с', null=True, blank=True)
+    error = models.TextField(verbose_name='Ошибка', blank=True)
+    # ошибки проверки прайса: [{'path': 'goods[12].price', 'error': ...}]
+    errors = models.JSONField(verbose_name='Ошибки прайса', default=list, blank=True)
+
+    class Meta:
+        verbose_name = 'Загрузка прайса'
+        verbose_name_plural = "Загрузки прайсов"
+        ordering = ('-id',)
+        indexes = [
+            models.Index(fields=['state', 'shop'], name='import_job_state_shop_idx'),
+        ]
+
+
+class OutboxEvent(models.Model):
+    """
+    Задача celery, записанная в одной транзакции с изменением заказа или пользователя.
+    Публикуется в брокер отдельным процессом (backend.outbox.relay_outbox)
+    """
+    id = models.BigAutoField(primary_key=True)
+    task = models.CharField(verbose_name='Задача', max_length=100)
+    kwargs = models.JSONField(verbose_name='Аргументы', default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    published_at = models.DateTimeField(verbose_name='Опубликовано', null=True, blank=True)
+    attempts = models.PositiveIntegerField(verbose_name='Неудачных попыток', default=0)
+
+    class Meta:
+        verbose_name = 'Событие outbox'
+        verbose_name_plural = "Outbox"
+        indexes = [
+            # очередь неопубликованных событий
+            models.Index(fields=['id'], condition=models.Q(published_at__isnull=True), name='outbox_pending_idx'),
+        ]
 
 
 class Contact(models.Model):
@@ -219,6 +399,8 @@ class Order(models.Model):
                              related_name='orders', blank=True,
                              on_delete=models.CASCADE)
     dt = models.DateTimeField(auto_now_add=True)
+    # последнее изменение: корзина живёт одной строкой, её позиции меняются без сохранения заказа (touch_basket)
+    updated_at = models.DateTimeField(verbose_name='Изменён', auto_now=True)
     state = models.CharField(verbose_name='Статус', choices=STATE_CHOICES, max_length=15)
     contact = models.ForeignKey(Contact, verbose_name='Контакт',
                                 blank=True, null=True,
@@ -228,6 +410,11 @@ class Order(models.Model):
         verbose_name = 'Заказ'
         verbose_name_plural = "Список заказ"
         ordering = ('-dt',)
+        indexes = [
+            models.Index(fields=['dt'], name='order_dt_idx'),
+            models.Index(fields=['state', 'dt'], name='order_state_dt_idx'),
+            models.Index(fields=['state', 'updated_at'], name='order_state_updated_idx'),
+        ]
 
     def __str__(self):
         return str(self.pk)
@@ -254,6 +441,107 @@ class OrderItem(models.Model):
         ]
 
 
+class ArchivedOrder(models.Model):
+    """
+    Доставленные и отменённые заказы старше ORDER_ARCHIVE_AFTER_DAYS (backend.maintenance.archive_orders).
+    id тот же, что был у заказа
+    """
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(User, verbose_name='Пользователь', related_name='archived_orders', blank=True,
+                             on_delete=models.CASCADE)
+    dt = models.DateTimeField()
+    state = models.CharField(verbose_name='Статус', choices=STATE_CHOICES, max_length=15)
+    contact = models.ForeignKey(Contact, verbose_name='Контакт', related_name='+', blank=True, null=True,
+                                on_delete=models.SET_NULL)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Архивный заказ'
+        verbose_name_plural = "Архив заказов"
+        ordering = ('-dt',)
+        indexes = [
+            models.Index(fields=['user', 'dt'], name='archived_order_user_dt_idx'),
+        ]
+
+    def __str__(self):
+        return str(self.pk)
+
+
+class ArchivedOrderItem(models.Model):
+    id = models.IntegerField(primary_key=True)
+    order = models.ForeignKey(ArchivedOrder, verbose_name='Заказ', related_name='ordered_items',
+                              on_delete=models.CASCADE)
+    product_info = models.ForeignKey(ProductInfo, verbose_name='Информация о продукте',
+                                     related_name='archived_order_items', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(verbose_name='Количество')
+
+    class Meta:
+        verbose_name = 'Архивная позиция'
+        verbose_name_plural = "Архивные позиции"
+
+
+class ShopDailySales(models.Model):
+    """
+    Продажи магазина за день по статусам заказов (backend.rollups): день - дата заказа
+    """
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='daily_sales', on_delete=models.CASCADE)
+    day = models.DateField(verbose_name='День')
+    state = models.CharField(verbose_name='Статус', choices=STATE_CHOICES, max_length=15)
+    orders = models.IntegerField(verbose_name='Заказов', default=0)
+    units = models.IntegerField(verbose_name='Единиц товара', default=0)
+    revenue = models.BigIntegerField(verbose_name='Выручка', default=0)
+
+    class Meta:
+        verbose_name = 'Продажи магазина за день'
+        verbose_name_plural = "Продажи магазинов по дням"
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'day', 'state'], name='unique_shop_daily_sales'),
+        ]
+
+
+class ShopDailyProductSales(models.Model):
+    """
+    Продажи продукта магазином за день без отменённых заказов (backend.rollups)
+    """
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='daily_product_sales',
+                             on_delete=models.CASCADE)
+    day = models.DateField(verbose_name='День')
+    product = models.ForeignKey(Product, verbose_name='Продукт', related_name='daily_sales', on_delete=models.CASCADE)
+    # копия Product.category для отчёта по категориям без соединения
+    category = models.ForeignKey(Category, verbose_name='Категория', related_name='daily_sales',
+                                 on_delete=models.CASCADE)
+    units = models.IntegerField(verbose_name='Единиц товара', default=0)
+    revenue = models.BigIntegerField(verbose_name='Выручка', default=0)
+
+    class Meta:
+        verbose_name = 'Продажи продукта за день'
+        verbose_name_plural = "Продажи продуктов по дням"
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'day', 'product'], name='unique_shop_daily_product_sales'),
+        ]
+
+
+class ProductRecommendation(models.Model):
+    """
+    Продукты, которые покупают вместе с продуктом: top RECOMMENDATION_TOP_K соседей по числу общих заказов.
+    Пересчитывается целиком и дополняется по новым заказам (backend.recommendations)
+    """
+    product = models.ForeignKey(Product, verbose_name='Продукт', related_name='recommendations',
+                                on_delete=models.CASCADE)
+    neighbour = models.ForeignKey(Product, verbose_name='Покупают вместе', related_name='+', on_delete=models.CASCADE)
+    score = models.IntegerField(verbose_name='Общих заказов', default=0)
+
+    class Meta:
+        verbose_name = 'Рекомендация'
+        verbose_name_plural = "Рекомендации: покупают вместе"
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'neighbour'], name='unique_product_recommendation'),
+        ]
+        indexes = [
+            models.Index(fields=['product', '-score'], name='product_recommendation_idx'),
+        ]
+
+
 class ConfirmEmailToken(models.Model):
     class Meta:
         verbose_name = 'Токен подтверждения Email'
@@ -0,0 +1,52 @@
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from kombu.exceptions import OperationalError
+
+from backend.celery import app
+from backend.models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(task, **kwargs):
+    """
+    Ставим задачу через outbox: запись попадает в базу в текущей транзакции,
+    в брокер её отправит relay_outbox. Запрос не ждёт брокер, событие не теряется при его недоступности
+    """
+    return OutboxEvent.objects.create(task=task.name, kwargs=kwargs)
+
+
+def relay_outbox(batch_size=None, connection=None):
+    """
+    Публикуем порцию неопубликованных событий в celery, возвращаем количество опубликованных.
+    Доставка "хотя бы один раз": если отметка не сохранится, событие будет отправлено повторно
+    """
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    published_ids = []
+    with transaction.atomic():
+        # несколько relay не возьмут одни и те же события
+        events = OutboxEvent.objects.select_for_update(skip_locked=True).filter(
+            published_at__isnull=True).order_by('id')[:batch_size]
+        for event in events:
+            try:
+                app.send_task(event.task, kwargs=event.kwargs, connection=connection,
+                              ignore_result=app.conf.task_ignore_result)
+            except OperationalError as error:
+                logger.warning('Outbox event %s not published: %s', event.id, error)
+                OutboxEvent.objects.filter(id=event.id).update(attempts=F('attempts') + 1)
+                break
+            published_ids.append(event.id)
+        OutboxEvent.objects.filter(id__in=published_ids).update(published_at=timezone.now())
+    return len(published_ids)
+
+
+@app.task(ignore_result=True)
+def relay_outbox_task():
+    # запускается celery beat, разгребаем накопившееся ограниченным числом порций
+    for _ in range(settings.OUTBOX_MAX_BATCHES):
+        if relay_outbox() < settings.OUTBOX_BATCH_SIZE:
+            break
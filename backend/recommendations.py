@@ -0,0 +1,156 @@
+import logging
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+
+from backend.celery import app
+from backend.models import Product, OrderItem, ArchivedOrderItem, ProductRecommendation
+from backend.rollups import NOT_SOLD_STATES, apply_deltas
+
+logger = logging.getLogger(__name__)
+
+
+def order_products(item_model, chunk_size):
+    """
+    Пары (заказ, продукт) оформленных заказов порциями массивов, отсортированных по заказу.
+    Страницы берём по ключу order_id > последнего заказа, заказ целиком попадает в одну порцию
+    """
+    queryset = item_model.objects.exclude(order__state__in=NOT_SOLD_STATES).order_by(
+        'order_id', 'product_info__product_id').values_list('order_id', 'product_info__product_id').distinct()
+    last_order = 0
+    while True:
+        rows = list(queryset.filter(order_id__gt=last_order)[:chunk_size])
+        if not rows:
+            return
+        last_page = len(rows) < chunk_size
+        if not last_page:
+            tail_order = rows[-1][0]
+            if rows[0][0] == tail_order:
+                rows += list(queryset.filter(order_id=tail_order)[chunk_size:])
+            else:
+                while rows[-1][0] == tail_order:
+                    rows.pop()
+        last_order = rows[-1][0]
+        pairs = np.array(rows, dtype=np.int64)
+        yield pairs[:, 0], pairs[:, 1]
+        if last_page:
+            return
+
+
+def co_occurrence(orders, products, max_lines):
+    """
+    Все упорядоченные пары разных продуктов внутри каждого заказа (массивы отсортированы по заказу,
+    продукт в заказе один раз). Заказы больше max_lines позиций пропускаем: пар в них квадратично много
+    """
+    starts = np.flatnonzero(np.diff(orders, prepend=orders[0] - 1))
+    counts = np.diff(np.append(starts, len(orders)))
+    keep = (counts > 1) & (counts <= max_lines)
+    starts, counts = starts[keep], counts[keep]
+    # позиции оставшихся заказов: начало заказа + номер позиции в заказе
+    group_starts = np.repeat(starts, counts)
+    items = group_starts + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    # каждая позиция в паре со всеми позициями своего заказа
+    sizes = np.repeat(counts, counts)
+    left = np.repeat(items, sizes)
+    right = np.repeat(group_starts, sizes) + np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    different = left != right
+    return products[left[different]], products[right[different]]
+
+
+def top_neighbours(rows, cols, scores, k):
+    """
+    Разреженная матрица (rows, cols, scores) -> top k столбцов каждой строки по убыванию score
+    """
+    order = np.lexsort((cols, -scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    starts = np.flatnonzero(np.diff(rows, prepend=rows[0] - 1))
+    counts = np.diff(np.append(starts, len(rows)))
+    rank = np.arange(len(rows)) - np.repeat(starts, counts)
+    keep = rank < k
+    return rows[keep], cols[keep], scores[keep]
+
+
+def rebuild_recommendations(chunk_size=None):
+    """
+    Полный пересчёт: матрица совместных покупок по рабочим и архивным заказам в виде ключей
+    строка * base + столбец с числом заказов, из неё top RECOMMENDATION_TOP_K соседей каждого продукта.
+    Старые строки заменяются в одной транзакции
+    """
+    start = time.monotonic()
+    chunk_size = chunk_size or settings.RECOMMENDATION_CHUNK_SIZE
+    base = (Product.objects.aggregate(max_id=Max('id'))['max_id'] or 0) + 1
+    keys = np.empty(0, dtype=np.int64)
+    scores = np.empty(0, dtype=np.int64)
+    for item_model in (OrderItem, ArchivedOrderItem):
+        for orders, products in order_products(item_model, chunk_size):
+            left, right = co_occurrence(orders, products, settings.RECOMMENDATION_MAX_ORDER_LINES)
+            # добавляем пары порции к накопленной матрице
+            keys, inverse = np.unique(np.concatenate((keys, left * base + right)), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate((scores, np.ones(len(left), dtype=np.int64))),
+                                 minlength=len(keys)).astype(np.int64)
+    rows, cols, scores = top_neighbours(keys // base, keys % base, scores, settings.RECOMMENDATION_TOP_K) \
+        if len(keys) else (keys, keys, scores)
+
+    with transaction.atomic():
+        ProductRecommendation.objects.all().delete()
+        ProductRecommendation.objects.bulk_create(
+            (ProductRecommendation(product_id=product_id, neighbour_id=neighbour_id, score=score)
+             for product_id, neighbour_id, score in zip(rows.tolist(), cols.tolist(), scores.tolist())),
+            batch_size=settings.RECOMMENDATION_CHUNK_SIZE)
+    report = {'pairs': len(keys), 'recommendations': len(rows), 'seconds': round(time.monotonic() - start, 3)}
+    logger.info('Recommendations rebuilt: %s', report)
+    return report
+
+
+def apply_order(order_id, sign):
+    """
+    Добавить (sign=1) или убрать (sign=-1) пары продуктов одного заказа и обрезать списки соседей
+    затронутых продуктов до top K. Соседи, выпавшие из top K, теряют счёт до полного пересчёта
+    """
+    product_ids = sorted(set(OrderItem.objects.filter(order_id=order_id).values_list(
+        'product_info__product_id', flat=True)))
+    if not 1 < len(product_ids) <= settings.RECOMMENDATION_MAX_ORDER_LINES:
+        return
+    with transaction.atomic():
+        apply_deltas(ProductRecommendation, {
+            (('product_id', product_id), ('neighbour_id', neighbour_id)): {'score': sign}
+            for product_id in product_ids for neighbour_id in product_ids if product_id != neighbour_id})
+        ProductRecommendation.objects.filter(product_id__in=product_ids, score__lte=0).delete()
+        for product_id in product_ids:
+            extra = ProductRecommendation.objects.filter(product_id=product_id).order_by(
+                '-score', 'neighbour_id').values_list('id', flat=True)[settings.RECOMMENDATION_TOP_K:]
+            ProductRecommendation.objects.filter(id__in=list(extra)).delete()
+
+
+@app.task(ignore_result=True)
+def update_order_recommendations_task(order_id, sign):
+    # ставится через outbox при оформлении и отмене заказа (backend.signals)
+    apply_order(order_id, sign)
+
+
+@app.task(ignore_result=True)
+def rebuild_recommendations_task():
+    # запускается celery beat (CELERY_BEAT_SCHEDULE), исправляет приближение инкрементальных обновлений
+    rebuild_recommendations()
+
+
+def recommendations(product_ids, limit):
+    """
+    Соседи продуктов по индексу (product, -score) с лучшим предложением каждого соседа.
+    Для нескольких продуктов (корзина) счёт складываем, сами продукты исключаем
+    """
+    rows = ProductRecommendation.objects.filter(product_id__in=product_ids).exclude(
+        neighbour_id__in=product_ids).order_by('-score', 'neighbour_id').values(
+        'neighbour_id', 'neighbour__name', 'score', 'neighbour__best_offer__product_info_id',
+        'neighbour__best_offer__price')
+    result = {}
+    for row in rows:
+        item = result.setdefault(row['neighbour_id'], {
+            'product': row['neighbour_id'], 'name': row['neighbour__name'], 'score': 0,
+            'product_info': row['neighbour__best_offer__product_info_id'],
+            'price': row['neighbour__best_offer__price']})
+        item['score'] += row['score']
+    return sorted(result.values(), key=lambda item: (-item['score'], item['product']))[:limit]
@@ -0,0 +1,129 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from backend.models import Category, Parameter, Shop
+
+
+class ReferenceCache:
+    """
+    Справочник в памяти процесса: id -> значения полей и name -> id.
+    Размер ограничен (вытесняем самые старые записи), актуальность проверяем
+    по версии в общем кэше не чаще раза в REFERENCE_CACHE_CHECK_SECONDS.
+    Версию меняют изменение и удаление записей, новые записи кэш не сбрасывают.
+    Созданные записи попадают в память только после фиксации транзакции (on_commit),
+    откат загрузки не оставит в кэше лишних id
+    """
+
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = fields
+        self.version_key = f'reference_version:{model._meta.label_lower}'
+        self.lock = Lock()
+        self.rows = OrderedDict()
+        self.ids = {}
+        self.version = None
+        self.checked_at = 0
+
+    def __deepcopy__(self, memo):
+        # один справочник на процесс, поля сериализаторов при копировании ссылаются на него же
+        return self
+
+    def check_version(self):
+        now = time.monotonic()
+        if now - self.checked_at < settings.REFERENCE_CACHE_CHECK_SECONDS:
+            return
+        version = cache.get_or_set(self.version_key, 1, None)
+        with self.lock:
+            self.checked_at = now
+            if version != self.version:
+                self.rows.clear()
+                self.ids.clear()
+                self.version = version
+
+    def invalidate(self):
+        transaction.on_commit(self._bump_version)
+
+    def _bump_version(self):
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.set(self.version_key, 1, None)
+        # в своём процессе сбрасываем сразу, не дожидаясь проверки версии
+        self.checked_at = 0
+
+    def put(self, pk, row):
+        with self.lock:
+            self.rows[pk] = row
+            self.rows.move_to_end(pk)
+            self.ids[row['name']] = pk
+            while len(self.rows) > settings.REFERENCE_CACHE_MAX_SIZE:
+                _, old_row = self.rows.popitem(last=False)
+                self.ids.pop(old_row['name'], None)
+
+    def get_many(self, pks):
+        """
+        Значения по списку id, отсутствующие в памяти догружаем одним запросом
+        """
+        self.check_version()
+        rows = {}
+        for pk in pks:
+            row = self.rows.get(pk)
+            if row is not None:
+                rows[pk] = row
+        missing = set(pks) - rows.keys()
+        if missing:
+            for row in self.model.objects.filter(pk__in=missing).values('pk', *self.fields):
+                pk = row.pop('pk')
+                self.put(pk, row)
+                rows[pk] = row
+        return rows
+
+    def get(self, pk):
+        return self.get_many([pk]).get(pk)
+
+    def name(self, pk):
+        row = self.get(pk)
+        return row['name'] if row else None
+
+    def get_or_create(self, name, defaults=None):
+        """
+        (id, значения) по имени; запись создаём, если её нет в базе
+        """
+        self.check_version()
+        pk = self.ids.get(name)
+        row = self.rows.get(pk)
+        if row is not None:
+            return pk, row
+        obj, created = self.model.objects.get_or_create(name=name, defaults=defaults)
+        row = {field: getattr(obj, field) for field in self.fields}
+        if created:
+            transaction.on_commit(lambda: self.put(obj.pk, row))
+        else:
+            self.put(obj.pk, row)
+        return obj.pk, row
+
+    def clear(self):
+        with self.lock:
+            self.rows.clear()
+            self.ids.clear()
+
+
+categories = ReferenceCache(Category, ('name',))
+parameters = ReferenceCache(Parameter, ('name', 'type'))
+shops = ReferenceCache(Shop, ('name',))
+
+
+def invalidate_reference(sender, created=False, **kwargs):
+    if not created:
+        {Category: categories, Parameter: parameters, Shop: shops}[sender].invalidate()
+
+
+for reference_model in (Category, Parameter, Shop):
+    post_save.connect(invalidate_reference, sender=reference_model, dispatch_uid=f'reference_{reference_model}')
+    post_delete.connect(invalidate_reference, sender=reference_model, dispatch_uid=f'reference_del_{reference_model}')
@@ -0,0 +1,124 @@
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import F, Sum, Count
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from backend import reference
+from backend.models import OrderItem, ArchivedOrderItem, ShopDailySales, ShopDailyProductSales
+
+ROLLUP_BATCH_SIZE = 1000
+
+# отменённые заказы и корзины в продажи продуктов не входят
+NOT_SOLD_STATES = ('basket', 'canceled')
+
+
+def is_sold(state):
+    # None - заказа в этом статусе ещё не было (заказ из корзины redis создаётся сразу оформленным)
+    return state is not None and state not in NOT_SOLD_STATES
+
+
+def apply_deltas(model, deltas):
+    """
+    Прибавляем к строкам сводки {ключ: {поле: приращение}}. Недостающие строки вставляем без конфликтов
+    (ON CONFLICT DO NOTHING), затем обновляем через F(): параллельные заказы не теряют приращений
+    """
+    if not deltas:
+        return
+    model.objects.bulk_create([model(**dict(key)) for key in deltas], ignore_conflicts=True)
+    # одинаковый порядок блокировок строк у параллельных транзакций
+    for key, values in sorted(deltas.items()):
+        model.objects.filter(**dict(key)).update(
+            **{field: F(field) + delta for field, delta in values.items()})
+
+
+def apply_order_state(order_id, old_state, new_state):
+    """
+    Переносим вклад заказа в сводках из старого статуса в новый (old_state=None - заказ только появился).
+    Вызывается в транзакции изменения статуса (сигнал order_state_changed)
+    """
+    if old_state == new_state:
+        return
+    sales = defaultdict(Counter)
+    products = defaultdict(Counter)
+    sold_before, sold_after = is_sold(old_state), is_sold(new_state)
+    # заказ считаем один раз на магазин, сколько бы позиций магазина в нём ни было
+    counted = set()
+    for dt, shop_id, product_id, category_id, quantity, price in OrderItem.objects.filter(
+            order_id=order_id).values_list('order__dt', 'product_info__shop_id', 'product_info__product_id',
+                                           'product_info__product__category_id', 'quantity', 'product_info__price'):
+        day = timezone.localtime(dt).date()
+        for state, sign in ((old_state, -1), (new_state, 1)):
+            if state and state != 'basket':
+                key = (('shop_id', shop_id), ('day', day), ('state', state))
+                sales[key]['units'] += sign * quantity
+                sales[key]['revenue'] += sign * quantity * price
+                if key not in counted:
+                    counted.add(key)
+                    sales[key]['orders'] += sign
+        if sold_before != sold_after:
+            sign = 1 if sold_after else -1
+            key = (('shop_id', shop_id), ('day', day), ('product_id', product_id), ('category_id', category_id))
+            products[key]['units'] += sign * quantity
+            products[key]['revenue'] += sign * quantity * price
+    apply_deltas(ShopDailySales, sales)
+    apply_deltas(ShopDailyProductSales, products)
+
+
+def rebuild_rollups():
+    """
+    Полный пересчёт сводок по рабочим и архивным заказам агрегирующими запросами.
+    Старые строки заменяются в одной транзакции, отчёт не увидит пустых сводок
+    """
+    sales = defaultdict(Counter)
+    products = defaultdict(Counter)
+    for item_model in (OrderItem, ArchivedOrderItem):
+        items = item_model.objects.exclude(order__state='basket').annotate(
+            day=TruncDate('order__dt'), line_sum=F('quantity') * F('product_info__price'))
+        for shop_id, day, state, orders, units, revenue in items.values_list(
+                'product_info__shop_id', 'day', 'order__state').annotate(
+                orders=Count('order_id', distinct=True), units=Sum('quantity'), revenue=Sum('line_sum')).order_by():
+            sales[(shop_id, day, state)].update({'orders': orders, 'units': units, 'revenue': revenue})
+        for shop_id, day, product_id, category_id, units, revenue in items.exclude(
+                order__state__in=NOT_SOLD_STATES).values_list(
+                'product_info__shop_id', 'day', 'product_info__product_id',
+                'product_info__product__category_id').annotate(
+                units=Sum('quantity'), revenue=Sum('line_sum')).order_by():
+            products[(shop_id, day, product_id, category_id)].update({'units': units, 'revenue': revenue})
+
+    with transaction.atomic():
+        ShopDailySales.objects.all().delete()
+        ShopDailyProductSales.objects.all().delete()
+        ShopDailySales.objects.bulk_create(
+            (ShopDailySales(shop_id=shop_id, day=day, state=state, **values)
+             for (shop_id, day, state), values in sales.items()), batch_size=ROLLUP_BATCH_SIZE)
+        ShopDailyProductSales.objects.bulk_create(
+            (ShopDailyProductSales(shop_id=shop_id, day=day, product_id=product_id, category_id=category_id, **values)
+             for (shop_id, day, product_id, category_id), values in products.items()), batch_size=ROLLUP_BATCH_SIZE)
+    return len(sales), len(products)
+
+
+def sales_report(shop_ids, date_from, date_to, top):
+    """
+    Отчёт о продажах магазинов за период только по сводкам: выручка, заказы и единицы по дням
+    (без отменённых), заказы по статусам, top продуктов и категорий по выручке
+    """
+    sales = ShopDailySales.objects.filter(shop_id__in=shop_ids, day__gte=date_from, day__lte=date_to)
+    products = ShopDailyProductSales.objects.filter(shop_id__in=shop_ids, day__gte=date_from, day__lte=date_to)
+    categories = list(products.values('category_id').annotate(
+        units=Sum('units'), revenue=Sum('revenue')).order_by('-revenue', 'category_id')[:top])
+    reference.categories.get_many({category['category_id'] for category in categories})
+    for category in categories:
+        category['category'] = reference.categories.name(category['category_id'])
+    return {
+        'date_from': date_from,
+        'date_to': date_to,
+        'days': list(sales.exclude(state__in=NOT_SOLD_STATES).values('day').annotate(
+            orders=Sum('orders'), units=Sum('units'), revenue=Sum('revenue')).order_by('day')),
+        'states': {state: orders for state, orders in sales.values('state').annotate(
+            total=Sum('orders')).order_by('state').values_list('state', 'total')},
+        'products': list(products.values('product_id', 'product__name').annotate(
+            units=Sum('units'), revenue=Sum('revenue')).order_by('-revenue', 'product_id')[:top]),
+        'categories': categories,
+    }
@@ -0,0 +1,86 @@
+from threading import local
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.permissions import SAFE_METHODS
+
+_state = local()
+
+# отметка подзапроса batch (backend.batch) в request.META
+BATCH_KEY = 'backend.batch'
+
+
+def pin_key(user_id):
+    return f'replica_pin:{user_id}'
+
+
+def pin_primary(user_id):
+    """
+    После записи пользователь какое-то время читает с основной базы,
+    чтобы видеть свои изменения, даже если реплика отстаёт
+    """
+    cache.set(pin_key(user_id), True, settings.REPLICA_STICKY_SECONDS)
+
+
+def is_pinned(user):
+    return user.is_authenticated and cache.get(pin_key(user.id), False)
+
+
+def use_replica(value):
+    _state.replica = value
+
+
+class ReplicaRouter:
+    """
+    Роутер баз: запись всегда в основную, чтение в реплику только там,
+    где это явно разрешено (ReplicaReadMixin)
+    """
+
+    def db_for_read(self, model, **hints):
+        if settings.REPLICA_READS and getattr(_state, 'replica', False):
+            return settings.REPLICA_DATABASE
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # реплика содержит те же данные, что и основная база
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaReadMixin:
+    """
+    Миксин для viewset: безопасные запросы читаем с реплики,
+    если пользователь не закреплён за основной базой
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # подзапросы batch читают основную базу: им нужны записи предыдущих операций той же транзакции
+        use_replica(request.method in SAFE_METHODS and not is_pinned(request.user)
+                    and not request.META.get(BATCH_KEY))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        use_replica(False)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class PrimaryPinMiddleware:
+    """
+    Закрепляем пользователя за основной базой после любого изменяющего запроса
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        user = getattr(request, 'user', None)
+        if request.method not in SAFE_METHODS and user is not None and user.is_authenticated:
+            pin_primary(user.id)
+        return response
@@ -1,10 +1,132 @@
 # Верстальщик
+from django.db import models
+from django.db.models import Prefetch
 from rest_framework import serializers
-
-from backend.models import User, Category, Shop, ProductInfo, Product, ProductParameter, OrderItem, Order, Contact
-
-
-class ContactSerializer(serializers.ModelSerializer):
+from rest_framework.fields import get_attribute
+from rest_framework.permissions import SAFE_METHODS
+
+from backend import reference
+
+from backend.models import User, Category, Shop, ProductInfo, Product, ProductParameter, OrderItem, Order, Contact, \
+    PriceChange, BestOffer, ImportJob
+
+
+def sparse_fieldset(query_params):
+    # ?fields=id,price - только эти поля, ?exclude=shop - все, кроме этих
+    fields = {name for name in query_params.get('fields', '').split(',') if name}
+    exclude = {name for name in query_params.get('exclude', '').split(',') if name}
+    return fields or None, exclude
+
+
+class SparseFieldsModelSerializer(serializers.ModelSerializer):
+    """
+    Базовый сериализатор: при чтении поля ответа ограничиваются ?fields= и ?exclude=.
+    Действует на корневой объект (или элементы списка), вложенные объекты отдаются целиком
+    """
+
+    def is_root(self):
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        return parent is None
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+        if request is None or request.method not in SAFE_METHODS or not self.is_root():
+            return fields
+        only, exclude = sparse_fieldset(request.query_params)
+        return {name: field for name, field in fields.items()
+                if (only is None or name in only) and name not in exclude}
+
+
+def related_lookups(select_related, prefix=''):
+    # {'user': {}, 'product': {'category': {}}} -> user, product, product__category
+    for name, nested in select_related.items():
+        yield prefix + name
+        yield from related_lookups(nested, f'{prefix}{name}__')
+
+
+def sparse_queryset(queryset, fields, required=()):
+    """
+    Запрос под выбранные поля сериализатора: .only() по их столбцам и required, select_related
+    и prefetch_related только для выбранных связей. Поле, которому нужен объект целиком (source='*')
+    или свойство модели, оставляет запрос как есть
+    """
+    model_fields = {}
+    for model_field in queryset.model._meta.get_fields():
+        if model_field.auto_created and not model_field.concrete:
+            model_fields[model_field.get_accessor_name()] = model_field
+        else:
+            model_fields[model_field.name] = model_field
+            model_fields[getattr(model_field, 'attname', model_field.name)] = model_field
+    columns, relations = set(required), set()
+    for field in fields:
+        if field.write_only:
+            continue
+        if not field.source_attrs:
+            return queryset
+        name = field.source_attrs[0]
+        if name in queryset.query.annotations:
+            continue
+        model_field = model_fields.get(name)
+        if model_field is None:
+            return queryset
+        relations.add(name if model_field.auto_created and not model_field.concrete else model_field.name)
+        if model_field.concrete:
+            columns.add(model_field.name)
+
+    select_related = queryset.query.select_related
+    if select_related is True:
+        return queryset
+    if select_related:
+        kept = [lookup for lookup in related_lookups(select_related) if lookup.split('__')[0] in relations]
+        queryset = queryset.select_related(None)
+        if kept:
+            queryset = queryset.select_related(*kept)
+        columns.update(lookup.split('__')[0] for lookup in kept)
+    prefetches = queryset._prefetch_related_lookups
+    if prefetches:
+        kept = [lookup for lookup in prefetches
+                if (lookup.prefetch_to if isinstance(lookup, Prefetch) else lookup).split('__')[0] in relations]
+        queryset = queryset.prefetch_related(None).prefetch_related(*kept)
+    return queryset.only(*columns) if columns else queryset.only('pk')
+
+
+class ReferenceNameField(serializers.ReadOnlyField):
+    """
+    Имя категории, параметра или магазина по id из справочника в памяти, без соединения в запросе
+    """
+
+    def __init__(self, reference_cache, **kwargs):
+        self.reference_cache = reference_cache
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return self.reference_cache.name(value)
+
+
+class ReferenceListSerializer(serializers.ListSerializer):
+    """
+    Перед выдачей списка догружаем недостающие имена из справочников одним запросом на справочник
+    """
+
+    def to_representation(self, data):
+        items = list(data.all() if isinstance(data, models.Manager) else data)
+        for field in self.child.fields.values():
+            if isinstance(field, ReferenceNameField):
+                field.reference_cache.get_many({get_attribute(item, field.source_attrs) for item in items})
+            elif isinstance(field, serializers.Serializer):
+                # вложенный объект (позиция заказа -> предложение): справочники по его полям
+                related = [get_attribute(item, field.source_attrs) for item in items]
+                for nested in field.fields.values():
+                    if isinstance(nested, ReferenceNameField):
+                        nested.reference_cache.get_many(
+                            {get_attribute(obj, nested.source_attrs) for obj in related if obj})
+        return super().to_representation(items)
+
+
+class ContactSerializer(SparseFieldsModelSerializer):
     class Meta:
         model = Contact
         fields = ('id', 'city', 'street', 'house', 'structure', 'building', 'apartment', 'user', 'phone')
@@ -14,7 +136,7 @@ class ContactSerializer(serializers.ModelSerializer):
         }
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsModelSerializer):
     contacts = ContactSerializer(read_only=True, many=True)
 
     class Meta:
@@ -23,63 +145,67 @@ class UserSerializer(serializers.ModelSerializer):
         read_only_fields = ('id',)
 
 
-class AdressSerializer(serializers.ModelSerializer):
+class AdressSerializer(SparseFieldsModelSerializer):
     class Meta:
         model = Contact
         fields = ('city', 'street', 'house', 'structure', 'building', 'apartment')
         read_only_fields = ('id',)
 
 
-class PhoneSerializer(serializers.ModelSerializer):
+class PhoneSerializer(SparseFieldsModelSerializer):
     class Meta:
         model = Contact
         fields = ('phone')
         read_only_fields = ('id',)
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(SparseFieldsModelSerializer):
     class Meta:
         model = Category
         fields = ('id', 'name',)
         read_only_fields = ('id',)
 
 
-class ShopSerializer(serializers.ModelSerializer):
+class ShopSerializer(SparseFieldsModelSerializer):
     class Meta:
         model = Shop
         fields = ('id', 'name', 'state',)
         read_only_fields = ('id',)
 
 
-class ProductSerializer(serializers.ModelSerializer):
-    category = serializers.StringRelatedField()
+class ProductSerializer(SparseFieldsModelSerializer):
+    category = ReferenceNameField(reference.categories, source='category_id')
 
     class Meta:
         model = Product
+        list_serializer_class = ReferenceListSerializer
         fields = ('name', 'category',)
 
 
-class ProductParameterSerializer(serializers.ModelSerializer):
-    parameter = serializers.StringRelatedField()
+class ProductParameterSerializer(SparseFieldsModelSerializer):
+    parameter = ReferenceNameField(reference.parameters, source='parameter_id')
+    value = serializers.CharField(source='get_value', read_only=True)
 
     class Meta:
         model = ProductParameter
+        list_serializer_class = ReferenceListSerializer
         fields = ('parameter', 'value',)
 
 
-class ProductInfoSerializer(serializers.ModelSerializer):
+class ProductInfoSerializer(SparseFieldsModelSerializer):
     # product = ProductSerializer(read_only=True)
     # product_parameters = ProductParameterSerializer(read_only=True, many=True)
-    shop = serializers.StringRelatedField()
+    shop = ReferenceNameField(reference.shops, source='shop_id')
 
     class Meta:
         model = ProductInfo
+        list_serializer_class = ReferenceListSerializer
         fields = ('id', 'model', 'shop', 'price',)
         read_only_fields = ('id',)
 
 
-class UsersInfoSerializer(serializers.ModelSerializer):
-    phone = ContactSerializer(read_only=True, many=True)
+class UsersInfoSerializer(SparseFieldsModelSerializer):
+    phone = ContactSerializer(source='contacts', read_only=True, many=True)
 
     class Meta:
         model = User
@@ -90,21 +216,37 @@ class UsersInfoSerializer(serializers.ModelSerializer):
         }
 
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(SparseFieldsModelSerializer):
     class Meta:
         model = OrderItem
         fields = ('id', 'product_info', 'quantity', 'order',)
         read_only_fields = ('id',)
         extra_kwargs = {
-            'order': {'write_only': True}
+            'order': {'write_only': True},
+            # в корзину - только включенные предложения живой версии каталога, как в RedisBasket.add
+            'product_info': {'queryset': ProductInfo.objects.visible()},
         }
 
 
 class OrderItemCreateSerializer(OrderItemSerializer):
     product_info = ProductInfoSerializer(read_only=True)
 
+    class Meta(OrderItemSerializer.Meta):
+        list_serializer_class = ReferenceListSerializer
+
 
-class BasketSerializer(serializers.ModelSerializer):
+class CompactOrderItemSerializer(SparseFieldsModelSerializer):
+    model = serializers.CharField(source='product_info.model', read_only=True)
+    shop = ReferenceNameField(reference.shops, source='product_info.shop_id')
+    price = serializers.IntegerField(source='product_info.price', read_only=True)
+
+    class Meta:
+        model = OrderItem
+        list_serializer_class = ReferenceListSerializer
+        fields = ('product_info', 'model', 'shop', 'price', 'quantity',)
+
+
+class BasketSerializer(SparseFieldsModelSerializer):
     ordered_items = OrderItemCreateSerializer(read_only=True, many=True)
     sum = serializers.IntegerField(read_only=True)
     delivery = serializers.IntegerField(read_only=True)
@@ -112,11 +254,11 @@ class BasketSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Order
-        fields = ('ordered_items', 'sum', 'delivery', 'total_sum',)
+        fields = ('id', 'ordered_items', 'sum', 'delivery', 'total_sum',)
         read_only_fields = ('id',)
 
 
-class PartnerOrderSerializer(serializers.ModelSerializer):
+class PartnerOrderSerializer(SparseFieldsModelSerializer):
     total_sum = serializers.IntegerField(read_only=True)
     ordered_items = OrderItemCreateSerializer(read_only=True, many=True)
 
@@ -126,14 +268,14 @@ class PartnerOrderSerializer(serializers.ModelSerializer):
         read_only_fields = ('id',)
 
 
-class PartnerOrdersSerializer(serializers.ModelSerializer):
+class PartnerOrdersSerializer(SparseFieldsModelSerializer):
     class Meta:
         model = Order
         fields = ('id', 'dt',)
         read_only_fields = ('id',)
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SparseFieldsModelSerializer):
     ordered_items = OrderItemCreateSerializer(read_only=True, many=True)
     total_sum = serializers.IntegerField()
     user = UsersInfoSerializer(read_only=True)
@@ -149,7 +291,18 @@ class OrderSerializer(serializers.ModelSerializer):
         return obj.contact.phone
 
 
-class OrdersSerializer(serializers.ModelSerializer):
+class CompactOrderSerializer(SparseFieldsModelSerializer):
+    """Заказ без данных покупателя, позиции плоским списком (?compact=true)"""
+    ordered_items = CompactOrderItemSerializer(read_only=True, many=True)
+    total_sum = serializers.IntegerField()
+
+    class Meta:
+        model = Order
+        fields = ('id', 'dt', 'state', 'contact', 'ordered_items', 'total_sum',)
+        read_only_fields = ('id',)
+
+
+class OrdersSerializer(SparseFieldsModelSerializer):
     total_sum = serializers.IntegerField(read_only=True)
     state = serializers.CharField(read_only=True)
 
@@ -157,3 +310,25 @@ class OrdersSerializer(serializers.ModelSerializer):
         model = Order
         fields = ('id', 'dt', 'total_sum', 'state',)
         read_only_fields = ('id',)
+
+
+class BestOfferSerializer(SparseFieldsModelSerializer):
+    class Meta:
+        model = BestOffer
+        fields = ('product', 'product_info', 'shop', 'price', 'offer_count',)
+        read_only_fields = ('product',)
+
+
+class PriceChangeSerializer(SparseFieldsModelSerializer):
+    class Meta:
+        model = PriceChange
+        fields = ('id', 'shop', 'product', 'external_id', 'change', 'price', 'price_rrc', 'quantity', 'dt',)
+        read_only_fields = ('id',)
+
+
+class ImportJobSerializer(SparseFieldsModelSerializer):
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'shop', 'url', 'state', 'created_at', 'started_at', 'finished_at', 'duration', 'error',
+                  'errors',)
+        read_only_fields = fields
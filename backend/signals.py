@@ -0,0 +1,103 @@
+import time
+
+from celery.signals import task_prerun, task_postrun
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver, Signal
+
+from backend import reference  # noqa: F401 сброс справочников в памяти при изменении записей
+from backend.catalog import apply_shop_state
+from backend.outbox import enqueue
+from backend.recommendations import update_order_recommendations_task
+from backend.rollups import apply_order_state, is_sold
+
+# событие изменения статуса магазинов: shop_ids, state
+shop_state_changed = Signal()
+# событие изменения статуса заказа: order_id, old_state, new_state (отправляется в транзакции изменения)
+order_state_changed = Signal()
+
+
+def record_connection_use(connection):
+    """
+    Обёртка запросов соединения: время последнего успешного запроса (тоже подтверждает живость соединения)
+    """
+    def wrapper(execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        connection.alive_at = time.monotonic()
+        return result
+    return wrapper
+
+
+@receiver(connection_created)
+def track_connection_use(connection, **kwargs):
+    # обёртка ставится один раз на алиас, переподключения её сохраняют
+    if not getattr(connection, 'use_tracked', False):
+        connection.execute_wrappers.append(record_connection_use(connection))
+        connection.use_tracked = True
+    connection.alive_at = time.monotonic()
+
+
+def close_unusable_connections():
+    """
+    Проверка постоянных соединений перед повторным использованием.
+    В Django 4.0 нет CONN_HEALTH_CHECKS, поэтому проверяем сами:
+    соединение, оборванное базой или pgbouncer, закрываем, и Django откроет новое.
+    Проверяем (SELECT 1) только соединения без запросов дольше DB_HEALTH_CHECK_IDLE_SECONDS:
+    занятые соединения и алиасы, которые запросы не используют, не дают лишних обращений к базе на каждый запрос
+    """
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None or connection.in_atomic_block \
+                or not connection.settings_dict.get('CONN_HEALTH_CHECKS') \
+                or now - getattr(connection, 'alive_at', 0) < settings.DB_HEALTH_CHECK_IDLE_SECONDS:
+            continue
+        if connection.is_usable():
+            connection.alive_at = now
+        else:
+            connection.close()
+
+
+def close_old_connections():
+    """
+    То же, что django.db.close_old_connections, но не трогаем соединения внутри транзакции
+    (задача может выполниться синхронно внутри запроса)
+    """
+    for connection in connections.all():
+        if not connection.in_atomic_block:
+            connection.close_if_unusable_or_obsolete()
+
+
+@receiver(request_started)
+def check_connections_on_request(**kwargs):
+    close_unusable_connections()
+
+
+@receiver(task_prerun)
+def check_connections_on_task(**kwargs):
+    # у celery нет request_started/request_finished, поэтому CONN_MAX_AGE соблюдаем по сигналам задач
+    close_old_connections()
+    close_unusable_connections()
+
+
+@receiver(task_postrun)
+def release_connections_after_task(**kwargs):
+    close_old_connections()
+
+
+@receiver(shop_state_changed)
+def update_catalog_visibility(shop_ids, state, **kwargs):
+    apply_shop_state(shop_ids, state)
+
+
+@receiver(order_state_changed)
+def update_sales_rollups(order_id, old_state, new_state, **kwargs):
+    apply_order_state(order_id, old_state, new_state)
+
+
+@receiver(order_state_changed)
+def update_recommendations(order_id, old_state, new_state, **kwargs):
+    # пары продуктов заказа пересчитываются в фоне, когда заказ оформлен или отменён
+    if is_sold(old_state) != is_sold(new_state):
+        enqueue(update_order_recommendations_task, order_id=order_id, sign=1 if is_sold(new_state) else -1)
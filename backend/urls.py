@@ -4,7 +4,9 @@ from rest_framework.routers import DefaultRouter
 
 from backend.views import OrdersViewset, ContactViewset, BasketViewset, PartnerStateViewset, \
     PartnerOrdersViewset, PartnerUpdateViewset, ProductInfoViewset, ShopListViewset, CategoryListViewset, \
-    LoginAccountViewset, AccountDetailsViewset, RegisterAccountViewset, ConfirmAccountViewset, PasswordResetCustom
+    LoginAccountViewset, AccountDetailsViewset, RegisterAccountViewset, ConfirmAccountViewset, PasswordResetCustom, \
+    PartnerExportViewset, PriceChangeViewset, BestOfferViewset, PartnerImportViewset, \
+    PartnerAnalyticsViewset, RecommendationViewset, BatchViewset
 
 router = DefaultRouter()
 router.register('user/register', RegisterAccountViewset)
@@ -14,13 +16,20 @@ router.register('user/confirm', ConfirmAccountViewset)
 router.register('user/details', AccountDetailsViewset)
 router.register('user/contact', ContactViewset)
 router.register('products', ProductInfoViewset)
+router.register('prices/changes', PriceChangeViewset)
+router.register('best_offers', BestOfferViewset)
+router.register('recommendations', RecommendationViewset, basename='recommendations')
 router.register('categories', CategoryListViewset)
 router.register('shops', ShopListViewset)
 router.register('orders', OrdersViewset)
 router.register('basket', BasketViewset)
 router.register('partner/update', PartnerUpdateViewset)
 router.register('partner/state', PartnerStateViewset)
+router.register('partner/imports', PartnerImportViewset)
 router.register('partner/orders', PartnerOrdersViewset)
+router.register('partner/export', PartnerExportViewset, basename='partner-export')
+router.register('partner/analytics', PartnerAnalyticsViewset, basename='partner-analytics')
+router.register('batch', BatchViewset, basename='batch')
 
 
 app_name = 'backend'
@@ -1,30 +1,115 @@
+from datetime import date, datetime, timedelta
 from distutils.util import strtobool
 
+from django.conf import settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
-from django.db import IntegrityError
-from django.db.models import Q, Sum, F, Count
-from django.http import JsonResponse
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Sum, F, Count, Prefetch
+from django.http import JsonResponse, Http404
+from django.utils.timezone import make_aware, localdate
 from django_rest_passwordreset.models import ResetPasswordToken
 from django_rest_passwordreset.views import User
-from requests import get
 from rest_framework import viewsets
 from rest_framework.authtoken.models import Token
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.decorators import action
+from rest_framework.exceptions import ParseError
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, SAFE_METHODS
 from rest_framework.response import Response
 from ujson import loads as load_json
-from yaml import load as load_yaml, Loader
-from backend.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, Order, OrderItem, \
-    Contact, ConfirmEmailToken
+from backend.models import Shop, Category, ProductInfo, Order, OrderItem, Contact, ConfirmEmailToken, PriceChange, \
+    BestOffer, ImportJob, ArchivedOrder, ArchivedOrderItem
 from backend.permissions import IsOwner, ShopPermission
+from backend.routers import ReplicaReadMixin
+from backend.signals import shop_state_changed, order_state_changed
 from backend.serializers import UserSerializer, CategorySerializer, ShopSerializer, ProductInfoSerializer, \
     OrderItemSerializer, OrderSerializer, ContactSerializer, OrdersSerializer, BasketSerializer, \
-    PartnerOrdersSerializer, PartnerOrderSerializer
+    PartnerOrdersSerializer, PartnerOrderSerializer, PriceChangeSerializer, BestOfferSerializer, ImportJobSerializer, \
+    CompactOrderSerializer, sparse_fieldset, sparse_queryset
 from backend.mail_service import new_user_registered, password_reset_token_created, new_order
-
-DELIVERY = 300
+from backend.importer import schedule_import, import_now, import_metrics
+from backend.outbox import enqueue
+from backend.maintenance import archive_cutoff
+from backend.rollups import sales_report
+from backend.baskets import RedisBasket, DELIVERY, touch_basket
+from backend.health import offer_health_rows, HEALTH_HEADER
+from backend.recommendations import recommendations
+from backend.autocomplete import autocomplete
+from backend.batch import run_batch, BatchError
+from backend.exports import export_response, partner_order_rows, catalog_rows, price_list_response, ORDER_HEADER, \
+    CATALOG_HEADER, CONTENT_TYPES
+
+PRICE_CHANGES_LIMIT = 1000
+ANALYTICS_DEFAULT_DAYS = 30
+ANALYTICS_TOP_LIMIT = 100
+
+
+def parse_date_range(query_params):
+    # ?date_from=&date_to= в формате ГГГГ-ММ-ДД, отсутствующая граница - None
+    try:
+        return [date.fromisoformat(query_params[name]) if query_params.get(name) else None
+                for name in ('date_from', 'date_to')]
+    except ValueError:
+        raise ParseError('date_from и date_to в формате ГГГГ-ММ-ДД')
+
+
+class SparseFieldsMixin:
+    """
+    Миксин для viewset: ?fields= и ?exclude= урезают не только ответ, но и запрос -
+    .only() по столбцам выбранных полей и связи только для них
+    """
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.request.method in SAFE_METHODS and sparse_fieldset(self.request.query_params) != (None, set()):
+            # IsOwner сверяет владельца объекта, его столбец читаем всегда
+            required = ('user',) if IsOwner in self.permission_classes else ()
+            queryset = sparse_queryset(queryset, self.get_serializer().fields.values(), required)
+        return queryset
+
+
+class OrderArchiveMixin:
+    """
+    Миксин для списков заказов: ?date_from=&date_to= (ГГГГ-ММ-ДД) ограничивает период.
+    Архивные заказы (ArchivedOrder) попадают в выдачу, только если период начинается раньше границы архива,
+    без периода читаются только рабочие таблицы. get_archive_queryset - те же фильтры и суммы по архиву
+    """
+    archive_fields = ('id', 'dt', 'state', 'total_sum')
+
+    def date_range(self):
+        return parse_date_range(self.request.query_params)
+
+    def filter_dates(self, queryset, date_from, date_to):
+        if date_from:
+            queryset = queryset.filter(dt__gte=make_aware(datetime.combine(date_from, datetime.min.time())))
+        if date_to:
+            queryset = queryset.filter(dt__lt=make_aware(datetime.combine(date_to + timedelta(days=1),
+                                                                          datetime.min.time())))
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        date_from, date_to = self.date_range()
+        queryset = self.filter_dates(self.filter_queryset(self.get_queryset()), date_from, date_to)
+        if date_from and make_aware(datetime.combine(date_from, datetime.min.time())) < archive_cutoff():
+            archived = self.filter_dates(self.get_archive_queryset(), date_from, date_to)
+            queryset = queryset.order_by().values(*self.archive_fields).union(
+                archived.order_by().values(*self.archive_fields), all=True).order_by('-dt')
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404:
+            # заказ по id ищем и в архиве
+            archived = self.get_archive_queryset().filter(id=self.kwargs['pk']).first()
+            if archived is None:
+                raise
+            # те же проверки прав на объект, что и для рабочих таблиц
+            self.check_object_permissions(self.request, archived)
+            return archived
 
 
 class RegisterAccountViewset(viewsets.ModelViewSet):
@@ -56,10 +141,12 @@ class RegisterAccountViewset(viewsets.ModelViewSet):
                 user_serializer = UserSerializer(data=request.data)
                 if user_serializer.is_valid():
                     # сохраняем пользователя
-                    user = user_serializer.save()
-                    user.set_password(request.data['password'])
-                    user.save()
-                    new_user_registered.delay(user_email=user.email, user_id=user.id)
+                    with transaction.atomic():
+                        user = user_serializer.save()
+                        user.set_password(request.data['password'])
+                        user.save()
+                        # письмо ставится через outbox в той же транзакции
+                        enqueue(new_user_registered, user_email=user.email, user_id=user.id)
                     return JsonResponse({'Status': True})
                 else:
                     return JsonResponse({'Status': False, 'Errors': user_serializer.errors})
@@ -156,10 +243,11 @@ class PasswordResetCustom(viewsets.ModelViewSet):
         if {'email'}.issubset(request.data):
             user = User.objects.filter(email=request.data['email'])
             if len(user) != 0:
-                token = ResetPasswordToken.objects.create(
-                    user=user[0])
-                print(token.key)
-                password_reset_token_created.delay(reset_password_token=token.key, user_email=request.data['email'])
+                with transaction.atomic():
+                    token = ResetPasswordToken.objects.create(
+                        user=user[0])
+                    enqueue(password_reset_token_created, reset_password_token=token.key,
+                            user_email=request.data['email'])
                 return JsonResponse({'Status': 'Писльмо для восстановления доступа отправлено на почту'})
 
             return JsonResponse({'Status': False, 'Errors': 'Нет такого пользователя'})
@@ -167,28 +255,29 @@ class PasswordResetCustom(viewsets.ModelViewSet):
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
 
-class CategoryListViewset(viewsets.ModelViewSet):
+class CategoryListViewset(SparseFieldsMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     """Viewset для просмотра категорий"""
 
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
 
 
-class ShopListViewset(viewsets.ModelViewSet):
+class ShopListViewset(SparseFieldsMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     """Viewset для просмотра списка магазинов"""
 
     queryset = Shop.objects.all()
     serializer_class = ShopSerializer
 
 
-class ProductInfoViewset(viewsets.ModelViewSet):
+class ProductInfoViewset(SparseFieldsMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     """Viewset для поиска товаров"""
 
     queryset = ProductInfo.objects.all().order_by('id')
     serializer_class = ProductInfoSerializer
 
     def get_queryset(self):
-        query = Q(shop__state=True)
+        # только живая версия каталога включенного магазина (is_active): идущая загрузка покупателям не видна
+        query = Q(is_active=True)
         shop_id = self.request.query_params.get('shop_id')
         category_id = self.request.query_params.get('category_id')
 
@@ -198,13 +287,90 @@ class ProductInfoViewset(viewsets.ModelViewSet):
         if category_id:
             query = query & Q(product__category_id=category_id)
 
-        return super().get_queryset().filter(
-            query).select_related(
-            'shop', 'product__category').prefetch_related(
-            'product_parameters__parameter').distinct()
+        # диапазон значений числового параметра: ?parameter_id=1&value_min=6&value_max=6.5
+        parameter_id = self.request.query_params.get('parameter_id')
+        if parameter_id:
+            parameter_query = Q(product_parameters__parameter_id=parameter_id)
+            for name, lookup in (('value_min', 'gte'), ('value_max', 'lte')):
+                value = self.request.query_params.get(name)
+                if value:
+                    try:
+                        value = float(value)
+                    except ValueError:
+                        raise ParseError(f'{name} должен быть числом')
+                    parameter_query &= Q(**{f'product_parameters__value_number__{lookup}': value})
+            query = query & parameter_query
+
+        # имя магазина сериализатор берёт из справочника в памяти
+        return super().get_queryset().filter(query).distinct()
+
+    # подсказки по началу имени продукта или модели: ?q=<префикс>&limit=
+    @action(detail=False)
+    def autocomplete(self, request, *args, **kwargs):
+        try:
+            limit = min(int(request.query_params.get('limit', settings.AUTOCOMPLETE_LIMIT)),
+                        settings.AUTOCOMPLETE_LIMIT)
+        except ValueError:
+            raise ParseError('limit должен быть числом')
+        return Response(autocomplete.search(request.query_params.get('q', ''), limit))
+
+
+class BestOfferViewset(SparseFieldsMixin, ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
+    """Viewset для лучших предложений по продуктам: /best_offers/<product_id>/ или ?product_id=1,2,3"""
+
+    queryset = BestOffer.objects.all().order_by('product_id')
+    serializer_class = BestOfferSerializer
+
+    def get_queryset(self):
+        product_ids = self.request.query_params.get('product_id')
+        if product_ids:
+            product_ids = [product_id for product_id in product_ids.split(',') if product_id.isdigit()]
+            return super().get_queryset().filter(product_id__in=product_ids)
+        return super().get_queryset()
 
 
-class BasketViewset(viewsets.ModelViewSet):
+class RecommendationViewset(ReplicaReadMixin, viewsets.ViewSet):
+    """Viewset для рекомендаций "покупают вместе": /recommendations/<product_id>/ или ?product_id=1,2,3"""
+
+    def list(self, request, *args, **kwargs):
+        product_ids = [int(product_id) for product_id in request.query_params.get('product_id', '').split(',')
+                       if product_id.isdigit()]
+        if not product_ids:
+            raise ParseError('product_id - список id продуктов через запятую')
+        return Response(recommendations(product_ids, settings.RECOMMENDATION_TOP_K))
+
+    def retrieve(self, request, pk=None, *args, **kwargs):
+        if not str(pk).isdigit():
+            raise Http404
+        return Response(recommendations([int(pk)], settings.RECOMMENDATION_TOP_K))
+
+
+class PriceChangeViewset(SparseFieldsMixin, ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
+    """Viewset для получения изменений цен и остатков после курсора: ?cursor=<id>&shop_id=&limit="""
+
+    queryset = PriceChange.objects.all().order_by('id')
+    serializer_class = PriceChangeSerializer
+
+    def list(self, request, *args, **kwargs):
+        try:
+            cursor = int(request.query_params.get('cursor', 0))
+            limit = min(int(request.query_params.get('limit', PRICE_CHANGES_LIMIT)), PRICE_CHANGES_LIMIT)
+        except ValueError:
+            raise ParseError('cursor и limit должны быть числами')
+
+        queryset = self.filter_queryset(self.get_queryset()).filter(id__gt=cursor)
+        shop_id = request.query_params.get('shop_id')
+        if shop_id:
+            queryset = queryset.filter(shop_id=shop_id)
+
+        changes = list(queryset[:limit])
+        return Response({
+            'cursor': changes[-1].id if changes else cursor,
+            'results': self.get_serializer(changes, many=True).data,
+        })
+
+
+class BasketViewset(SparseFieldsMixin, viewsets.ModelViewSet):
     """Viewset для корзины"""
 
     permission_classes = [IsAuthenticated, IsOwner]
@@ -219,6 +385,18 @@ class BasketViewset(viewsets.ModelViewSet):
             total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price')) +
                       Count('ordered_items__product_info__shop', distinct=True) * DELIVERY)
 
+    @property
+    def redis_basket(self):
+        # BASKET_BACKEND=redis: корзина в redis, в базу попадает при оформлении заказа
+        if settings.BASKET_BACKEND == 'redis':
+            return RedisBasket(self.request.user.id)
+
+    def list(self, request, *args, **kwargs):
+        basket = self.redis_basket
+        if basket is None:
+            return super().list(request, *args, **kwargs)
+        return self.get_paginated_response(self.paginate_queryset(basket.data()))
+
     # добавить товары в корзину
     def create(self, request, *args, **kwargs):
         items_sting = request.data.get('items')
@@ -228,6 +406,8 @@ class BasketViewset(viewsets.ModelViewSet):
             except ValueError:
                 return JsonResponse({'Status': False, 'Errors': 'Неверный формат запроса'})
             else:
+                if self.redis_basket:
+                    return JsonResponse({'Status': True, 'Создано объектов': self.redis_basket.add(items_dict)})
                 contact_id = Contact.objects.filter(user_id=request.user.id).values_list('pk', flat=True)[0]
                 basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket',
                                                         contact_id=contact_id)
@@ -246,6 +426,8 @@ class BasketViewset(viewsets.ModelViewSet):
                     else:
                         JsonResponse({'Status': False, 'Errors': serializer.errors})
 
+                if objects_created:
+                    touch_basket(basket.id)
                 return JsonResponse({'Status': True, 'Создано объектов': objects_created})
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
@@ -254,6 +436,11 @@ class BasketViewset(viewsets.ModelViewSet):
         items_sting = request.data.get('items')
         if items_sting:
             items_list = items_sting.split(',')
+            if self.redis_basket:
+                item_ids = [item_id for item_id in items_list if item_id.isdigit()]
+                if item_ids:
+                    return JsonResponse({'Status': True, 'Удалено объектов': self.redis_basket.remove(item_ids)})
+                return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
             basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket')
             query = Q()
             objects_deleted = False
@@ -264,6 +451,8 @@ class BasketViewset(viewsets.ModelViewSet):
 
             if objects_deleted:
                 deleted_count = OrderItem.objects.filter(query).delete()[0]
+                if deleted_count:
+                    touch_basket(basket.id)
                 return JsonResponse({'Status': True, 'Удалено объектов': deleted_count})
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
@@ -277,6 +466,10 @@ class BasketViewset(viewsets.ModelViewSet):
             except ValueError:
                 JsonResponse({'Status': False, 'Errors': 'Неверный формат запроса'})
             else:
+                if self.redis_basket:
+                    items = [order_item for order_item in items_dict
+                             if type(order_item['id']) == int and type(order_item['quantity']) == int]
+                    return JsonResponse({'Status': True, 'Обновлено объектов': self.redis_basket.update(items)})
                 basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket')
                 objects_updated = 0
                 for order_item in items_dict:
@@ -284,10 +477,34 @@ class BasketViewset(viewsets.ModelViewSet):
                         objects_updated += OrderItem.objects.filter(order_id=basket.id, id=order_item['id']).update(
                             quantity=order_item['quantity'])
 
+                if objects_updated:
+                    touch_basket(basket.id)
                 return JsonResponse({'Status': True, 'Обновлено объектов': objects_updated})
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
 
+class BatchViewset(viewsets.ViewSet):
+    """
+    Viewset для нескольких запросов к api за один: {"atomic": true, "operations": [{"id": "basket",
+    "method": "GET", "url": "/api/v1/basket/"}, {"method": "POST", "url": "/api/v1/orders/",
+    "data": {"id": "{{basket.results.0.id}}", "contact": 1}}]}. Подзапросы выполняются от того же пользователя,
+    свой заголовок Authorization можно передать в "headers" (например, токен из операции входа)
+    """
+
+    def create(self, request, *args, **kwargs):
+        operations = request.data.get('operations')
+        if isinstance(operations, str):
+            try:
+                operations = load_json(operations)
+            except ValueError:
+                return JsonResponse({'Status': False, 'Errors': 'Неверный формат запроса'})
+        try:
+            atomic = bool(strtobool(str(request.data.get('atomic', 'false'))))
+            return Response(run_batch(request, operations, atomic))
+        except (BatchError, ValueError) as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)})
+
+
 class PartnerUpdateViewset(viewsets.ModelViewSet):
     """Viewset для обновления прайса"""
 
@@ -304,38 +521,35 @@ class PartnerUpdateViewset(viewsets.ModelViewSet):
             except ValidationError as e:
                 return JsonResponse({'Status': False, 'Error': str(e)})
             else:
-                stream = get(url).content
-
-                data = load_yaml(stream, Loader=Loader)
-                shop, _ = Shop.objects.get_or_create(name=data['shop'], user_id=request.user.id,
-                                                     url=request.data['url'])
-                for category in data['categories']:
-                    category_object, _ = Category.objects.get_or_create(id=category['id'], name=category['name'])
-                    category_object.shops.add(shop.id)
-                    category_object.save()
-                ProductInfo.objects.filter(shop_id=shop.id).delete()
-                for item in data['goods']:
-                    product, _ = Product.objects.get_or_create(name=item['name'], category_id=item['category'])
-
-                    product_info = ProductInfo.objects.create(product_id=product.id,
-                                                              external_id=item['id'],
-                                                              model=item['model'],
-                                                              price=item['price'],
-                                                              quantity=item['quantity'],
-                                                              price_rrc=item['price_rrc'],
-                                                              shop_id=shop.id)
-                    for name, value in item['parameters'].items():
-                        parameter_object, _ = Parameter.objects.get_or_create(name=name)
-                        ProductParameter.objects.create(product_info_id=product_info.id,
-                                                        parameter_id=parameter_object.id,
-                                                        value=value)
+                if settings.PRICE_IMPORT_ASYNC:
+                    job = schedule_import(request.user.id, url)
+                    return JsonResponse({'Status': True, 'Job': job.id})
 
-                return JsonResponse({'Status': True})
+                job = import_now(request.user.id, url)
+                if job.state == 'failed':
+                    return JsonResponse({'Status': False, 'Error': job.error, 'Errors': job.errors, 'Job': job.id})
+                return JsonResponse({'Status': True, 'Job': job.id})
 
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
 
-class PartnerStateViewset(viewsets.ModelViewSet):
+class PartnerImportViewset(SparseFieldsMixin, viewsets.ReadOnlyModelViewSet):
+    """Viewset для заданий загрузки прайса поставщика и метрик очереди загрузок"""
+
+    permission_classes = [IsAuthenticated, ShopPermission]
+    queryset = ImportJob.objects.all()
+    serializer_class = ImportJobSerializer
+
+    def get_queryset(self):
+        return super().get_queryset().filter(user_id=self.request.user.id)
+
+    # очередь и длительность загрузок по магазинам (для администраторов)
+    @action(detail=False, permission_classes=[IsAuthenticated, IsAdminUser])
+    def metrics(self, request, *args, **kwargs):
+        return Response(list(import_metrics()))
+
+
+class PartnerStateViewset(SparseFieldsMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     """Viewset для работы со статусом поставщика"""
 
     permission_classes = [IsAuthenticated, IsOwner, ShopPermission]
@@ -347,7 +561,13 @@ class PartnerStateViewset(viewsets.ModelViewSet):
         state = request.data.get('state')
         if state:
             try:
-                Shop.objects.filter(user_id=request.user.id).update(state=strtobool(state))
+                state = bool(strtobool(state))
+                shop_ids = list(Shop.objects.filter(user_id=request.user.id).values_list('id', flat=True))
+                # статус и каталог меняются вместе, иначе ошибка в обработчике оставит выключенный магазин
+                # с видимыми предложениями
+                with transaction.atomic():
+                    Shop.objects.filter(id__in=shop_ids).update(state=state)
+                    shop_state_changed.send(sender=Shop, shop_ids=shop_ids, state=state)
                 return JsonResponse({'Status': True})
             except ValueError as error:
                 return JsonResponse({'Status': False, 'Errors': str(error)})
@@ -355,7 +575,7 @@ class PartnerStateViewset(viewsets.ModelViewSet):
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
 
-class PartnerOrdersViewset(viewsets.ModelViewSet):
+class PartnerOrdersViewset(SparseFieldsMixin, ReplicaReadMixin, OrderArchiveMixin, viewsets.ModelViewSet):
     """Viewset ля получения заказов поставщиками"""
 
     permission_classes = [IsAuthenticated, IsOwner, ShopPermission]
@@ -369,17 +589,96 @@ class PartnerOrdersViewset(viewsets.ModelViewSet):
             'ordered_items__product_info__product_parameters__parameter').annotate(
             total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price')))
 
-    def retrieve(self, request, *args, **kwargs):
-        instance = self.get_object()
-        serializer = PartnerOrderSerializer(instance)
-        return Response(serializer.data)
+    def get_archive_queryset(self):
+        return ArchivedOrder.objects.filter(
+            ordered_items__product_info__shop__user_id=self.request.user.id).annotate(
+            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price')))
+
+    def get_serializer_class(self):
+        return PartnerOrderSerializer if self.action == 'retrieve' else PartnerOrdersSerializer
+
+
+class PartnerAnalyticsViewset(ReplicaReadMixin, viewsets.ViewSet):
+    """Viewset для отчёта о продажах поставщика по сводкам: ?date_from=&date_to= (по умолчанию 30 дней)&top="""
+
+    permission_classes = [IsAuthenticated, ShopPermission]
+
+    def list(self, request, *args, **kwargs):
+        date_from, date_to = parse_date_range(request.query_params)
+        date_to = date_to or localdate()
+        date_from = date_from or date_to - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+        try:
+            top = min(int(request.query_params.get('top', ANALYTICS_TOP_LIMIT)), ANALYTICS_TOP_LIMIT)
+        except ValueError:
+            raise ParseError('top должен быть числом')
+        shop_ids = list(Shop.objects.filter(user_id=request.user.id).values_list('id', flat=True))
+        return Response(sales_report(shop_ids, date_from, date_to, top))
+
+
+class PartnerExportViewset(ReplicaReadMixin, viewsets.ViewSet):
+    """Viewset для потоковой выгрузки заказов и каталога поставщика в csv/xlsx"""
 
+    permission_classes = [IsAuthenticated, ShopPermission]
 
-class ContactViewset(viewsets.ModelViewSet):
+    def get_file_type(self):
+        file_type = self.request.query_params.get('file_type', 'csv')
+        return file_type if file_type in CONTENT_TYPES else None
+
+    # заказы с позициями
+    @action(detail=False)
+    def orders(self, request, *args, **kwargs):
+        file_type = self.get_file_type()
+        if not file_type:
+            return JsonResponse({'Status': False, 'Errors': 'Неподдерживаемый формат выгрузки'})
+
+        return export_response(file_type, 'orders', ORDER_HEADER, partner_order_rows(request.user.id))
+
+    # текущий каталог магазина
+    @action(detail=False)
+    def catalog(self, request, *args, **kwargs):
+        file_type = self.get_file_type()
+        if not file_type:
+            return JsonResponse({'Status': False, 'Errors': 'Неподдерживаемый формат выгрузки'})
+
+        shops = Shop.objects.filter(user_id=request.user.id)
+        shop_id = request.query_params.get('shop_id')
+        if shop_id:
+            shops = shops.filter(id=shop_id)
+        shop_ids = list(shops.values_list('id', flat=True))
+        if not shop_ids:
+            return JsonResponse({'Status': False, 'Errors': 'Магазин не найден'})
+
+        return export_response(file_type, 'catalog', CATALOG_HEADER, catalog_rows(shop_ids))
+
+    # предложения магазинов с ценой выше рекомендованной, нулевым остатком и выбросами цены
+    @action(detail=False)
+    def health(self, request, *args, **kwargs):
+        file_type = self.get_file_type()
+        if not file_type:
+            return JsonResponse({'Status': False, 'Errors': 'Неподдерживаемый формат выгрузки'})
+
+        shop_ids = list(Shop.objects.filter(user_id=request.user.id).values_list('id', flat=True))
+        return export_response(file_type, 'offer_health', HEALTH_HEADER, offer_health_rows(shop_ids))
+
+    # каталог магазина в формате прайса для partner/update
+    @action(detail=False)
+    def yaml(self, request, *args, **kwargs):
+        shops = Shop.objects.filter(user_id=request.user.id).order_by('id')
+        shop_id = request.query_params.get('shop_id')
+        if shop_id:
+            shops = shops.filter(id=shop_id)
+        shop = shops.first()
+        if not shop:
+            return JsonResponse({'Status': False, 'Errors': 'Магазин не найден'})
+
+        return price_list_response(shop)
+
+
+class ContactViewset(SparseFieldsMixin, viewsets.ModelViewSet):
     """Viewset для контактов"""
 
     permission_classes = [IsAuthenticated, IsOwner]
-    queryset = Contact.objects.all()
+    queryset = Contact.objects.all().order_by('id')
     serializer_class = ContactSerializer
 
     def get_queryset(self):
@@ -430,7 +729,7 @@ class ContactViewset(viewsets.ModelViewSet):
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
 
-class OrdersViewset(viewsets.ModelViewSet):
+class OrdersViewset(SparseFieldsMixin, OrderArchiveMixin, viewsets.ModelViewSet):
     """Viewset для заказов. В queryset фильтруем по ользователю, добавляем общую сумму с учетом доставки"""
 
     permission_classes = [IsAuthenticated, IsOwner]
@@ -438,29 +737,71 @@ class OrdersViewset(viewsets.ModelViewSet):
     serializer_class = OrdersSerializer
 
     def get_queryset(self):
-        return super().get_queryset().filter(user=self.request.user).exclude(state='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter').annotate(
+        queryset = super().get_queryset().filter(user=self.request.user).exclude(state='basket').annotate(
             total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price')) +
                       Count('ordered_items__product_info__shop', distinct=True) * DELIVERY).distinct()
+        if self.action == 'retrieve':
+            # фиксированный план: заказ с покупателем и адресом, позиции с предложениями, контакты покупателя.
+            # Имена магазинов берутся из справочника, число запросов не зависит от числа позиций
+            items = Prefetch('ordered_items', queryset=OrderItem.objects.select_related('product_info').order_by('id'))
+            if self.compact:
+                return queryset.prefetch_related(items)
+            return queryset.select_related('user', 'contact').prefetch_related(items, 'user__contacts')
+        return queryset
+
+    def get_archive_queryset(self):
+        queryset = ArchivedOrder.objects.filter(user=self.request.user).annotate(
+            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price')) +
+                      Count('ordered_items__product_info__shop', distinct=True) * DELIVERY)
+        if self.action == 'retrieve':
+            items = Prefetch('ordered_items',
+                             queryset=ArchivedOrderItem.objects.select_related('product_info').order_by('id'))
+            return queryset.select_related('user', 'contact').prefetch_related(items, 'user__contacts')
+        return queryset
+
+    @property
+    def compact(self):
+        return strtobool(self.request.query_params.get('compact', 'false'))
 
     def create(self, request, *args, **kwargs):
         try:
-            is_updated = Order.objects.filter(
-                user_id=request.user.id, id=request.data['id']).update(
-                contact_id=request.data['contact'],
-                state='new')
+            with transaction.atomic():
+                order_id = int(request.data['id'])
+                order = None
+                if settings.BASKET_BACKEND == 'redis':
+                    order = RedisBasket(request.user.id).checkout(order_id, request.data['contact'])
+                    if order is False:
+                        return JsonResponse({'Status': False, 'Errors': 'В корзине нет доступных товаров'})
+                if order:
+                    is_updated, order_id, old_state = True, order.id, None
+                else:
+                    is_updated = Order.objects.filter(
+                        user_id=request.user.id, id=order_id, state='basket').update(
+                        contact_id=request.data['contact'],
+                        state='new')
+                    old_state = 'basket'
+                if is_updated:
+                    order_state_changed.send(sender=Order, order_id=order_id, old_state=old_state, new_state='new')
+                    # письмо о заказе не уйдет, если транзакция откатится
+                    enqueue(new_order, user_id=request.user.id, order_id=order_id)
 
         except IntegrityError as error:
             return JsonResponse({'Status': False, 'Errors': 'Неправильно указаны аргументы'})
         else:
             if is_updated:
-                new_order.delay(user_id=request.user.id)
                 return JsonResponse({'Status': True})
 
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
+    # ?compact=true - без данных покупателя, позиции плоским списком
     def retrieve(self, request, *args, **kwargs):
-        instance = self.get_object()
-        serializer = OrderSerializer(instance)
-        return Response(serializer.data)
+        try:
+            self.compact
+        except ValueError:
+            raise ParseError('compact должен быть true или false')
+        return super().retrieve(request, *args, **kwargs)
+
+    def get_serializer_class(self):
+        if self.action == 'retrieve':
+            return CompactOrderSerializer if self.compact else OrderSerializer
+        return OrdersSerializer
@@ -0,0 +1,67 @@
+"""
+Замер префиксного индекса подсказок (backend.autocomplete) на синтетических именах:
+память индекса (tracemalloc), время построения, задержка запроса по длине префикса
+и время инкрементального обновления после загрузки прайса.
+
+Запуск: python benchmarks/bench_autocomplete.py [количество имён]
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'my_diplom.settings')
+django.setup()
+
+from backend.autocomplete import PrefixIndex  # noqa: E402
+
+WORDS = ('Смартфон', 'Телевизор', 'Ноутбук', 'Наушники', 'Чайник', 'Холодильник', 'Ёмкость', 'Apple', 'Samsung',
+         'Xiaomi', 'Philips', 'Bosch', 'Pro', 'Max', 'Lite', 'Ultra')
+QUERIES = 2000
+
+
+def names(count):
+    rng = random.Random(1)
+    return Counter({f'{rng.choice(WORDS)} {rng.choice(WORDS)} {i:x}/{rng.randrange(1000)}': rng.randrange(1, 50)
+                    for i in range(count)})
+
+
+def main(count):
+    counts = names(count)
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = PrefixIndex()
+    index.build(counts)
+    built = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f'names: {len(index.keys)}, build: {built:.2f} s, index memory: {memory / 2 ** 20:.1f} MiB')
+
+    rng = random.Random(2)
+    sample = rng.sample(list(counts), QUERIES)
+    for length in (1, 2, 3, 5, 10, 15):
+        timings = []
+        for name in sample:
+            start = time.perf_counter()
+            index.search(name[:length], 10)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(f'prefix {length:>2}: p50 {timings[len(timings) // 2] * 1e6:.0f} us, '
+              f'p99 {timings[len(timings) * 99 // 100] * 1e6:.0f} us')
+
+    # прайс магазина: тысяча новых имён и тысяча снятых с продажи
+    deltas = Counter({f'Новинка {i}': 1 for i in range(1000)})
+    deltas.update({name: -counts[name] for name in sample[:1000]})
+    start = time.perf_counter()
+    index.update(deltas)
+    print(f'update of {len(deltas)} names: {(time.perf_counter() - start) * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
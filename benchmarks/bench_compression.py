@@ -0,0 +1,75 @@
+"""
+Размер типичных ответов API: полный ответ и урезанный ?fields=/?exclude=, без сжатия, gzip и brotli
+(backend.compression). Данные создаются в транзакции и откатываются после замера.
+
+Запуск: python benchmarks/bench_compression.py [позиций в заказе]
+"""
+import os
+import sys
+from pathlib import Path
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'my_diplom.settings')
+django.setup()
+
+from django.db import transaction  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+from rest_framework.authtoken.models import Token  # noqa: E402
+from rest_framework.test import APIClient  # noqa: E402
+
+from backend.models import User, Contact, Shop, Category, Product, ProductInfo, Order, OrderItem  # noqa: E402
+
+OFFERS = 200
+
+
+class Rollback(Exception):
+    pass
+
+
+def fill(lines):
+    user = User.objects.create_user(email='bench@example.com', password='bench', first_name='Иван',
+                                    last_name='Петров', company='Bench', position='buyer', is_active=True)
+    contact = Contact.objects.create(user=user, city='Москва', street='Тверская', house='1', phone='+79000000000')
+    shop = Shop.objects.create(name='bench')
+    category = Category.objects.create(name='bench')
+    products = Product.objects.bulk_create(
+        Product(name=f'Смартфон Apple iPhone XS Max {i} ГБ', category=category) for i in range(OFFERS))
+    offers = ProductInfo.objects.bulk_create(
+        ProductInfo(product=product, shop=shop, external_id=i, model=f'apple/iphone/xs-max-{i}', quantity=10,
+                    price=100000 + i, price_rrc=110000 + i) for i, product in enumerate(products))
+    order = Order.objects.create(user=user, contact=contact, state='new')
+    OrderItem.objects.bulk_create(OrderItem(order=order, product_info=offer, quantity=1) for offer in offers[:lines])
+    token, _ = Token.objects.get_or_create(user=user)
+    return APIClient(HTTP_AUTHORIZATION='Token ' + token.key), order
+
+
+def sizes(client, url, params):
+    return [len(client.get(url, params, HTTP_ACCEPT_ENCODING=encoding).content)
+            for encoding in ('identity', 'gzip', 'br')]
+
+
+def main(lines):
+    setup_test_environment()
+    try:
+        with transaction.atomic():
+            client, order = fill(lines)
+            payloads = (
+                ('products', '/api/v1/products/', {}),
+                ('products fields=id,price,model', '/api/v1/products/', {'fields': 'id,price,model'}),
+                (f'order with {lines} lines', f'/api/v1/orders/{order.id}/', {}),
+                ('order exclude=user,phone,contact', f'/api/v1/orders/{order.id}/',
+                 {'exclude': 'user,phone,contact'}),
+            )
+            print(f'{"payload":<36}{"plain":>10}{"gzip":>10}{"br":>10}{"saved":>8}')
+            for name, url, params in payloads:
+                plain, gzip, br = sizes(client, url, params)
+                print(f'{name:<36}{plain:>10}{gzip:>10}{br:>10}{1 - br / plain:>8.0%}')
+            raise Rollback
+    except Rollback:
+        pass
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
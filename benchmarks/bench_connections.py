@@ -0,0 +1,49 @@
+"""
+Замер задержки запроса с постоянными соединениями и без них.
+Цикл повторяет жизненный цикл запроса Django: request_started -> запросы к базе -> request_finished,
+на request_finished Django закрывает соединение, если CONN_MAX_AGE истёк.
+
+Запуск: python benchmarks/bench_connections.py [количество запросов]
+"""
+import os
+import sys
+import time
+from pathlib import Path
+from statistics import median, quantiles
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'my_diplom.settings')
+django.setup()
+
+from django.core.signals import request_started, request_finished  # noqa: E402
+from django.db import connection  # noqa: E402
+
+from backend.models import Category  # noqa: E402
+
+
+def run(conn_max_age, count):
+    connection.close()
+    connection.settings_dict['CONN_MAX_AGE'] = conn_max_age
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        request_started.send(sender=None)
+        list(Category.objects.values_list('id', 'name')[:40])
+        request_finished.send(sender=None)
+        timings.append((time.perf_counter() - start) * 1000)
+    connection.close()
+    return timings
+
+
+def main(count):
+    print(f'{connection.vendor}, {count} requests')
+    for conn_max_age in (0, 60):
+        timings = run(conn_max_age, count)
+        print(f'CONN_MAX_AGE={conn_max_age}: p50 {median(timings):.3f} ms, '
+              f'p95 {quantiles(timings, n=20)[-1]:.3f} ms')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,47 @@
+"""
+Проверка прайса перед загрузкой (backend.importer.validate_price_list): скорость на большом прайсе
+без ошибок и с ошибкой в каждой сотой строке. База не используется.
+
+Запуск: python benchmarks/bench_feed_validation.py [количество товаров]
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'my_diplom.settings')
+django.setup()
+
+from backend.importer import validate_price_list  # noqa: E402
+
+
+def feed(count, broken_every=None):
+    goods = []
+    for i in range(count):
+        item = {'id': i, 'category': i % 50, 'model': f'model/{i}', 'name': f'Товар {i}', 'price': 1000 + i,
+                'price_rrc': 1100 + i, 'quantity': i % 20,
+                'parameters': {'Диагональ (дюйм)': 6.1, 'Цвет': 'черный', 'Память (Гб)': 256}}
+        if broken_every and i % broken_every == 0:
+            del item['price']
+        goods.append(item)
+    return {'shop': 'bench', 'categories': [{'id': i, 'name': f'Категория {i}'} for i in range(50)],
+            'goods': goods}
+
+
+def timed(data):
+    start = time.perf_counter()
+    errors = validate_price_list(data)
+    return time.perf_counter() - start, len(errors)
+
+
+def main(count):
+    for title, data in (('valid', feed(count)), ('1% broken', feed(count, broken_every=100))):
+        elapsed, errors = timed(data)
+        print(f'{title}: {count} goods, {errors} errors, {elapsed:.2f} s, {count / elapsed:,.0f} goods/s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
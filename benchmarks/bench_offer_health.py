@@ -0,0 +1,101 @@
+"""
+Замер отчёта о проблемных предложениях (backend.health).
+Сначала векторные проверки на синтетических порциях (миллионы предложений, без базы),
+затем полный проход через базу: данные создаются в транзакции и откатываются после замера.
+Пик памяти считаем через tracemalloc, numpy отчитывается в него о своих массивах.
+
+Запуск: python benchmarks/bench_offer_health.py [предложений в памяти] [предложений в базе]
+"""
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import django
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'my_diplom.settings')
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.db import transaction  # noqa: E402
+
+from backend.health import offer_health, offer_health_rows, OFFER_COLUMNS  # noqa: E402
+from backend.models import Shop, Category, Product, ProductInfo  # noqa: E402
+
+SHOPS = 20
+
+
+class Rollback(Exception):
+    pass
+
+
+def synthetic_chunks(count, chunk_size):
+    # у каждого продукта от 1 до SHOPS предложений, цены вокруг общей для продукта
+    rng = np.random.default_rng(1)
+    product_id = 0
+    for start in range(0, count, chunk_size):
+        size = min(chunk_size, count - start)
+        offers = np.empty((size, len(OFFER_COLUMNS)), dtype=np.int64)
+        per_product = rng.integers(1, SHOPS + 1, size // (SHOPS // 2) + SHOPS)
+        products = np.repeat(np.arange(product_id, product_id + len(per_product)), per_product)[:size]
+        product_id = products[-1] + 1
+        base = rng.integers(1000, 100000, product_id + 1)[products]
+        offers[:, 0] = np.arange(start, start + size)
+        offers[:, 1] = products
+        offers[:, 2] = rng.integers(1, SHOPS + 1, size)
+        offers[:, 3] = base * rng.uniform(0.7, 1.6, size)
+        offers[:, 4] = base * 1.2
+        offers[:, 5] = rng.integers(0, 50, size)
+        offers[:, 6] = rng.random(size) < 0.95
+        order = np.lexsort((offers[:, 3], offers[:, 1]))
+        yield offers[order]
+
+
+def bench_vectorized(count):
+    tracemalloc.start()
+    flagged = 0
+    elapsed = 0.0
+    for offers in synthetic_chunks(count, settings.HEALTH_CHUNK_SIZE):
+        start = time.perf_counter()
+        mask, _ = offer_health(offers, settings.HEALTH_OUTLIER_RATIO, settings.HEALTH_MIN_OFFERS)
+        elapsed += time.perf_counter() - start
+        flagged += int(mask.sum())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'vectorized: offers: {count}, flagged: {flagged}, time: {elapsed:.2f} s, '
+          f'{count / elapsed:.0f} offers/s, peak memory: {peak / 2 ** 20:.1f} MiB')
+
+
+def fill(count):
+    category = Category.objects.create(name='bench')
+    shops = [Shop.objects.create(name=f'bench {i}') for i in range(SHOPS)]
+    products = Product.objects.bulk_create(
+        (Product(name=f'product {i}', category=category) for i in range(count // SHOPS + 1)), batch_size=10000)
+    ProductInfo.objects.bulk_create(
+        (ProductInfo(product=products[i // SHOPS], shop=shops[i % SHOPS], external_id=i, quantity=i % 50,
+                     price=1000 + (i * 7919) % 2000, price_rrc=2500) for i in range(count)), batch_size=10000)
+
+
+def bench_database(count):
+    try:
+        with transaction.atomic():
+            fill(count)
+            tracemalloc.start()
+            start = time.perf_counter()
+            flagged = sum(1 for _ in offer_health_rows())
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'database: offers: {count}, flagged: {flagged}, time: {elapsed:.2f} s, '
+                  f'{count / elapsed:.0f} offers/s, peak memory: {peak / 2 ** 20:.1f} MiB')
+            raise Rollback
+    except Rollback:
+        pass
+
+
+if __name__ == '__main__':
+    bench_vectorized(int(sys.argv[1]) if len(sys.argv) > 1 else 5000000)
+    bench_database(int(sys.argv[2]) if len(sys.argv) > 2 else 200000)
@@ -0,0 +1,87 @@
+"""
+Фильтр по диапазону числового параметра: строковые значения (как хранилось раньше, Cast в запросе)
+против числовой колонки value_number с индексом. Данные создаются в транзакции и откатываются.
+
+Запуск: python benchmarks/bench_parameter_filter.py [количество товаров]
+"""
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'my_diplom.settings')
+django.setup()
+
+from django.db import transaction, connection  # noqa: E402
+from django.db.models import FloatField  # noqa: E402
+from django.db.models.functions import Cast  # noqa: E402
+
+from backend.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter  # noqa: E402
+
+
+class Rollback(Exception):
+    pass
+
+
+def fill(count):
+    shop = Shop.objects.create(name='bench')
+    category = Category.objects.create(name='bench')
+    old = Parameter.objects.create(name='bench string', type='string')
+    new = Parameter.objects.create(name='bench number', type='number')
+    products = Product.objects.bulk_create(Product(name=f'product {i}', category=category) for i in range(count))
+    infos = ProductInfo.objects.bulk_create(
+        ProductInfo(product=product, shop=shop, external_id=i, quantity=1, price=1, price_rrc=1)
+        for i, product in enumerate(products))
+    values = [round(random.uniform(4, 8), 1) for _ in infos]
+    ProductParameter.objects.bulk_create(
+        (ProductParameter(product_info=info, parameter=old, value=str(value)) for info, value in zip(infos, values)),
+        batch_size=10000)
+    ProductParameter.objects.bulk_create(
+        (ProductParameter(product_info=info, parameter=new, value='', value_number=value)
+         for info, value in zip(infos, values)), batch_size=10000)
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE backend_productparameter')
+    return old, new
+
+
+def timed(queryset, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        count = len(list(queryset.values_list('product_info_id', flat=True)))
+    return (time.perf_counter() - start) / repeat * 1000, count
+
+
+def column_bytes(parameter, column):
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT sum(pg_column_size({column})) FROM backend_productparameter WHERE parameter_id = %s',
+                       [parameter.id])
+        return cursor.fetchone()[0]
+
+
+def main(count):
+    try:
+        with transaction.atomic():
+            old, new = fill(count)
+            old_ms, old_count = timed(ProductParameter.objects.filter(parameter=old).annotate(
+                number=Cast('value', FloatField())).filter(number__gte=6, number__lte=6.5))
+            new_ms, new_count = timed(ProductParameter.objects.filter(
+                parameter=new, value_number__gte=6, value_number__lte=6.5))
+            assert old_count == new_count
+            print(f'{connection.vendor}, {count} offers, {new_count} matches')
+            print(f'string value + Cast: {old_ms:.1f} ms, value bytes: {column_bytes(old, "value")}')
+            print(f'value_number index:  {new_ms:.1f} ms, value bytes: '
+                  f'{column_bytes(new, "value") and column_bytes(new, "value") + column_bytes(new, "value_number")}')
+            raise Rollback
+    except Rollback:
+        pass
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
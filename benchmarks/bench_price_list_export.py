@@ -0,0 +1,61 @@
+"""
+Замер скорости выгрузки каталога в формате прайса (shop.yaml).
+Данные создаются в транзакции и откатываются после замера.
+
+Запуск: python benchmarks/bench_price_list_export.py [количество товаров]
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'my_diplom.settings')
+django.setup()
+
+from django.db import transaction, connection  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+
+from backend.exports import stream_price_list  # noqa: E402
+from backend.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter  # noqa: E402
+
+
+class Rollback(Exception):
+    pass
+
+
+def fill(count):
+    shop = Shop.objects.create(name='bench')
+    category = Category.objects.create(name='bench')
+    category.shops.add(shop)
+    parameters = [Parameter.objects.create(name=f'bench {i}') for i in range(4)]
+    products = Product.objects.bulk_create(
+        Product(name=f'product {i}', category=category) for i in range(count))
+    infos = ProductInfo.objects.bulk_create(
+        ProductInfo(product=product, shop=shop, external_id=i, model=f'model/{i}', quantity=i % 50,
+                    price=1000 + i, price_rrc=1100 + i) for i, product in enumerate(products))
+    ProductParameter.objects.bulk_create(
+        (ProductParameter(product_info=info, parameter=parameter, value=str(i))
+         for info in infos for i, parameter in enumerate(parameters)), batch_size=10000)
+    return shop
+
+
+def main(count):
+    try:
+        with transaction.atomic():
+            shop = fill(count)
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                size = sum(len(chunk) for chunk in stream_price_list(shop))
+                elapsed = time.perf_counter() - start
+            print(f'goods: {count}, size: {size / 2 ** 20:.1f} MiB, time: {elapsed:.2f} s, '
+                  f'{count / elapsed:.0f} goods/s, queries: {len(queries)}')
+            raise Rollback
+    except Rollback:
+        pass
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
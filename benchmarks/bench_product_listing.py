@@ -0,0 +1,85 @@
+"""
+Выдача каталога (COUNT для пагинации и первая страница): живая версия каталога и статус магазина
+через соединение с магазинами (version = shop.catalog_version, shop__state) против одного флага
+ProductInfo.is_active, которым фильтрует ProductInfoViewset.
+У части магазинов рядом лежит прежняя (выключенная) версия каталога, которую ещё не удалила фоновая задача.
+Данные создаются в транзакции и откатываются.
+
+Запуск: python benchmarks/bench_product_listing.py [количество предложений] [количество магазинов]
+"""
+import os
+import sys
+import time
+from pathlib import Path
+from statistics import median
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'my_diplom.settings')
+django.setup()
+
+from django.db import transaction, connection  # noqa: E402
+from django.db.models import F  # noqa: E402
+
+from backend.models import Shop, Category, Product, ProductInfo  # noqa: E402
+
+
+class Rollback(Exception):
+    pass
+
+
+# у каждого пятого магазина ещё лежит прежняя версия каталога
+OLD_VERSION_EVERY = 5
+
+
+def offers(products, shops, version):
+    for i, product in enumerate(products):
+        shop = shops[i % len(shops)]
+        if version == shop.catalog_version or i % len(shops) % OLD_VERSION_EVERY == 0:
+            yield ProductInfo(product=product, shop=shop, external_id=i, quantity=1, price=1, price_rrc=1,
+                              is_active=shop.state and version == shop.catalog_version, version=version)
+
+
+def fill(count, shop_count):
+    shops = Shop.objects.bulk_create(Shop(name=f'bench {i}', state=i % 4 != 0, catalog_version=2)
+                                     for i in range(shop_count))
+    category = Category.objects.create(name='bench')
+    products = Product.objects.bulk_create(Product(name=f'product {i}', category=category) for i in range(count))
+    for version in (1, 2):
+        ProductInfo.objects.bulk_create(offers(products, shops, version), batch_size=10000)
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE backend_productinfo')
+            cursor.execute('ANALYZE backend_shop')
+
+
+def listing(queryset, repeat=20):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        queryset.count()
+        list(queryset.order_by('id').values_list('id', flat=True)[:40])
+        timings.append((time.perf_counter() - start) * 1000)
+    return median(timings)
+
+
+def main(count, shop_count):
+    try:
+        with transaction.atomic():
+            fill(count, shop_count)
+            join = ProductInfo.objects.filter(version=F('shop__catalog_version'), shop__state=True)
+            flag = ProductInfo.objects.visible()
+            assert join.count() == flag.count()
+            join_ms = listing(join)
+            flag_ms = listing(flag)
+            print(f'{connection.vendor}, {ProductInfo.objects.count()} offers, {shop_count} shops')
+            print(f'live version + shop__state join: {join_ms:.1f} ms')
+            print(f'is_active flag:                  {flag_ms:.1f} ms')
+            raise Rollback
+    except Rollback:
+        pass
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000, int(sys.argv[2]) if len(sys.argv) > 2 else 50)
@@ -45,10 +45,12 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'backend.compression.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'backend.routers.PrimaryPinMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -79,16 +81,53 @@ WSGI_APPLICATION = 'my_diplom.wsgi.application'
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
 
+# DB_POOL_MODE=pgbouncer: веб и celery воркеры ходят в базу через pgbouncer (transaction pooling).
+# В этом режиме серверные курсоры недоступны, а обычный курсор psycopg2 получает весь результат в память,
+# так что iterator(chunk_size) память не ограничивает. Выгрузки тогда читают порциями по ключу
+# (backend.exports.keyset_rows)
+DB_POOL_MODE = os.environ.get('DB_POOL_MODE', 'none')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
-        'NAME': '***',
-        'USER': '***',
-        'PASSWORD': '***',
-        'HOST': 'localhost',
+        'NAME': os.environ.get('DB_NAME', '***'),
+        'USER': os.environ.get('DB_USER', '***'),
+        'PASSWORD': os.environ.get('DB_PASSWORD', '***'),
+        'HOST': os.environ.get('DB_HOST', 'localhost'),
+        'PORT': os.environ.get('DB_PORT', ''),
+        # постоянные соединения: не открываем новое соединение на каждый запрос и задачу
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+        # проверка живости соединения перед повторным использованием (backend.signals)
+        'CONN_HEALTH_CHECKS': os.environ.get('DB_CONN_HEALTH_CHECKS', 'true').lower() == 'true',
+        'DISABLE_SERVER_SIDE_CURSORS': DB_POOL_MODE == 'pgbouncer',
+        'OPTIONS': {
+            'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 5)),
+        },
     }
 }
 
+# Реплика для чтения каталога и отчетов. Пока DB_REPLICA_HOST не задан, все запросы идут в основную базу
+DATABASES['replica'] = {
+    **DATABASES['default'],
+    'HOST': os.environ.get('DB_REPLICA_HOST', DATABASES['default']['HOST']),
+    'TEST': {'MIRROR': 'default'},
+}
+# Прямое подключение к основной базе мимо pgbouncer (DB_DIRECT_HOST, DB_DIRECT_PORT) для сессионных блокировок
+DATABASES['direct'] = {
+    **DATABASES['default'],
+    'HOST': os.environ.get('DB_DIRECT_HOST', DATABASES['default']['HOST']),
+    'PORT': os.environ.get('DB_DIRECT_PORT', DATABASES['default']['PORT']),
+    'DISABLE_SERVER_SIDE_CURSORS': False,
+    'TEST': {'MIRROR': 'default'},
+}
+DATABASE_ROUTERS = ['backend.routers.ReplicaRouter']
+# CONN_HEALTH_CHECKS: соединение проверяем, только если по нему не было запросов столько секунд
+DB_HEALTH_CHECK_IDLE_SECONDS = 10
+REPLICA_DATABASE = 'replica'
+REPLICA_READS = 'DB_REPLICA_HOST' in os.environ
+# сколько секунд после записи пользователь читает с основной базы
+REPLICA_STICKY_SECONDS = 10
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -167,6 +206,17 @@ REST_FRAMEWORK = {
 
 }
 
+# размер порции серверного курсора или запроса по ключу (через pgbouncer) при потоковых выгрузках
+EXPORT_CHUNK_SIZE = 2000
+
+# сжатие ответов (backend.compression): меньшие ответы не сжимаем, качество brotli - компромисс для
+# динамических ответов (11 - максимум, но в разы медленнее)
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_BROTLI_QUALITY = 5
+
+# операций в одном запросе batch (backend.batch)
+BATCH_MAX_OPERATIONS = 20
+
 # REDIS related settings
 REDIS_HOST = 'localhost'
 REDIS_PORT = '6379'
@@ -175,4 +225,114 @@ CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 3600}
 CELERY_RESULT_BACKEND = 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/0'
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
-CELERY_RESULT_SERIALIZER = 'json'
\ No newline at end of file
+CELERY_RESULT_SERIALIZER = 'json'
+
+# Общий кэш процессов (закрепление за основной базой, версии справочников и каталога, throttling).
+# DJANGO_CACHE=redis обязателен, если процессов больше одного (gunicorn с воркерами, celery):
+# кэш в памяти у каждого процесса свой, и изменения справочников, статуса и каталога магазина
+# из другого процесса не сбрасывают его справочники и подсказки, а лимиты запросов считаются по процессам.
+# Без DJANGO_CACHE - кэш в памяти процесса, только для разработки в одном процессе
+if os.environ.get('DJANGO_CACHE') == 'redis':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/1',
+        }
+    }
+
+# Корзины: db - заказы со статусом basket, redis - хеши в redis с TTL, в базу при оформлении заказа
+BASKET_BACKEND = os.environ.get('BASKET_BACKEND', 'db')
+BASKET_REDIS_URL = 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/2'
+BASKET_TTL = 7 * 24 * 3600
+
+# справочники (категории, параметры, магазины) в памяти процесса
+REFERENCE_CACHE_MAX_SIZE = 10000
+REFERENCE_CACHE_CHECK_SECONDS = 5
+
+# подсказки поиска (backend.autocomplete): индекс в памяти процесса сверяется с версией каталога
+# не чаще раза в AUTOCOMPLETE_CHECK_SECONDS, ответы на префиксы с числом совпадений больше
+# AUTOCOMPLETE_REMEMBER_MATCHES запоминаются до изменения индекса
+AUTOCOMPLETE_CHECK_SECONDS = 5
+AUTOCOMPLETE_REMEMBER_MATCHES = 1000
+AUTOCOMPLETE_LIMIT = 10
+
+CELERY_IMPORTS = ('backend.mail_service', 'backend.outbox', 'backend.importer', 'backend.catalog',
+                  'backend.maintenance', 'backend.recommendations',)
+# Очереди celery, каждую должен слушать хотя бы один воркер:
+#   celery -A backend worker -Q default - публикация outbox (relay_outbox_task), уборка, архив заказов,
+#     рекомендации; без него события outbox не публикуются и письма не уходят
+#   celery -A backend worker -Q mail_transactional - письма регистрации, сброса пароля и заказа
+#   celery -A backend worker -Q mail_bulk - массовые рассылки
+#   celery -A backend worker -Q imports -c <N> - загрузка прайсов и удаление старых версий каталога
+#   celery -A backend beat - расписание CELERY_BEAT_SCHEDULE
+# На одной машине очереди можно слушать одним воркером: celery -A backend worker -Q default,mail_transactional
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_ROUTES = {
+    'backend.mail_service.new_user_registered': {'queue': 'mail_transactional'},
+    'backend.mail_service.password_reset_token_created': {'queue': 'mail_transactional'},
+    'backend.mail_service.new_order': {'queue': 'mail_transactional'},
+    'backend.mail_service.send_mail_chunk': {'queue': 'mail_bulk'},
+    'backend.importer.import_price_list_task': {'queue': 'imports'},
+    'backend.catalog.collect_catalog_versions_task': {'queue': 'imports'},
+}
+# результаты писем никто не читает, не храним их в redis
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_RESULT_EXPIRES = 3600
+MAIL_TRANSACTIONAL_RATE_LIMIT = '120/m'
+MAIL_BULK_RATE_LIMIT = '30/m'
+MAIL_BULK_CHUNK_SIZE = 100
+
+# Загрузка прайсов: celery -A backend worker -Q imports -c <N>, разные магазины грузятся параллельно.
+# PRICE_IMPORT_ASYNC=false - partner/update загружает прайс в запросе (как раньше)
+PRICE_IMPORT_ASYNC = os.environ.get('PRICE_IMPORT_ASYNC', 'false').lower() == 'true'
+# блокировка магазина на время загрузки - сессионная advisory-блокировка postgres (backend.importer).
+# pgbouncer в режиме transaction pooling не сохраняет сессию, поэтому блокировки берём через прямое подключение
+IMPORT_LOCK_DATABASE = 'direct' if DB_POOL_MODE == 'pgbouncer' else 'default'
+IMPORT_RETRY_SECONDS = 30
+# старые версии каталога магазина удаляются порциями в фоне
+CATALOG_GC_BATCH_SIZE = 1000
+
+# Outbox: события из базы публикует в брокер задача relay_outbox_task (по расписанию beat, очередь default)
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_BATCHES = 50
+CELERY_BEAT_SCHEDULE = {
+    'relay-outbox': {
+        'task': 'backend.outbox.relay_outbox_task',
+        'schedule': 1.0,
+    },
+    'sweep-expired': {
+        'task': 'backend.maintenance.sweep_expired_task',
+        'schedule': 3600.0,
+    },
+    'archive-orders': {
+        'task': 'backend.maintenance.archive_orders_task',
+        'schedule': 3600.0,
+    },
+    'rebuild-recommendations': {
+        'task': 'backend.recommendations.rebuild_recommendations_task',
+        'schedule': 24 * 3600.0,
+    },
+}
+
+# Уборка устаревших строк (backend.maintenance): сроки хранения и порции удаления
+BASKET_RETENTION_DAYS = 30
+CONFIRM_TOKEN_RETENTION_DAYS = 7
+RESET_TOKEN_RETENTION_HOURS = 24
+OUTBOX_RETENTION_DAYS = 7
+SWEEP_BATCH_SIZE = 1000
+SWEEP_MAX_BATCHES = 100
+# доставленные и отменённые заказы старше срока переносятся в архивные таблицы
+ORDER_ARCHIVE_AFTER_DAYS = 180
+ORDER_ARCHIVE_BATCH_SIZE = 500
+
+# Отчёт о проблемных предложениях (backend.health): цена дальше HEALTH_OUTLIER_RATIO от медианы продукта
+# считается выбросом, если продукт продают хотя бы HEALTH_MIN_OFFERS магазинов
+HEALTH_OUTLIER_RATIO = 0.5
+HEALTH_MIN_OFFERS = 3
+HEALTH_CHUNK_SIZE = 100000
+
+# "Покупают вместе" (backend.recommendations): соседей на продукт, заказы крупнее RECOMMENDATION_MAX_ORDER_LINES
+# позиций не учитываются. Между ночными пересчётами список дополняется по новым заказам
+RECOMMENDATION_TOP_K = 10
+RECOMMENDATION_MAX_ORDER_LINES = 50
+RECOMMENDATION_CHUNK_SIZE = 100000
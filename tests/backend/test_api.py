@@ -1,8 +1,52 @@
+import gzip
+import json
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+
+import brotli
 import pytest
 
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connections
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_rest_passwordreset.models import ResetPasswordToken
+from kombu import Connection
+from kombu.exceptions import OperationalError as KombuOperationalError
+from openpyxl import load_workbook
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
-from backend.models import User, Contact
+from yaml import load as load_yaml, dump as yaml_dump, Loader
+from backend import reference
+from backend.autocomplete import autocomplete
+from backend.baskets import RedisBasket, DELIVERY
+from backend.catalog import catalog_version, collect_catalog_versions, collect_catalog_versions_task
+from backend.celery import app
+from backend.exports import stream_price_list
+from backend.importer import import_price_list, import_price_list_task, run_import_job, acquire_shop_lock, \
+    release_shop_lock, ShopImportLocked, validate_price_list
+from backend.mail_service import new_order, send_bulk_mail
+from backend.maintenance import sweep_expired, archive_orders
+from backend.outbox import enqueue, relay_outbox
+from backend.recommendations import update_order_recommendations_task
+from backend.models import User, Contact, ProductInfo, Order, OrderItem, Shop, Parameter, ProductParameter, \
+    BestOffer, OutboxEvent, ImportJob, ConfirmEmailToken, ArchivedOrder, ArchivedOrderItem, ShopDailySales, \
+    ShopDailyProductSales, ProductRecommendation
+from backend.signals import close_unusable_connections, order_state_changed
+
+
+@pytest.fixture(autouse=True)
+def reference_cache():
+    # справочники в памяти и общий кэш (счётчики throttling, версии) живут дольше транзакции теста
+    for reference_cache in (reference.categories, reference.parameters, reference.shops, autocomplete):
+        reference_cache.clear()
+    cache.clear()
 
 
 @pytest.fixture
@@ -190,3 +234,723 @@ def test_get_orders(client_token, update_pricelist):
     response = client_token.get('/api/v1/orders/')
     data = response.json()
     assert len(data['results']) == 0
+
+
+@pytest.mark.django_db
+def test_partner_export_catalog_csv(client_token_shop, update_pricelist):
+    response = client_token_shop.get('/api/v1/partner/export/catalog/')
+    lines = b''.join(response.streaming_content).decode().splitlines()
+    assert response['Content-Type'] == 'text/csv'
+    assert len(lines) == ProductInfo.objects.count() + 1
+
+
+@pytest.mark.django_db
+def test_exports_without_server_side_cursors(client_token, client_token_shop, update_pricelist, contacts,
+                                             settings, monkeypatch):
+    items = [{'product_info': product_info_id, 'quantity': 1} for product_info_id in
+             ProductInfo.objects.values_list('id', flat=True)[:3]]
+    client_token.post('/api/v1/basket/', {'items': [json.dumps(items)]})
+    basket = Order.objects.get(state='basket')
+    client_token.post('/api/v1/orders/', {'id': basket.id, 'contact': contacts.id})
+    urls = ('/api/v1/partner/export/catalog/', '/api/v1/partner/export/orders/', '/api/v1/partner/export/yaml/')
+    expected = [b''.join(client_token_shop.get(url).streaming_content) for url in urls]
+
+    # через pgbouncer выгрузки читают порциями по ключу, результат тот же
+    settings.EXPORT_CHUNK_SIZE = 2
+    monkeypatch.setitem(connections['default'].settings_dict, 'DISABLE_SERVER_SIDE_CURSORS', True)
+    with CaptureQueriesContext(connections['default']) as queries:
+        assert [b''.join(client_token_shop.get(url).streaming_content) for url in urls] == expected
+    assert sum('LIMIT 2' in query['sql'] for query in queries) > len(urls)
+
+
+@pytest.mark.django_db
+def test_partner_export_orders_xlsx(client_token, client_token_shop, update_pricelist, contacts):
+    client_token.post('/api/v1/basket/', {'items': ['[{"product_info": "2", "quantity": "2"}]']})
+    basket = Order.objects.get(state='basket')
+    client_token.post('/api/v1/orders/', {'id': basket.id, 'contact': contacts.id})
+    response = client_token_shop.get('/api/v1/partner/export/orders/', data={'file_type': 'xlsx'})
+    sheet = load_workbook(BytesIO(b''.join(response.streaming_content)), read_only=True).active
+    rows = list(sheet.values)
+    assert len(rows) == 2 and rows[1][0] == basket.id and rows[1][-1] == 2 * rows[1][-2]
+
+
+def catalog_snapshot():
+    return sorted(ProductInfo.objects.live().values_list(
+        'shop__name', 'external_id', 'product__name', 'product__category_id', 'model', 'price', 'price_rrc',
+        'quantity')) + sorted(ProductParameter.objects.filter(
+        product_info__version=F('product_info__shop__catalog_version')).values_list(
+        'product_info__external_id', 'parameter__name', 'parameter__type', 'value', 'value_number'))
+
+
+@pytest.mark.django_db
+def test_price_list_yaml_round_trip(client_token_shop, user_shop, update_pricelist, django_assert_max_num_queries):
+    with open(settings.BASE_DIR / 'shop.yaml', 'rb') as f:
+        source = load_yaml(f, Loader=Loader)
+    shop = Shop.objects.get(user=user_shop)
+
+    with django_assert_max_num_queries(6):
+        exported = ''.join(stream_price_list(shop))
+    data = load_yaml(exported, Loader=Loader)
+    assert data['shop'] == source['shop']
+    assert sorted(data['categories'], key=lambda c: c['id']) == sorted(source['categories'], key=lambda c: c['id'])
+    assert data['goods'] == source['goods']
+
+    snapshot = catalog_snapshot()
+    import_price_list(data, user_shop.id, shop.url)
+    assert catalog_snapshot() == snapshot
+    assert ''.join(stream_price_list(shop)) == exported
+
+    response = client_token_shop.get('/api/v1/partner/export/yaml/')
+    assert b''.join(response.streaming_content).decode() == exported
+
+
+@pytest.mark.django_db(transaction=True, databases=['default', 'replica'])
+def test_replica_reads_and_sticky_primary(client_token, update_pricelist, contacts, settings):
+    settings.REPLICA_READS = True
+    cache.clear()
+    with CaptureQueriesContext(connections['replica']) as replica_queries:
+        response = client_token.get('/api/v1/products/')
+    assert response.json()['count'] > 0 and len(replica_queries) > 0
+
+    product_info_id = ProductInfo.objects.first().id
+    client_token.post('/api/v1/basket/', {'items': [f'[{{"product_info": {product_info_id}, "quantity": 2}}]']})
+    with CaptureQueriesContext(connections['replica']) as replica_queries:
+        client_token.get('/api/v1/products/')
+    assert len(replica_queries) == 0
+
+    cache.clear()
+    with CaptureQueriesContext(connections['replica']) as replica_queries:
+        client_token.get('/api/v1/basket/')
+    assert len(replica_queries) == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_unusable_connection_closed(monkeypatch):
+    connection = connections['default']
+    connection.ensure_connection()
+    checks, closed = [], []
+    monkeypatch.setitem(connection.settings_dict, 'CONN_HEALTH_CHECKS', True)
+    monkeypatch.setattr(connection, 'is_usable', lambda: checks.append(True) or False)
+    monkeypatch.setattr(connection, 'close', lambda: closed.append(True))
+    # соединение только что выполнило запрос: не проверяем
+    User.objects.exists()
+    close_unusable_connections()
+    assert not checks and not closed
+
+    monkeypatch.setattr(connection, 'alive_at', time.monotonic() - settings.DB_HEALTH_CHECK_IDLE_SECONDS - 1,
+                        raising=False)
+    close_unusable_connections()
+    assert checks and closed
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('model', ['productinfo', 'productparameter', 'order', 'orderitem'])
+def test_admin_changelist_queries(client, client_token, update_pricelist, contacts, model,
+                                  django_assert_max_num_queries):
+    items = [{'product_info': product_info_id, 'quantity': 1} for product_info_id in
+             ProductInfo.objects.values_list('id', flat=True)]
+    client_token.post('/api/v1/basket/', {'items': [json.dumps(items)]})
+    assert OrderItem.objects.count() == len(items)
+    admin_user = User.objects.create_superuser(email='admin@eoscast.com', password='12345678A', is_active=True)
+    client.force_login(admin_user)
+    with django_assert_max_num_queries(8):
+        response = client.get(f'/admin/backend/{model}/')
+    assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_find_product_by_parameter_range(client, update_pricelist):
+    diagonal = Parameter.objects.get(name='Диагональ (дюйм)')
+    color = Parameter.objects.get(name='Цвет')
+    assert diagonal.type == 'number' and color.type == 'string'
+
+    response = client.get('/api/v1/products/', data={'parameter_id': diagonal.id, 'value_min': 6, 'value_max': 6.2})
+    expected = ProductParameter.objects.filter(parameter=diagonal, value_number__gte=6, value_number__lte=6.2)
+    assert response.json()['count'] == expected.count() > 0
+
+    response = client.get('/api/v1/products/', data={'parameter_id': diagonal.id, 'value_min': 'big'})
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_price_changes_since_cursor(client, user_shop, update_pricelist):
+    response = client.get('/api/v1/prices/changes/')
+    data = response.json()
+    assert len(data['results']) == ProductInfo.objects.count()
+    assert {change['change'] for change in data['results']} == {'created'}
+
+    with open(settings.BASE_DIR / 'shop.yaml', 'rb') as f:
+        source = load_yaml(f, Loader=Loader)
+    source['goods'][0]['price'] += 100
+    removed = source['goods'].pop()
+    shop = Shop.objects.get(user=user_shop)
+    import_price_list(source, user_shop.id, shop.url)
+
+    response = client.get('/api/v1/prices/changes/', data={'cursor': data['cursor']})
+    changes = response.json()['results']
+    assert [(change['change'], change['external_id']) for change in changes] == [
+        ('updated', source['goods'][0]['id']), ('deleted', removed['id'])]
+    assert changes[0]['price'] == source['goods'][0]['price']
+
+    # журнал только для чтения
+    assert client.delete(f'/api/v1/prices/changes/{changes[0]["id"]}/').status_code == 405
+    assert client.patch(f'/api/v1/prices/changes/{changes[0]["id"]}/', {'price': 1}).status_code == 405
+
+
+@pytest.mark.django_db
+def test_best_offers(client, client_token_shop, update_pricelist, django_assert_num_queries):
+    product_info = ProductInfo.objects.order_by('price').first()
+    offers = ProductInfo.objects.filter(product_id=product_info.product_id)
+    with django_assert_num_queries(1):
+        response = client.get(f'/api/v1/best_offers/{product_info.product_id}/')
+    data = response.json()
+    assert data['price'] == product_info.price and data['offer_count'] == offers.count()
+    assert BestOffer.objects.count() == ProductInfo.objects.values('product_id').distinct().count()
+
+    client_token_shop.post('/api/v1/partner/state/', data={'state': 'off'})
+    assert BestOffer.objects.count() == 0
+    client_token_shop.post('/api/v1/partner/state/', data={'state': 'on'})
+    call_command('rebuild_best_offers', stdout=StringIO())
+    response = client.get('/api/v1/best_offers/', data={'product_id': product_info.product_id})
+    assert response.json()['results'][0]['product_info'] == offers.order_by('price', 'id').first().id
+    # витрина пересчитывается только сигналами и командой
+    assert client.patch(f'/api/v1/best_offers/{product_info.product_id}/', {'price': 1}).status_code == 405
+    assert client.delete(f'/api/v1/best_offers/{product_info.product_id}/').status_code == 405
+
+
+@pytest.mark.django_db
+def test_partner_state_hides_catalog(client, client_token_shop, update_pricelist, django_capture_on_commit_callbacks):
+    version = catalog_version()
+    with django_capture_on_commit_callbacks(execute=True):
+        client_token_shop.post('/api/v1/partner/state/', data={'state': 'off'})
+    assert not ProductInfo.objects.filter(is_active=True).exists()
+    assert client.get('/api/v1/products/').json()['count'] == 0
+    assert catalog_version() > version
+
+    client_token_shop.post('/api/v1/partner/state/', data={'state': 'on'})
+    assert client.get('/api/v1/products/').json()['count'] == ProductInfo.objects.count()
+
+
+@pytest.mark.django_db
+def test_order_mail_through_outbox(client_token, update_pricelist, contacts, monkeypatch):
+    monkeypatch.setattr(new_order, 'delay', lambda **kwargs: pytest.fail('broker called from request'))
+    client_token.post('/api/v1/basket/', {'items': ['[{"product_info": "2", "quantity": "2"}]']})
+    basket = Order.objects.get(state='basket')
+    client_token.post('/api/v1/orders/', {'id': basket.id, 'contact': contacts.id})
+    event = OutboxEvent.objects.get(task=new_order.name)
+    assert event.kwargs == {'user_id': basket.user_id, 'order_id': basket.id} and event.published_at is None
+
+    monkeypatch.setitem(app.conf, 'CELERY_TASK_ALWAYS_EAGER', False)
+    # вместе с письмом публикуется и удаление прежней версии каталога после загрузки прайса
+    pending = OutboxEvent.objects.filter(published_at__isnull=True).count()
+    with Connection('memory://') as connection:
+        assert relay_outbox(connection=connection) == pending
+        message = connection.SimpleQueue('mail_transactional').get(timeout=1)
+        assert message.headers['task'] == new_order.name
+    event.refresh_from_db()
+    assert event.published_at is not None
+    assert relay_outbox() == 0
+
+
+@pytest.mark.django_db
+def test_outbox_keeps_events_when_broker_down(user, monkeypatch):
+    def broker_down(*args, **kwargs):
+        raise KombuOperationalError('broker is down')
+
+    enqueue(new_order, user_id=user.id, order_id=1)
+    monkeypatch.setattr(app, 'send_task', broker_down)
+    assert relay_outbox() == 0
+    event = OutboxEvent.objects.get()
+    assert event.published_at is None and event.attempts == 1
+
+
+@pytest.mark.django_db
+def test_bulk_mail_chunks(user, user_shop, settings, monkeypatch):
+    settings.MAIL_BULK_CHUNK_SIZE = 1
+    monkeypatch.setitem(app.conf, 'CELERY_TASK_ALWAYS_EAGER', True)
+    result = send_bulk_mail('Новости', 'Текст', [user.id, user_shop.id])
+    assert len(result.results) == 2
+    assert sorted(message.to[0] for message in mail.outbox) == sorted([user.email, user_shop.email])
+
+
+@pytest.mark.django_db
+def test_product_listing_uses_reference_cache(client, update_pricelist):
+    with CaptureQueriesContext(connections['default']) as cold:
+        client.get('/api/v1/products/')
+    with CaptureQueriesContext(connections['default']) as warm:
+        data = client.get('/api/v1/products/').json()
+    assert len(warm) == len(cold) - 1 == 2
+    # видимость предложения - флаг is_active, выдача не соединяется с магазинами
+    assert not any('"backend_shop"' in query['sql'] for query in warm.captured_queries)
+    assert {product['shop'] for product in data['results']} == set(Shop.objects.values_list('name', flat=True))
+
+
+@pytest.mark.django_db
+def test_import_queue_lock_per_shop(client, client_token_shop, user_shop, update_pricelist, settings):
+    shop = Shop.objects.get(user=user_shop)
+    assert update_pricelist.json() == {'Status': True, 'Job': ImportJob.objects.get().id}
+    settings.PRICE_IMPORT_ASYNC = True
+    url = shop.url
+    job_id = client_token_shop.post('/api/v1/partner/update/', data={'url': url}).json()['Job']
+    assert OutboxEvent.objects.get(task=import_price_list_task.name).kwargs == {'job_id': job_id}
+
+    # магазин занят другой загрузкой: задание остаётся в очереди до повтора
+    assert acquire_shop_lock(shop.id, 0)
+    with pytest.raises(ShopImportLocked):
+        run_import_job(job_id)
+    release_shop_lock(shop.id, 0)
+    job = run_import_job(job_id)
+    assert job.state == 'done' and job.shop_id == shop.id and job.duration is not None
+
+    # из двух фидов одного магазина загружается только свежий
+    first = client_token_shop.post('/api/v1/partner/update/', data={'url': url}).json()['Job']
+    second = client_token_shop.post('/api/v1/partner/update/', data={'url': url}).json()['Job']
+    assert run_import_job(first).state == 'skipped'
+    admin_user = User.objects.create_superuser(email='admin@eoscast.com', password='12345678A', is_active=True)
+    client.force_authenticate(admin_user)
+    metrics = client.get('/api/v1/partner/imports/metrics/').json()
+    assert [(row['shop_id'], row['queued'], row['running']) for row in metrics] == [(shop.id, 1, 0)]
+    assert run_import_job(second).state == 'done'
+
+    # воркер упал посреди загрузки: повторная доставка задания ждёт блокировку и загружает заново
+    interrupted = client_token_shop.post('/api/v1/partner/update/', data={'url': url}).json()['Job']
+    ImportJob.objects.filter(id=interrupted).update(state='running', shop=shop, started_at=timezone.now())
+    assert acquire_shop_lock(shop.id, 0)
+    with pytest.raises(ShopImportLocked):
+        run_import_job(interrupted)
+    assert ImportJob.objects.get(id=interrupted).state == 'running'
+    release_shop_lock(shop.id, 0)
+    assert run_import_job(interrupted).state == 'done'
+
+
+@pytest.mark.django_db
+def test_invalid_price_list_rejected_before_writes(client_token_shop, update_pricelist, monkeypatch):
+    with open(settings.BASE_DIR / 'shop.yaml', encoding='utf-8') as file:
+        data = load_yaml(file, Loader=Loader)
+    del data['goods'][1]['price']
+    data['goods'][2]['quantity'] = -1
+    data['goods'][3]['category'] = 999
+    feed = yaml_dump(data, allow_unicode=True).encode()
+    monkeypatch.setattr('backend.importer.get', lambda url: SimpleNamespace(content=feed))
+    offers_before = catalog_snapshot()
+
+    response = client_token_shop.post('/api/v1/partner/update/', data={
+        'url': 'https://raw.githubusercontent.com/typeoflife/my_diplom/main/shop.yaml'}).json()
+    assert response['Status'] is False
+    assert [error['path'] for error in response['Errors']] == [
+        'goods[1].price', 'goods[2].quantity', 'goods[3].category']
+    assert catalog_snapshot() == offers_before
+    assert ImportJob.objects.get(id=response['Job']).state == 'failed'
+
+    # прайс без обязательных разделов отклоняется проверкой, а не падает при загрузке
+    assert validate_price_list({'shop': data['shop'], 'goods': []}) == [
+        {'path': 'categories', 'error': 'поле отсутствует'}]
+    assert [error['path'] for error in validate_price_list({'shop': data['shop']})] == ['categories', 'goods']
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('compact', ['false', 'true'])
+def test_order_detail_queries_independent_of_lines(client_token, update_pricelist, contacts, compact):
+    product_info_ids = list(ProductInfo.objects.values_list('id', flat=True))
+    query_counts = []
+    for lines in (product_info_ids[:1], product_info_ids):
+        items = [{'product_info': product_info_id, 'quantity': 1} for product_info_id in lines]
+        client_token.post('/api/v1/basket/', {'items': [json.dumps(items)]})
+        basket = Order.objects.get(state='basket')
+        client_token.post('/api/v1/orders/', {'id': basket.id, 'contact': contacts.id})
+        reference.shops.clear()
+        with CaptureQueriesContext(connections['default']) as queries:
+            data = client_token.get(f'/api/v1/orders/{basket.id}/', {'compact': compact}).json()
+        assert len(data['ordered_items']) == len(lines)
+        query_counts.append(len(queries))
+    assert query_counts[0] == query_counts[1]
+    assert ('user' in data) == (compact == 'false')
+
+
+@pytest.mark.django_db
+def test_import_switches_catalog_version(client, client_token, client_token_shop, user_shop, update_pricelist, contacts,
+                                        monkeypatch):
+    shop = Shop.objects.get(user=user_shop)
+    offer_ids = list(ProductInfo.objects.order_by('id').values_list('id', flat=True))
+    client_token.post('/api/v1/basket/', {'items': [json.dumps([{'product_info': offer_ids[0], 'quantity': 1}])]})
+    order = Order.objects.get(state='basket')
+    client_token.post('/api/v1/orders/', {'id': order.id, 'contact': contacts.id})
+    client_token.post('/api/v1/basket/', {'items': [json.dumps([{'product_info': offer_ids[1], 'quantity': 1}])]})
+    basket = Order.objects.get(state='basket')
+
+    # пока загружается новая версия, покупатели видят прежний каталог целиком
+    listed = client.get('/api/v1/products/').json()['count']
+    get_or_create = reference.parameters.get_or_create
+
+    def check_listing(*args, **kwargs):
+        assert not ProductInfo.objects.filter(version=2, is_active=True).exists()
+        # после первой проверки магазин отключают посреди загрузки
+        if Shop.objects.get(id=shop.id).state:
+            assert client.get('/api/v1/products/').json()['count'] == listed
+            client_token_shop.post('/api/v1/partner/state/', data={'state': 'off'})
+        return get_or_create(*args, **kwargs)
+
+    monkeypatch.setattr(reference.parameters, 'get_or_create', check_listing)
+    with open(settings.BASE_DIR / 'shop.yaml', encoding='utf-8') as file:
+        import_price_list(load_yaml(file, Loader=Loader), user_shop.id, shop.url)
+    shop.refresh_from_db()
+    assert shop.catalog_version == 2
+    assert not ProductInfo.objects.filter(version=2, is_active=True).exists()
+    client_token_shop.post('/api/v1/partner/state/', data={'state': 'on'})
+    assert {product['id'] for product in client.get('/api/v1/products/').json()['results']} == set(
+        ProductInfo.objects.filter(version=2).values_list('id', flat=True))
+    assert not ProductInfo.objects.filter(version=1, is_active=True).exists()
+    # предложения прежней версии в корзину больше не кладутся
+    response = client_token.post('/api/v1/basket/', {
+        'items': [json.dumps([{'product_info': offer_ids[2], 'quantity': 1}])]})
+    assert response.json()['Создано объектов'] == 0
+
+    # корзина переехала на новую версию, оформленный заказ остался на старой
+    assert basket.ordered_items.get().product_info.version == 2
+    assert order.ordered_items.get().product_info_id == offer_ids[0]
+    assert OutboxEvent.objects.filter(task=collect_catalog_versions_task.name).exists()
+    assert collect_catalog_versions(shop.id, batch_size=2) == len(offer_ids) - 1
+    assert set(ProductInfo.objects.filter(version=1).values_list('id', flat=True)) == {offer_ids[0]}
+
+
+class FakeRedis:
+    """Команды redis, которыми пользуется RedisBasket, поверх словаря (decode_responses=True)"""
+
+    def __init__(self):
+        self.data, self.ttl = {}, {}
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        values = dict(mapping or {})
+        if field is not None:
+            values[field] = value
+        self.data.setdefault(key, {}).update({str(name): str(item) for name, item in values.items()})
+        return len(values)
+
+    def hsetnx(self, key, field, value):
+        if field in self.data.get(key, {}):
+            return 0
+        return self.hset(key, field, value)
+
+    def hdel(self, key, *fields):
+        return sum(self.data.get(key, {}).pop(str(field), None) is not None for field in fields)
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+    def expire(self, key, seconds):
+        self.ttl[key] = seconds
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_redis_basket_written_to_order_on_checkout(client_token, user, update_pricelist, contacts, settings,
+                                                   monkeypatch):
+    settings.BASKET_BACKEND = 'redis'
+    fake = FakeRedis()
+    monkeypatch.setattr('backend.baskets._client', fake)
+    offers = list(ProductInfo.objects.order_by('id')[:2])
+    items = [{'product_info': offer.id, 'quantity': 2} for offer in offers]
+    with CaptureQueriesContext(connections['default']) as queries:
+        response = client_token.post('/api/v1/basket/', {'items': [json.dumps(items)]}).json()
+    assert response == {'Status': True, 'Создано объектов': 2}
+    assert not [query for query in queries if not query['sql'].startswith('SELECT')]
+    client_token.put('/api/v1/basket/', {'items': [json.dumps([{'id': offers[0].id, 'quantity': 3}])]})
+
+    basket = client_token.get('/api/v1/basket/').json()
+    assert basket['count'] == 1 and not Order.objects.exists()
+    assert basket['results'][0]['sum'] == 3 * offers[0].price + 2 * offers[1].price
+    assert basket['results'][0]['total_sum'] == basket['results'][0]['sum'] + DELIVERY
+    assert fake.ttl[f'basket:{user.id}'] == settings.BASKET_TTL
+
+    basket_id = RedisBasket(user.id).basket_id()
+    assert client_token.post('/api/v1/orders/', {'id': basket_id, 'contact': contacts.id}).json()['Status']
+    order = Order.objects.get(state='new')
+    assert sorted(order.ordered_items.values_list('product_info_id', 'quantity')) == [
+        (offers[0].id, 3), (offers[1].id, 2)]
+    assert f'basket:{user.id}' not in fake.data
+    assert client_token.get('/api/v1/basket/').json()['count'] == 0
+    # заказ из redis сразу оформлен и попадает в продажи продуктов
+    assert sorted(ShopDailyProductSales.objects.values_list('product_id', 'units')) == sorted(
+        [(offers[0].product_id, 3), (offers[1].product_id, 2)])
+
+
+@pytest.mark.django_db
+def test_redis_basket_rejects_bad_quantities_and_empty_checkout(client_token, user, update_pricelist, contacts,
+                                                               settings, monkeypatch):
+    settings.BASKET_BACKEND = 'redis'
+    monkeypatch.setattr('backend.baskets._client', FakeRedis())
+    offer = ProductInfo.objects.order_by('id').first()
+    items = [{'product_info': offer.id, 'quantity': quantity} for quantity in (0, -1)]
+    response = client_token.post('/api/v1/basket/', {'items': [json.dumps(items)]}).json()
+    assert response == {'Status': True, 'Создано объектов': 0}
+    client_token.post('/api/v1/basket/', {'items': [json.dumps([{'product_info': offer.id, 'quantity': 1}])]})
+    response = client_token.put('/api/v1/basket/', {'items': [json.dumps([{'id': offer.id, 'quantity': -2}])]})
+    assert response.json() == {'Status': True, 'Обновлено объектов': 0}
+
+    # пустую корзину не оформляем: ни заказа, ни письма, ни сводок
+    basket_id = RedisBasket(user.id).basket_id()
+    client_token.delete('/api/v1/basket/', {'items': str(offer.id)})
+    response = client_token.post('/api/v1/orders/', {'id': basket_id, 'contact': contacts.id}).json()
+    assert response['Status'] is False
+    assert not Order.objects.exists() and not OutboxEvent.objects.filter(task=new_order.name).exists()
+
+
+@pytest.mark.django_db
+def test_sweep_expired_rows(client_token, user, user_shop, update_pricelist, contacts):
+    offer_ids = list(ProductInfo.objects.values_list('id', flat=True)[:3])
+    client_token.post('/api/v1/basket/', {'items': [json.dumps(
+        [{'product_info': product_info_id, 'quantity': 1} for product_info_id in offer_ids[:2]])]})
+    old = timezone.now() - timedelta(days=settings.BASKET_RETENTION_DAYS + 1)
+    Order.objects.filter(state='basket').update(dt=old, updated_at=old)
+    # старую корзину только что изменили: её не удаляем
+    client_token.post('/api/v1/basket/', {'items': [json.dumps([{'product_info': offer_ids[2], 'quantity': 1}])]})
+    fresh_basket = Order.objects.get(state='basket')
+    abandoned = Order.objects.create(user=user_shop, state='basket')
+    OrderItem.objects.bulk_create(OrderItem(order=abandoned, product_info_id=product_info_id, quantity=1)
+                                  for product_info_id in offer_ids[:2])
+    Order.objects.filter(id=abandoned.id).update(dt=old, updated_at=old)
+    ConfirmEmailToken.objects.create(user=user)
+    ConfirmEmailToken.objects.update(created_at=old)
+    ResetPasswordToken.objects.create(user=user)
+    ResetPasswordToken.objects.update(created_at=old)
+    enqueue(new_order, user_id=user.id, order_id=1)
+    OutboxEvent.objects.update(published_at=old)
+    expected = {'backend.Order': 1, 'backend.OrderItem': 2,
+                'backend.ConfirmEmailToken': ConfirmEmailToken.objects.count(),
+                'django_rest_passwordreset.ResetPasswordToken': 1,
+                'backend.OutboxEvent': OutboxEvent.objects.count()}
+
+    report = sweep_expired(batch_size=1)
+    assert report['removed'] == expected and report['seconds'] >= 0
+    assert list(Order.objects.filter(state='basket')) == [fresh_basket]
+    out = StringIO()
+    call_command('sweep_expired', stdout=out)
+    assert 'backend.Order' not in out.getvalue()
+
+
+@pytest.mark.django_db
+def test_archived_orders_read_by_date_range(client_token, client_token_shop, user_shop, update_pricelist, contacts):
+    client_token.post('/api/v1/basket/', {'items': [json.dumps(
+        [{'product_info': product_info_id, 'quantity': 2} for product_info_id in
+         ProductInfo.objects.values_list('id', flat=True)[:2]])]})
+    basket = Order.objects.get(state='basket')
+    client_token.post('/api/v1/orders/', {'id': basket.id, 'contact': contacts.id})
+    total_sum = client_token.get('/api/v1/orders/').json()['results'][0]['total_sum']
+    old = timezone.now() - timedelta(days=settings.ORDER_ARCHIVE_AFTER_DAYS + 10)
+    Order.objects.filter(id=basket.id).update(state='delivered', dt=old)
+
+    assert archive_orders(batch_size=1)['archived'] == 1
+    assert not Order.objects.filter(id=basket.id).exists()
+    assert ArchivedOrder.objects.get(id=basket.id).ordered_items.count() == 2
+
+    # без периода архив не читается, с периодом раньше границы архива - попадает в выдачу
+    assert client_token.get('/api/v1/orders/').json()['count'] == 0
+    period = {'date_from': (old - timedelta(days=1)).date().isoformat(), 'date_to': old.date().isoformat()}
+    results = client_token.get('/api/v1/orders/', period).json()['results']
+    assert [(order['id'], order['state'], order['total_sum']) for order in results] == [
+        (basket.id, 'delivered', total_sum)]
+    assert client_token_shop.get('/api/v1/partner/orders/', period).json()['count'] == 1
+    assert len(client_token.get(f'/api/v1/orders/{basket.id}/').json()['ordered_items']) == 2
+    # права на объект из архива проверяются так же, как для рабочих таблиц (IsOwner)
+    assert client_token_shop.get(f'/api/v1/partner/orders/{basket.id}/').status_code == 403
+
+    # предложения из архивных заказов не удаляются вместе со старой версией каталога
+    shop = Shop.objects.get(user=user_shop)
+    Shop.objects.filter(id=shop.id).update(catalog_version=F('catalog_version') + 1)
+    collect_catalog_versions(shop.id)
+    assert ArchivedOrderItem.objects.count() == 2
+
+
+def rollup_rows():
+    return sorted(ShopDailySales.objects.exclude(orders=0, units=0).values_list(
+        'shop_id', 'day', 'state', 'orders', 'units', 'revenue')) + sorted(
+        ShopDailyProductSales.objects.exclude(units=0).values_list(
+            'shop_id', 'day', 'product_id', 'category_id', 'units', 'revenue'))
+
+
+@pytest.mark.django_db
+def test_partner_sales_rollups(client_token, client_token_shop, update_pricelist, contacts):
+    offers = list(ProductInfo.objects.order_by('id')[:2])
+    for quantities in ((2, 1), (1, 3)):
+        client_token.post('/api/v1/basket/', {'items': [json.dumps(
+            [{'product_info': offer.id, 'quantity': quantity} for offer, quantity in zip(offers, quantities)])]})
+        basket = Order.objects.get(state='basket')
+        client_token.post('/api/v1/orders/', {'id': basket.id, 'contact': contacts.id})
+    revenue = 3 * offers[0].price + 4 * offers[1].price
+
+    report = client_token_shop.get('/api/v1/partner/analytics/').json()
+    assert [(day['orders'], day['units'], day['revenue']) for day in report['days']] == [(2, 7, revenue)]
+    assert report['states'] == {'new': 2}
+    assert sum(product['revenue'] for product in report['products']) == revenue
+    assert report['categories'][0]['category'] == offers[0].product.category.name
+
+    # отмена заказа (как из админки) переносит его в статус canceled и убирает из продаж
+    Order.objects.filter(id=basket.id).update(state='canceled')
+    order_state_changed.send(sender=Order, order_id=basket.id, old_state='new', new_state='canceled')
+    report = client_token_shop.get('/api/v1/partner/analytics/').json()
+    assert report['states'] == {'new': 1, 'canceled': 1}
+    assert report['days'][0]['revenue'] == 2 * offers[0].price + offers[1].price
+
+    incremental = rollup_rows()
+    call_command('rebuild_rollups', stdout=StringIO())
+    assert rollup_rows() == incremental
+
+
+@pytest.mark.django_db
+def test_offer_health_report(client_token_shop, user_shop, update_pricelist):
+    over_rrc, zero_stock, outlier = ProductInfo.objects.order_by('id')[:3]
+    ProductInfo.objects.filter(id=over_rrc.id).update(price=over_rrc.price_rrc + 1)
+    ProductInfo.objects.filter(id=zero_stock.id).update(quantity=0)
+    # ещё два магазина продают продукт втрое дешевле
+    for name in ('second', 'third'):
+        shop = Shop.objects.create(name=name)
+        ProductInfo.objects.create(product_id=outlier.product_id, shop=shop, external_id=outlier.external_id,
+                                   quantity=1, price=outlier.price // 3, price_rrc=outlier.price_rrc)
+
+    response = client_token_shop.get('/api/v1/partner/export/health/')
+    lines = b''.join(response.streaming_content).decode().splitlines()
+    assert lines[0].split(',') == ['product_info_id', 'product_id', 'shop_id', 'price', 'price_rrc', 'quantity',
+                                   'is_active', 'product_offers', 'product_median_price', 'over_rrc', 'zero_stock',
+                                   'price_outlier']
+    flagged = {int(line.split(',')[0]): line.split(',')[-3:] for line in lines[1:]}
+    assert flagged == {over_rrc.id: ['True', 'False', 'False'], zero_stock.id: ['False', 'True', 'False'],
+                       outlier.id: ['False', 'False', 'True']}
+
+    # порции меньше продукта и магазина не меняют отчёт
+    out = StringIO()
+    call_command('offer_health_report', chunk_size=2, stdout=out)
+    assert out.getvalue().splitlines()[1:] == lines[1:]
+
+
+def recommendation_rows():
+    return sorted(ProductRecommendation.objects.values_list('product_id', 'neighbour_id', 'score'))
+
+
+def run_recommendation_events():
+    # задачи из outbox выполняем сами, как это сделал бы воркер
+    for event in OutboxEvent.objects.filter(task=update_order_recommendations_task.name, published_at__isnull=True):
+        update_order_recommendations_task(**event.kwargs)
+        OutboxEvent.objects.filter(id=event.id).update(published_at=timezone.now())
+
+
+@pytest.mark.django_db
+def test_frequently_bought_together(client, client_token, update_pricelist, contacts):
+    a, b, c = ProductInfo.objects.order_by('id')[:3]
+    for offers in ((a, b), (a, b), (a, c)):
+        client_token.post('/api/v1/basket/', {'items': [json.dumps(
+            [{'product_info': offer.id, 'quantity': 1} for offer in offers])]})
+        basket = Order.objects.get(state='basket')
+        client_token.post('/api/v1/orders/', {'id': basket.id, 'contact': contacts.id})
+    run_recommendation_events()
+
+    response = client.get(f'/api/v1/recommendations/{a.product_id}/').json()
+    assert [(item['product'], item['score']) for item in response] == [(b.product_id, 2), (c.product_id, 1)]
+    response = client.get('/api/v1/recommendations/', {'product_id': f'{b.product_id},{c.product_id}'}).json()
+    assert [(item['product'], item['score']) for item in response] == [(a.product_id, 3)]
+
+    # отмена заказа убирает его пары
+    order_state_changed.send(sender=Order, order_id=basket.id, old_state='new', new_state='canceled')
+    Order.objects.filter(id=basket.id).update(state='canceled')
+    run_recommendation_events()
+    incremental = recommendation_rows()
+    assert incremental == sorted([(a.product_id, b.product_id, 2), (b.product_id, a.product_id, 2)])
+
+    call_command('rebuild_recommendations', chunk_size=1, stdout=StringIO())
+    assert recommendation_rows() == incremental
+
+
+@pytest.mark.django_db
+def test_autocomplete_prefix(client, client_token_shop, user_shop, update_pricelist, settings,
+                             django_capture_on_commit_callbacks):
+    settings.AUTOCOMPLETE_CHECK_SECONDS = 0
+    offer = ProductInfo.objects.select_related('product').order_by('id').first()
+    name = offer.product.name
+    # тот же продукт у второго магазина: имя поднимается в выдаче
+    shop = Shop.objects.create(name='second')
+    ProductInfo.objects.create(product=offer.product, shop=shop, external_id=1, model='Ёлка',
+                               quantity=1, price=1, price_rrc=1)
+
+    response = client.get('/api/v1/products/autocomplete/', {'q': name[:3].upper()}).json()
+    assert response[0] == {'name': name, 'offers': 2}
+    assert client.get('/api/v1/products/autocomplete/', {'q': 'елк'}).json() == [{'name': 'Ёлка', 'offers': 1}]
+
+    # выключенный магазин пропадает из подсказок после смены версии каталога
+    with django_capture_on_commit_callbacks(execute=True):
+        client_token_shop.post('/api/v1/partner/state/', data={'state': 'off'})
+    response = client.get('/api/v1/products/autocomplete/', {'q': name[:3]}).json()
+    assert response == [{'name': name, 'offers': 1}]
+
+
+@pytest.mark.django_db
+def test_sparse_fieldsets(client, client_token, update_pricelist, contacts):
+    with CaptureQueriesContext(connections['default']) as queries:
+        response = client.get('/api/v1/products/', {'fields': 'id,price'})
+    assert set(response.json()['results'][0]) == {'id', 'price'}
+    assert not any('"model"' in query['sql'] for query in queries.captured_queries)
+    response = client.get('/api/v1/products/', {'exclude': 'shop'})
+    assert set(response.json()['results'][0]) == {'id', 'model', 'price'}
+
+    client_token.post('/api/v1/basket/', {'items': ['[{"product_info": "2", "quantity": "2"}]']})
+    basket = Order.objects.get(state='basket')
+    client_token.post('/api/v1/orders/', {'id': basket.id, 'contact': contacts.id})
+    # без данных покупателя заказ читается без соединения с пользователями
+    with CaptureQueriesContext(connections['default']) as queries:
+        response = client_token.get(f'/api/v1/orders/{basket.id}/', {'exclude': 'user,phone,contact'})
+    assert set(response.json()) == {'id', 'dt', 'state', 'ordered_items', 'total_sum'}
+    assert not any('"backend_contact"' in query['sql'] for query in queries.captured_queries)
+
+
+@pytest.mark.django_db
+def test_response_compression(client, update_pricelist, settings):
+    settings.COMPRESSION_MIN_SIZE = 100
+    plain = client.get('/api/v1/products/')
+    assert not plain.has_header('Content-Encoding') and plain['Vary'].endswith('Accept-Encoding')
+
+    response = client.get('/api/v1/products/', HTTP_ACCEPT_ENCODING='gzip, br;q=0')
+    assert response['Content-Encoding'] == 'gzip' and gzip.decompress(response.content) == plain.content
+    response = client.get('/api/v1/products/', HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+    assert response['Content-Encoding'] == 'br' and brotli.decompress(response.content) == plain.content
+    assert len(response.content) < len(plain.content)
+
+    # маленький ответ не сжимаем
+    settings.COMPRESSION_MIN_SIZE = len(plain.content) + 1
+    assert not client.get('/api/v1/products/', HTTP_ACCEPT_ENCODING='br').has_header('Content-Encoding')
+
+
+@pytest.mark.django_db
+def test_batch_procurement_run(client, user, update_pricelist):
+    offer_id = ProductInfo.objects.order_by('id').values_list('id', flat=True).first()
+    operations = [
+        {'id': 'login', 'method': 'POST', 'url': '/api/v1/user/login/',
+         'data': {'email': user.email, 'password': '12345678Q'}},
+        {'method': 'POST', 'url': '/api/v1/user/contact/', 'headers': {'Authorization': 'Token {{login.Token}}'},
+         'data': {'city': 'Moscow', 'street': 'Gogolya', 'house': '58', 'phone': '+79424238142'}},
+        {'id': 'contacts', 'url': '/api/v1/user/contact/', 'headers': {'Authorization': 'Token {{login.Token}}'}},
+        {'method': 'POST', 'url': '/api/v1/basket/', 'headers': {'Authorization': 'Token {{login.Token}}'},
+         'data': {'items': [{'product_info': offer_id, 'quantity': 2}]}},
+        {'id': 'basket', 'url': '/api/v1/basket/', 'headers': {'Authorization': 'Token {{login.Token}}'}},
+        {'method': 'POST', 'url': '/api/v1/orders/', 'headers': {'Authorization': 'Token {{login.Token}}'},
+         'data': {'id': '{{basket.results.0.id}}', 'contact': '{{contacts.results.0.id}}'}},
+    ]
+    # ошибка последней операции откатывает всю транзакцию
+    failing = operations[:-1] + [{**operations[-1], 'data': {'id': '{{basket.results.0.missing}}'}}]
+    response = client.post('/api/v1/batch/', {'atomic': True, 'operations': failing}, format='json').json()
+    assert response['Status'] is False and response['rolled_back'] is True
+    assert response['operations'][-1]['status'] == 424
+    assert not Contact.objects.exists() and not Order.objects.exists()
+
+    response = client.post('/api/v1/batch/', {'atomic': True, 'operations': operations}, format='json').json()
+    assert response['Status'] is True
+    assert [operation['status'] for operation in response['operations']] == [200] * len(operations)
+    order = Order.objects.get(user=user)
+    assert order.state == 'new' and order.contact_id == Contact.objects.get(user=user).id
+    assert order.ordered_items.get().quantity == 2